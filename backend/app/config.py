@@ -18,8 +18,17 @@ class Settings(BaseSettings):
     # Paths
     upload_dir: str = "uploads"
     temp_dir: str = "temp"
+    page_cache_dir: str = "cache/pages"  # 渲染页面图像的磁盘缓存
     database_url: str = "sqlite+aiosqlite:///./unitutor.db"
 
+    # 进程内读缓存（本进程写入时立即失效；其他进程的写入只能等 TTL 过期）
+    metadata_cache_size: int = 1024
+    metadata_cache_ttl: float = 5.0
+    explanation_cache_size: int = 4096
+    explanation_cache_ttl: float = 300.0  # 单进程部署时的页面解释缓存有效期（秒）
+    explanation_cache_shared_ttl: float = 5.0  # 多进程部署时改用的有效期（秒）
+    web_concurrency: int = 1  # 服务进程数，与 uvicorn --workers / WEB_CONCURRENCY 保持一致
+
     # Server
     host: str = "0.0.0.0"
     port: int = 8000
@@ -28,10 +37,58 @@ class Settings(BaseSettings):
     # Processing
     max_file_size_mb: int = 50
     supported_formats: list[str] = [".pdf"]
+    max_concurrent_pages: int = 1  # 每个任务默认同时处理的页数（1 表示逐页处理，每页都有前文摘要）
+    max_concurrent_pages_limit: int = 8  # 客户端可请求的并发页数上限
+    pages_per_request: int = 1  # 每个任务默认每次请求分析的页数（1 表示不合并）
+    pages_per_request_limit: int = 6  # 客户端可请求的每次请求页数上限
+    render_prefetch_depth: int = 2  # 每个处理片段提前渲染的页数（有界队列长度）
+    progress_flush_pages: int = 5  # 进度每累计多少页写一次数据库
+    progress_flush_interval: float = 2.0  # 或距上次写入超过多少秒
+    pdf_max_open_documents: int = 16  # 同时保持打开的 PDF 文档句柄数
+    pdf_document_idle_seconds: int = 300  # 文档句柄空闲多久后关闭
+    page_cache_max_mb: int = 1024  # 页面图像磁盘缓存配额
+    page_image_format: str = "png"  # 页面图像编码格式：png / jpeg / webp
+    page_image_quality: int = 85  # jpeg / webp 的编码质量
+    render_pool_size: int = 2  # 页面渲染进程数，0 表示在线程中渲染
+    export_render_ahead: int = 4  # 导出时提前并行渲染的页数
+    export_image_format: str = "webp"  # ZIP 导出中图片文件的格式：png / jpeg / webp
+    explanation_memo_max_entries: int = 20000  # 跨文档解释记忆保留的条目数（按最近使用淘汰）
+    page_text_fast_path: bool = True  # 纯文字页面只发送文本层，空白页/结束页直接使用模板
+    text_page_max_drawings: int = 10  # 绘图数不超过该值的无图片页面视为纯文字（模板装饰）
+    build_slide_grouping: bool = False  # 合并动画分步页，只分析每组最完整的一页（需显式开启）
+    build_slide_max_hash_distance: int = 12  # 相邻页缩略图指纹的最大汉明距离（0-64）
+    build_slide_sparse_hash_distance: int = 4  # 前一页文字很少（如只有标题）时使用的更严格距离
+    build_slide_min_text_chars: int = 40  # 前一页文字少于该字数时视为文字很少
+
+    # Job Queue（任务持久化在数据库中，多个进程可共享同一个队列）
+    job_worker_concurrency: int = 4  # 每个进程同时运行的任务数
+    job_poll_interval: float = 2.0  # 队列为空时的轮询间隔（秒）
+    job_lease_seconds: int = 60  # 任务租约时长，持有者每 1/3 租约续期一次
+    job_max_attempts: int = 3  # 任务最多被认领的次数（防止反复崩溃的任务无限重试）
+    job_page_max_attempts: int = 2  # 单页最多尝试次数（跨重启累计）
 
     # LLM Settings
     max_tokens: int = 50000
     temperature: float = 0.7
+    llm_request_timeout: float = 180.0  # 单次非流式请求、流式请求首块的超时（秒）
+    llm_stream_idle_timeout: float = 60.0  # 流式输出两块之间的最长等待（秒），超过视为连接停滞
+    llm_generation_deadline: float = 900.0  # 单次流式生成的总时长上限（秒）
+    llm_pool_max_entries: int = 64  # 复用的 (API Key, 模型) 客户端数量上限
+    llm_pool_idle_seconds: float = 900.0  # 客户端空闲多久后释放（秒）
+    llm_key_max_concurrency: int = 8  # 每个 (API Key, 模型) 同时进行的请求上限
+
+    # Chat Sessions
+    chat_history_token_budget: int = 4000  # 每轮携带的历史对话 token 上限，更早的轮次并入摘要
+    chat_summary_max_tokens: int = 8192  # 生成对话摘要的输出上限（含思考 token）
+    chat_session_ttl_hours: int = 72  # 会话闲置多久后删除
+    chat_answer_cache_size: int = 512  # 重复问题回答缓存的条目上限（0 表示关闭）
+    chat_answer_cache_ttl: float = 3600.0  # 缓存回答的有效期（秒）
+
+    # Rate Limiting（按 API Key + 模型共享预算，默认对齐免费层级）
+    llm_rpm_limit: int = 10  # 每分钟请求数
+    llm_tpm_limit: int = 250000  # 每分钟输入 token 数
+    # 按模型覆盖，如 {"gemini-2.5-pro": {"rpm": 5, "tpm": 250000}}
+    llm_model_rate_limits: dict[str, dict[str, int]] = {}
 
     class Config:
         env_file = ".env"
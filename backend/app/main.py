@@ -1,13 +1,13 @@
 """PPT Helper - FastAPI 后端"""
 import os
 import asyncio
-import base64
-import io
+import hashlib
+import uuid
 from pathlib import Path
-from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks
+from typing import Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from contextlib import asynccontextmanager
 import json
@@ -20,12 +20,129 @@ from app.models.schemas import (
 )
 from app.services.pdf_parser import pdf_parser
 from app.services.cache_service import cache_service
-from app.services.llm_service import llm_service, create_llm_service
+from app.services.llm_service import create_llm_service, llm_pool
+from app.services.processing_service import job_worker
+from app.services.job_queue import job_queue
+from app.services.chat_service import chat_sessions
+from app.services.event_bus import OVERFLOW_EVENT, event_bus
+from app.services.page_stream import page_streams, page_topic
+from app.services.rate_limiter import rate_limiter
+from app.services.page_image_cache import page_image_cache
+from app.services.export_service import stream_markdown, stream_zip_bundle
 
 settings = get_settings()
 
-# 存储正在处理的任务
-processing_tasks = {}
+# 上传文件分块读取大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# SSE 心跳间隔（秒）
+SSE_HEARTBEAT_SECONDS = 15
+# 聊天输出缓冲的最大块数；客户端读取慢时生成端在此等待
+CHAT_STREAM_BUFFER = 64
+
+
+def sse_event(data: dict) -> str:
+    """格式化一条 SSE 数据事件"""
+    return f"data: {json.dumps(data)}\n\n"
+
+
+async def forward_events(queue: asyncio.Queue, until: tuple = (), on_idle=None):
+    """
+    将订阅队列中的事件转为 SSE，遇到 until 中的事件类型后结束
+
+    空闲时发送心跳；提供 on_idle 时改为发送其返回的事件（同样受 until 约束）。
+    订阅因积压过多被事件总线移除时直接结束连接，客户端（EventSource）重连后重新获取快照。
+    """
+    while True:
+        try:
+            event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            idle_event = await on_idle() if on_idle else None
+            if not idle_event:
+                yield ": ping\n\n"
+                continue
+            event = idle_event
+        if event is OVERFLOW_EVENT:
+            return
+        yield sse_event(event)
+        if event.get("type") in until:
+            return
+
+
+async def relay_chat(chunks, http_request: Request, preamble: Optional[dict] = None):
+    """
+    将聊天生成器的输出转为 SSE（preamble 作为第一条事件发送）
+
+    生成在独立任务中进行，经有界队列交给响应：客户端读取慢时生成端等待（背压），
+    等待上游时不阻塞发送。空闲时发送心跳并检查连接；
+    客户端断开或响应被关闭时取消生成任务，上游请求随之取消，不再消耗 token。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=CHAT_STREAM_BUFFER)
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await queue.put(sse_event({"content": chunk}))
+        except Exception as e:
+            print(f"❌ 聊天流生成错误: {str(e)}")
+            await queue.put(sse_event({"error": str(e)}))
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        if preamble:
+            yield sse_event(preamble)
+        while True:
+            try:
+                frame = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await http_request.is_disconnected():
+                    print("🔌 客户端已断开，取消聊天生成")
+                    return
+                yield ": ping\n\n"
+                continue
+            if frame is None:
+                break
+            yield frame
+        # 发送完成信号
+        yield "data: [DONE]\n\n"
+    finally:
+        producer.cancel()
+
+
+def sse_response(events) -> StreamingResponse:
+    """SSE 流式响应"""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",  # 禁用 nginx 缓冲
+        }
+    )
+
+
+async def housekeeping_loop(interval: float = 60):
+    """定时清理空闲资源"""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(pdf_parser.documents.evict_idle)
+        try:
+            purged = await chat_sessions.purge_idle()
+            if purged:
+                print(f"🧹 已删除 {purged} 个闲置聊天会话")
+        except Exception as e:
+            print(f"⚠️ 清理聊天会话失败: {str(e)}")
+        try:
+            async with AsyncSessionLocal() as db:
+                pruned = await cache_service.prune_memoized_explanations(
+                    db, settings.explanation_memo_max_entries
+                )
+            if pruned:
+                print(f"🧹 已淘汰 {pruned} 条解释记忆")
+        except Exception as e:
+            print(f"⚠️ 清理解释记忆失败: {str(e)}")
 
 
 @asynccontextmanager
@@ -36,7 +153,13 @@ async def lifespan(app: FastAPI):
     Path(settings.temp_dir).mkdir(exist_ok=True)
     print(f"✅ 数据库已初始化")
     print(f"✅ 上传目录: {settings.upload_dir}")
+    housekeeping = asyncio.create_task(housekeeping_loop())
+    job_worker.start()
     yield
+    housekeeping.cancel()
+    # 停止任务执行器：取消未完成的 LLM 请求并交还租约，重启后从未完成的页面续跑
+    await job_worker.stop()
+    pdf_parser.shutdown()
     print("👋 关闭服务")
 
 
@@ -67,120 +190,19 @@ async def root():
     return {"message": "PPT Helper API", "version": "0.4.0", "status": "running"}
 
 
-async def process_pdf_background(
-    pdf_id: str,
-    file_path: str,
-    page_numbers: list[int],
-    llm_config: dict = None
-):
-    """后台任务：按顺序处理指定页面
-
-    Args:
-        pdf_id: PDF 文档 ID
-        file_path: PDF 文件路径
-        page_numbers: 要处理的页码列表
-        llm_config: LLM 配置 {"api_key": "...", "model": "..."}
-    """
-    total_pages_to_process = len(page_numbers)
-    print(f"🚀 开始后台处理 PDF: {pdf_id}, 处理 {total_pages_to_process} 页: {page_numbers}")
-
-    # 创建 LLM 服务实例
-    current_model_name = "unknown"  # 用于日志记录
-    if llm_config and llm_config.get("api_key"):
-        current_model_name = llm_config.get("model", "gemini-2.5-flash")
-        current_llm = create_llm_service(
-            api_key=llm_config["api_key"],
-            model=current_model_name
-        )
-        print(f"  📡 使用客户端 API Key，模型: {current_model_name}")
-    else:
-        # 向后兼容：使用全局配置
-        current_llm = llm_service
-        current_model_name = settings.google_model
-        print(f"  📡 使用服务器默认配置，模型: {current_model_name}")
-
-    try:
-        async with AsyncSessionLocal() as db:
-            # 更新状态为处理中
-            await cache_service.update_processing_status(db, pdf_id, "processing", 0)
-
-        processed_count = 0
-        for page_number in page_numbers:
-            print(f"📄 处理第 {page_number} 页 ({processed_count + 1}/{total_pages_to_process})...")
-
-            try:
-                async with AsyncSessionLocal() as db:
-                    # 检查是否已有缓存
-                    cached = await cache_service.get_cached_markdown_explanation(db, pdf_id, page_number)
-                    if cached:
-                        print(f"✅ 第 {page_number} 页已有缓存，跳过")
-                        processed_count += 1
-                        await cache_service.update_processing_status(db, pdf_id, "processing", processed_count)
-                        continue
-
-                # 提取页面图像
-                print(f"  📸 提取页面图像...")
-                page_image = await pdf_parser.parse_single_page(file_path, page_number)
-
-                async with AsyncSessionLocal() as db:
-                    # 获取前面页面的摘要作为上下文
-                    previous_summaries = await cache_service.get_previous_summaries(
-                        db, pdf_id, page_number, max_pages=3
-                    )
-
-                # 调用 LLM 生成解释
-                print(f"  🤖 正在由 {current_model_name} 模型分析第 {page_number} 页...")
-                markdown_content = await current_llm.analyze_image(
-                    image=page_image,
-                    page_num=page_number,
-                    previous_summaries=previous_summaries,
-                    temperature=settings.temperature,
-                    max_tokens=settings.max_tokens,
-                )
-
-                # 提取摘要
-                summary = current_llm.extract_summary(markdown_content, page_number)
-                
-                async with AsyncSessionLocal() as db:
-                    # 保存到缓存
-                    await cache_service.save_markdown_explanation(
-                        db, pdf_id, page_number, markdown_content, summary
-                    )
-                    
-                    # 更新进度
-                    processed_count += 1
-                    await cache_service.update_processing_status(db, pdf_id, "processing", processed_count)
-                
-                print(f"✅ 第 {page_number} 页处理完成")
-                
-                # 小延迟避免 API 限流
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                import traceback
-                print(f"❌ 处理第 {page_number} 页失败: {str(e)}")
-                print(f"  详细错误: {traceback.format_exc()}")
-                # 继续处理下一页
-                continue
-        
-        # 处理完成
-        async with AsyncSessionLocal() as db:
-            await cache_service.update_processing_status(db, pdf_id, "completed", processed_count)
-        print(f"🎉 PDF {pdf_id} 选定页面全部处理完成 ({processed_count}/{total_pages_to_process})")
-        
-    except Exception as e:
-        import traceback
-        print(f"❌ 后台处理失败: {str(e)}")
-        print(f"  详细错误: {traceback.format_exc()}")
-        try:
-            async with AsyncSessionLocal() as db:
-                await cache_service.update_processing_status(db, pdf_id, "failed", 0)
-        except:
-            pass
-    finally:
-        # 清理任务记录
-        if pdf_id in processing_tasks:
-            del processing_tasks[pdf_id]
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """根据 Content-Length 提前拒绝过大的上传，不必先接收完整请求体"""
+    if request.url.path == "/api/upload":
+        content_length = request.headers.get("content-length")
+        # multipart 边界等开销留 1MB 余量，精确限制在 upload_pdf 中逐块检查
+        max_bytes = (settings.max_file_size_mb + 1) * 1024 * 1024
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"文件过大，最大 {settings.max_file_size_mb}MB"},
+            )
+    return await call_next(request)
 
 
 @app.post("/api/upload", response_model=UploadResponse)
@@ -192,16 +214,25 @@ async def upload_pdf(
     if not file.filename.endswith(".pdf"):
         raise HTTPException(400, "仅支持 PDF 文件")
 
-    content = await file.read()
-    if len(content) / (1024 * 1024) > settings.max_file_size_mb:
-        raise HTTPException(400, f"文件过大，最大 {settings.max_file_size_mb}MB")
-
-    temp_path = Path(settings.temp_dir) / file.filename
-    with open(temp_path, "wb") as f:
-        f.write(content)
+    # 分块写入唯一的临时文件，边写边计算哈希，超出大小限制立即中止
+    max_bytes = settings.max_file_size_mb * 1024 * 1024
+    temp_path = Path(settings.temp_dir) / f"{uuid.uuid4().hex}.part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(400, f"文件过大，最大 {settings.max_file_size_mb}MB")
+                sha256.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
 
     try:
-        pdf_id = pdf_parser._generate_pdf_id(str(temp_path))
+        pdf_id = pdf_parser.pdf_id_from_hash(sha256)
 
         # 检查是否已存在
         if await cache_service.check_pdf_exists(db, pdf_id):
@@ -226,9 +257,9 @@ async def upload_pdf(
             if temp_path.exists():
                 temp_path.unlink()
         else:
-            temp_path.rename(final_path)
+            os.replace(temp_path, final_path)
 
-        total_pages = pdf_parser.get_page_count(str(final_path))
+        total_pages = await asyncio.to_thread(pdf_parser.get_page_count, str(final_path))
 
         await cache_service.save_pdf_metadata(
             db, pdf_id, file.filename, total_pages, str(final_path)
@@ -260,14 +291,9 @@ async def start_processing(
     if not pdf_doc:
         raise HTTPException(404, "PDF 未找到")
     
-    # 检查是否已经在处理中（且任务仍在运行）
-    if pdf_id in processing_tasks:
-        task = processing_tasks[pdf_id]
-        if not task.done():
-            raise HTTPException(400, "该 PDF 正在处理中")
-        else:
-            # 任务已完成，清理记录
-            del processing_tasks[pdf_id]
+    # 检查是否已有未结束的任务（可能在其他进程中运行）
+    if await job_queue.get_active_job(db, pdf_id):
+        raise HTTPException(400, "该 PDF 正在处理中")
     
     # 获取要处理的页码列表
     page_numbers = request.get("page_numbers", [])
@@ -276,6 +302,7 @@ async def start_processing(
 
     # 获取 LLM 配置（可选）
     llm_config = request.get("llm_config", None)
+    user_api_key = None
     
     if not llm_config or not llm_config.get("api_key"):
         # 用户未提供 API Key,使用默认配置
@@ -294,36 +321,52 @@ async def start_processing(
         model = llm_config.get("model", "gemini-2.5-flash")
         if model not in ["gemini-2.5-flash", "gemini-2.5-pro"]:
             raise HTTPException(400, f"不支持的模型: {model}")
+        user_api_key = llm_config["api_key"]
         print(f"🔑 使用用户 API Key (模型: {model})")
 
+    # 并发页数（可选），限制在服务器允许的范围内
+    max_concurrent_pages = request.get("max_concurrent_pages", settings.max_concurrent_pages)
+    if not isinstance(max_concurrent_pages, int) or max_concurrent_pages < 1:
+        raise HTTPException(400, "max_concurrent_pages 必须是正整数")
+    max_concurrent_pages = min(max_concurrent_pages, settings.max_concurrent_pages_limit)
+
+    # 每次请求分析的页数（可选），大于 1 时多页合并为一次请求
+    pages_per_request = request.get("pages_per_request", settings.pages_per_request)
+    if not isinstance(pages_per_request, int) or pages_per_request < 1:
+        raise HTTPException(400, "pages_per_request 必须是正整数")
+    pages_per_request = min(pages_per_request, settings.pages_per_request_limit)
+
     # 验证页码
     total_pages = pdf_doc.total_pages
     invalid_pages = [p for p in page_numbers if p < 1 or p > total_pages]
     if invalid_pages:
         raise HTTPException(400, f"页码无效: {invalid_pages}，有效范围: 1-{total_pages}")
 
-    # 更新选定页数
-    async with AsyncSessionLocal() as update_db:
-        from sqlalchemy import update
-        from app.models.database import PDFDocument
-        stmt = update(PDFDocument).where(PDFDocument.id == pdf_id).values(
-            selected_pages_count=len(page_numbers),
-            processed_pages=0,
-            processing_status="pending"
+    # 任务入队并重置进度；由任务执行器认领运行
+    # API Key 不落库：服务器默认 Key 执行时从配置读取（任何进程都可运行），
+    # 用户 Key 只保存在本进程内存中，任务由本进程运行
+    try:
+        job = await job_queue.enqueue(
+            db,
+            pdf_id,
+            page_numbers,
+            model=llm_config.get("model", "gemini-2.5-flash"),
+            api_key=user_api_key,
+            max_concurrent_pages=max_concurrent_pages,
+            pages_per_request=pages_per_request,
+            worker_id=job_worker.worker_id,
         )
-        await update_db.execute(stmt)
-        await update_db.commit()
-
-    # 启动后台处理任务（传递 LLM 配置）
-    task = asyncio.create_task(
-        process_pdf_background(pdf_id, pdf_doc.file_path, page_numbers, llm_config)
-    )
-    processing_tasks[pdf_id] = task
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    job_worker.notify()
 
     return {
         "message": f"已启动处理 {len(page_numbers)} 页",
+        "job_id": job.id,
         "page_numbers": page_numbers,
-        "model": llm_config.get("model", "default") if llm_config else "server_default"
+        "model": llm_config.get("model", "default") if llm_config else "server_default",
+        "max_concurrent_pages": max_concurrent_pages,
+        "pages_per_request": pages_per_request,
     }
 
 
@@ -334,17 +377,37 @@ async def get_progress(pdf_id: str, db: AsyncSession = Depends(get_db)):
     if not pdf_doc:
         raise HTTPException(404, "PDF 未找到")
 
-    # 使用选定页数计算进度，如果没有选定则使用总页数
-    total_for_progress = pdf_doc.selected_pages_count if pdf_doc.selected_pages_count > 0 else pdf_doc.total_pages
-    progress_percentage = (pdf_doc.processed_pages / total_for_progress * 100) if total_for_progress > 0 else 0
+    return ProcessingProgress.from_document(pdf_doc)
 
-    return ProcessingProgress(
-        pdf_id=pdf_id,
-        total_pages=total_for_progress,  # 返回选定的页数
-        processed_pages=pdf_doc.processed_pages,
-        status=pdf_doc.processing_status or "pending",
-        progress_percentage=round(progress_percentage, 1)
-    )
+
+@app.get("/api/progress/{pdf_id}/stream")
+async def stream_progress(pdf_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    推送处理进度（SSE）
+
+    连接后先发送一次当前进度，之后推送事件：
+    - {"type": "progress", ...ProcessingProgress}
+    - {"type": "page", "page_number": N}  该页解释已生成
+    空闲时定期重新发送当前进度，兼作心跳。
+    """
+    pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
+    if not pdf_doc:
+        raise HTTPException(404, "PDF 未找到")
+    snapshot = ProcessingProgress.from_document(pdf_doc)
+
+    async def current_progress():
+        # 事件总线只在进程内有效；任务可能在其他 worker 进程中运行，空闲时从数据库补发进度
+        async with AsyncSessionLocal() as session:
+            doc = await cache_service.get_pdf_metadata(session, pdf_id)
+        return {"type": "progress", **ProcessingProgress.from_document(doc).model_dump()} if doc else None
+
+    async def event_stream():
+        async with event_bus.subscribe(pdf_id) as queue:
+            yield sse_event({"type": "progress", **snapshot.model_dump()})
+            async for chunk in forward_events(queue, on_idle=current_progress):
+                yield chunk
+
+    return sse_response(event_stream())
 
 
 @app.get("/api/explain/{pdf_id}/{page_number}", response_model=PageExplanationMarkdown)
@@ -371,9 +434,63 @@ async def get_explanation(pdf_id: str, page_number: int, db: AsyncSession = Depe
     )
 
 
-@app.get("/api/download/{pdf_id}")
-async def download_markdown(pdf_id: str, db: AsyncSession = Depends(get_db)):
-    """下载完整的 Markdown 文件（包含页面截图）"""
+@app.get("/api/explain/{pdf_id}/{page_number}/stream")
+async def stream_explanation(pdf_id: str, page_number: int, db: AsyncSession = Depends(get_db)):
+    """
+    实时推送页面解释的生成过程（SSE）
+
+    - 已生成的页面：直接发送 done 事件
+    - 生成中的页面：先发送已生成的文本，再推送后续增量
+    - 尚未开始的页面：等待开始后推送
+    - 不在进行中任务里的页面（未选中、已失败或任务已结束）：发送 error
+    事件格式见 PageStream；收到 done 或 error 后连接结束。
+    """
+    pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
+    if not pdf_doc:
+        raise HTTPException(404, "PDF 未找到")
+
+    if not (1 <= page_number <= pdf_doc.total_pages):
+        raise HTTPException(400, f"页码无效，范围: 1-{pdf_doc.total_pages}")
+
+    async def current_state():
+        # 事件总线只在进程内有效：页面可能在其他 worker 进程中生成，任务也可能在
+        # 开始生成前就已结束。空闲时从数据库确认，先查任务状态再查缓存，避免漏掉刚完成的页面
+        if page_streams.get(pdf_id, page_number) is not None:
+            return None
+        async with AsyncSessionLocal() as session:
+            if await job_queue.is_page_pending(session, pdf_id, page_number):
+                return None
+            cached = await cache_service.get_cached_markdown_explanation(session, pdf_id, page_number)
+        if cached:
+            return {"type": "done", **cached.model_dump()}
+        return {"type": "error", "message": "该页没有进行中的生成任务"}
+
+    async def event_stream():
+        # 先订阅再检查状态，期间完成的页面事件会留在队列中，不会丢失
+        async with event_bus.subscribe(page_topic(pdf_id, page_number)) as queue:
+            live = page_streams.get(pdf_id, page_number)
+            if live is not None:
+                if live.text:
+                    # 先 reset：重连的客户端丢弃之前收到的部分文本，以快照为准
+                    yield sse_event({"type": "reset"})
+                    yield sse_event({"type": "delta", "text": live.text})
+            else:
+                async with AsyncSessionLocal() as session:
+                    cached = await cache_service.get_cached_markdown_explanation(
+                        session, pdf_id, page_number
+                    )
+                if cached:
+                    yield sse_event({"type": "done", **cached.model_dump()})
+                    return
+
+            async for chunk in forward_events(queue, until=("done", "error"), on_idle=current_state):
+                yield chunk
+
+    return sse_response(event_stream())
+
+
+async def load_export_data(db: AsyncSession, pdf_id: str):
+    """校验并加载导出所需的文档元数据和全部解释"""
     pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
     if not pdf_doc:
         raise HTTPException(404, "PDF 未找到")
@@ -387,74 +504,58 @@ async def download_markdown(pdf_id: str, db: AsyncSession = Depends(get_db)):
     if not explanations:
         raise HTTPException(404, "未找到任何解释内容")
 
-    # 生成 Markdown 内容
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    md_content = f"""# 课件讲解: {pdf_doc.filename}
+    return pdf_doc, explanations
 
-> 生成时间: {timestamp}
-> 总页数: {pdf_doc.total_pages}
 
----
+@app.get("/api/download/{pdf_id}")
+async def download_markdown(pdf_id: str, db: AsyncSession = Depends(get_db)):
+    """下载完整的 Markdown 文件（包含页面截图）"""
+    pdf_doc, explanations = await load_export_data(db, pdf_id)
 
-"""
+    # 生成文件名
+    filename = f"{Path(pdf_doc.filename).stem}_explained.md"
     
-    for explanation in explanations:
-        page_num = explanation.page_number
-        
-        # 获取页面图像并转为 base64
-        try:
-            page_image = await pdf_parser.parse_single_page(pdf_doc.file_path, page_num)
-            
-            # 转换为 base64
-            img_buffer = io.BytesIO()
-            page_image.save(img_buffer, format='PNG')
-            img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-            
-            md_content += f"""## 第 {page_num} 页
-
-![第{page_num}页](data:image/png;base64,{img_base64})
-
-{explanation.explanation_json}
-
----
-
-"""
-        except Exception as e:
-            print(f"⚠️ 获取第 {page_num} 页图像失败: {str(e)}")
-            md_content += f"""## 第 {page_num} 页
-
-{explanation.explanation_json}
+    # 逐页渲染并输出，首字节无需等待全部页面渲染完成
+    return StreamingResponse(
+        stream_markdown(pdf_doc, explanations),
+        media_type="text/markdown",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        }
+    )
 
----
 
-"""
-    
-    # 添加页脚
-    md_content += f"""
-## 文档说明
+@app.get("/api/download/{pdf_id}/zip")
+async def download_zip_bundle(pdf_id: str, db: AsyncSession = Depends(get_db)):
+    """下载 ZIP 包：explained.md + images/ 目录下的页面图片（相对路径引用）"""
+    pdf_doc, explanations = await load_export_data(db, pdf_id)
 
-- 本文档由 PDF 课件自动讲解系统生成
-- 每页内容包含课件截图和 AI 详细讲解
-- 建议结合原始课件一起学习
+    filename = f"{Path(pdf_doc.filename).stem}_explained.zip"
 
----
-*Generated by PPT Helper*
-"""
-    
-    # 生成文件名
-    filename = f"{Path(pdf_doc.filename).stem}_explained.md"
-    
-    # 返回文件流
     return StreamingResponse(
-        io.BytesIO(md_content.encode('utf-8')),
-        media_type="text/markdown",
+        stream_zip_bundle(pdf_doc, explanations),
+        media_type="application/zip",
         headers={
             "Content-Disposition": f'attachment; filename="{filename}"'
         }
     )
 
 
+@app.get("/api/stats")
+async def get_stats():
+    """运行状态统计（限流器桶状态等）"""
+    return {
+        "rate_limits": rate_limiter.snapshot(),
+        "page_image_cache": page_image_cache.stats(),
+        "db_cache": cache_service.stats(),
+        "event_bus": event_bus.stats(),
+        "page_streams": page_streams.stats(),
+        "jobs": job_worker.stats(),
+        "llm_pool": llm_pool.stats(),
+        "chat_sessions": chat_sessions.stats(),
+    }
+
+
 @app.get("/api/pdf/{pdf_id}/info")
 async def get_pdf_info(pdf_id: str, db: AsyncSession = Depends(get_db)):
     """获取 PDF 元数据"""
@@ -477,6 +578,8 @@ async def delete_page_cache(pdf_id: str, request: dict, db: AsyncSession = Depen
     """
     删除指定页面的缓存，以便重新分析
 
+    页面解释和渲染图像一起删除，重新分析时重新渲染。
+
     Request Body:
     {
         "page_numbers": [1, 2, 3]
@@ -497,6 +600,7 @@ async def delete_page_cache(pdf_id: str, request: dict, db: AsyncSession = Depen
 
     # 删除缓存
     deleted_count = await cache_service.delete_page_cache(db, pdf_id, page_numbers)
+    await asyncio.to_thread(page_image_cache.delete, pdf_id, page_numbers)
 
     return {
         "message": f"已清除 {deleted_count} 页缓存",
@@ -506,7 +610,9 @@ async def delete_page_cache(pdf_id: str, request: dict, db: AsyncSession = Depen
 
 
 @app.post("/api/chat/{pdf_id}")
-async def chat_with_ai(pdf_id: str, request: dict, db: AsyncSession = Depends(get_db)):
+async def chat_with_ai(
+    pdf_id: str, request: dict, http_request: Request, db: AsyncSession = Depends(get_db)
+):
     """
     与 AI 进行对话（流式响应）
 
@@ -514,10 +620,12 @@ async def chat_with_ai(pdf_id: str, request: dict, db: AsyncSession = Depends(ge
     {
         "question": "用户的问题",
         "page_number": 1,
-        "context": "当前页面的解释内容",
-        "history": [{"role": "user", "content": "..."}, ...],
+        "session_id": "上一轮返回的会话 ID（首轮省略）",
         "llm_config": {"api_key": "...", "model": "..."}
     }
+
+    对话历史保存在服务端，页面讲解从缓存中读取。
+    第一条事件为 {"session_id": ...}，客户端在下一轮带上。
     """
     # 验证 PDF 存在
     pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
@@ -530,8 +638,9 @@ async def chat_with_ai(pdf_id: str, request: dict, db: AsyncSession = Depends(ge
         raise HTTPException(400, "请提供问题")
 
     page_number = request.get("page_number", 1)
-    context = request.get("context", "")
-    history = request.get("history", [])
+    if not isinstance(page_number, int) or not 1 <= page_number <= pdf_doc.total_pages:
+        raise HTTPException(400, "页码超出范围")
+    session_id = request.get("session_id")
     llm_config = request.get("llm_config", None)
 
     # 验证 LLM 配置
@@ -548,34 +657,11 @@ async def chat_with_ai(pdf_id: str, request: dict, db: AsyncSession = Depends(ge
         model=model
     )
 
-    async def generate_stream():
-        """生成 SSE 流"""
-        try:
-            async for chunk in current_llm.chat_stream(
-                question=question,
-                context=context,
-                history=history,
-                page_number=page_number,
-            ):
-                # SSE 格式
-                yield f"data: {json.dumps({'content': chunk})}\n\n"
-
-            # 发送完成信号
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            print(f"❌ 聊天流生成错误: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            yield "data: [DONE]\n\n"
+    session = await chat_sessions.get_or_create(db, pdf_id, session_id)
+    turn = await chat_sessions.build_turn(db, session, page_number)
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",  # 禁用 nginx 缓冲
-        }
-    )
+    chunks = chat_sessions.stream_answer(current_llm, turn, question, page_number)
+    return sse_response(relay_chat(chunks, http_request, {"session_id": session.id}))
 
 
 if __name__ == "__main__":
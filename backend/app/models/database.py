@@ -1,5 +1,5 @@
 """Database models and session management."""
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, create_engine
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Index, create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from datetime import datetime
@@ -28,9 +28,13 @@ class PageExplanationCache(Base):
     """Caches AI-generated explanations to avoid redundant API calls."""
 
     __tablename__ = "page_explanations"
+    # 每页只保留一条解释；(pdf_id, page_number) 上的查询和范围扫描走该索引
+    __table_args__ = (
+        Index("uq_page_explanations_pdf_page", "pdf_id", "page_number", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    pdf_id = Column(String, nullable=False, index=True)
+    pdf_id = Column(String, nullable=False)
     page_number = Column(Integer, nullable=False)
     page_type = Column(String, default="CONTENT")
     explanation_json = Column(Text, nullable=False)  # Stored as JSON string (now Markdown)
@@ -38,6 +42,111 @@ class PageExplanationCache(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
+class ExplanationMemo(Base):
+    """Content-addressed explanations shared across documents.
+
+    The key hashes the page-number-free inputs of the generation request
+    (model, prompt template, page content, context summaries, sampling
+    settings), so identical slides in different uploads reuse one stored
+    answer. References to the request's own pages are stored as {{P0}}-style
+    placeholders and filled in on lookup. Rows least recently used are pruned
+    beyond settings.explanation_memo_max_entries.
+    """
+
+    __tablename__ = "explanation_memos"
+
+    key = Column(String, primary_key=True)  # sha256 hex
+    model = Column(String, nullable=False)
+    markdown = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)  # updated on every hit
+
+
+class ProcessingJob(Base):
+    """A persisted processing run; claimed by one worker at a time through a lease."""
+
+    __tablename__ = "processing_jobs"
+    __table_args__ = (
+        Index("ix_processing_jobs_status_created", "status", "created_at"),
+        # 每个 PDF 同时只能有一个未结束的任务（多进程并发提交时由数据库保证）
+        Index(
+            "uq_processing_jobs_active_pdf", "pdf_id", unique=True,
+            sqlite_where=text("status IN ('queued', 'running')"),
+            postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    id = Column(String, primary_key=True)  # uuid4 hex
+    pdf_id = Column(String, nullable=False)
+    page_numbers = Column(Text, nullable=False)  # JSON list of selected pages
+    model = Column(String, nullable=False)
+    # 使用客户端提供的 API Key：Key 不落库，只保存在提交任务的进程内存中，
+    # 该进程持有此任务的租约；进程退出后任务无法续跑，需客户端重新提交
+    needs_client_key = Column(Boolean, default=False)
+    max_concurrent_pages = Column(Integer, default=1)
+    pages_per_request = Column(Integer, default=1)  # 每次 LLM 请求分析的页数
+    # 任务状态: queued, running, completed, failed
+    status = Column(String, default="queued", nullable=False)
+    attempts = Column(Integer, default=0)  # 被认领的次数
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ProcessingJobPage(Base):
+    """Per-page state of a processing job."""
+
+    __tablename__ = "processing_job_pages"
+    __table_args__ = (
+        Index("uq_processing_job_pages_job_page", "job_id", "page_number", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, nullable=False)
+    page_number = Column(Integer, nullable=False)
+    # 页面状态: pending, running, done, failed
+    state = Column(String, default="pending", nullable=False)
+    attempts = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ChatSession(Base):
+    """A server-side chat conversation about one PDF.
+
+    Turns older than the history budget are folded into ``summary``;
+    ``summarized_until`` is the id of the last message already included in it.
+    """
+
+    __tablename__ = "chat_sessions"
+    __table_args__ = (
+        Index("ix_chat_sessions_updated", "updated_at"),
+    )
+
+    id = Column(String, primary_key=True)  # uuid4 hex
+    pdf_id = Column(String, nullable=False)
+    summary = Column(Text, default="")
+    summarized_until = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ChatMessage(Base):
+    """One message of a chat session."""
+
+    __tablename__ = "chat_messages"
+    __table_args__ = (
+        Index("ix_chat_messages_session", "session_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, nullable=False)
+    role = Column(String, nullable=False)  # user, assistant
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 # Async engine setup
 settings = get_settings()
 engine = create_async_engine(
@@ -54,9 +163,76 @@ AsyncSessionLocal = async_sessionmaker(
 
 
 async def init_db():
-    """Initialize database tables."""
+    """Initialize database tables and apply pending migrations."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_page_explanations_unique)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(scrub_job_api_keys)
+
+
+def migrate_page_explanations_unique(sync_conn):
+    """
+    Add the (pdf_id, page_number) unique index to existing databases.
+
+    create_all() does not add indexes to tables that already exist, and older
+    databases may hold duplicate rows per page; keep the newest row of each
+    page before creating the index. Skipped entirely once the index exists,
+    so startup does not scan the table every time.
+    """
+    indexes = {index["name"] for index in inspect(sync_conn).get_indexes("page_explanations")}
+    if "uq_page_explanations_pdf_page" in indexes:
+        return
+    sync_conn.execute(text(
+        "DELETE FROM page_explanations WHERE id NOT IN ("
+        "SELECT MAX(id) FROM page_explanations GROUP BY pdf_id, page_number)"
+    ))
+    sync_conn.execute(text(
+        "CREATE UNIQUE INDEX uq_page_explanations_pdf_page "
+        "ON page_explanations (pdf_id, page_number)"
+    ))
+
+
+def add_missing_columns(sync_conn):
+    """
+    Add columns introduced after a table was first created.
+
+    create_all() only creates missing tables; new nullable/defaulted columns
+    on existing tables are added here with ALTER TABLE ... ADD COLUMN.
+    """
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            default = ""
+            if column.default is not None and column.default.is_scalar:
+                default = f" DEFAULT {column.default.arg!r}"
+            sync_conn.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}"
+            ))
+
+
+def scrub_job_api_keys(sync_conn):
+    """
+    Remove API keys that older versions stored in processing_jobs.api_key.
+
+    Jobs that carried a client key are flagged as needing one, so they are
+    parked for re-submission instead of silently falling back to the
+    server's default key.
+    """
+    columns = {column["name"] for column in inspect(sync_conn).get_columns("processing_jobs")}
+    if "api_key" not in columns:
+        return
+    sync_conn.execute(text(
+        "UPDATE processing_jobs SET needs_client_key = :flag, api_key = NULL "
+        "WHERE api_key IS NOT NULL"
+    ), {"flag": True})
 
 
 async def get_db() -> AsyncSession:
@@ -74,3 +74,21 @@ class ProcessingProgress(BaseModel):
     processed_pages: int
     status: str  # pending, processing, completed, failed
     progress_percentage: float
+
+    @classmethod
+    def from_document(cls, pdf_doc) -> "ProcessingProgress":
+        """Build progress from a PDFDocument row."""
+        # 使用选定页数计算进度，如果没有选定则使用总页数
+        total_for_progress = (
+            pdf_doc.selected_pages_count if pdf_doc.selected_pages_count > 0 else pdf_doc.total_pages
+        )
+        progress_percentage = (
+            pdf_doc.processed_pages / total_for_progress * 100 if total_for_progress > 0 else 0
+        )
+        return cls(
+            pdf_id=pdf_doc.id,
+            total_pages=total_for_progress,  # 返回选定的页数
+            processed_pages=pdf_doc.processed_pages,
+            status=pdf_doc.processing_status or "pending",
+            progress_percentage=round(progress_percentage, 1),
+        )
@@ -1,15 +1,103 @@
 """Caching service to avoid redundant LLM calls."""
 import json
-from typing import List, Optional
-from sqlalchemy import select, update, delete
+import time
+from datetime import datetime
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.models.database import PageExplanationCache, PDFDocument
+from app.models.database import ExplanationMemo, PageExplanationCache, PDFDocument
 from app.models.schemas import PageExplanation, PageExplanationMarkdown
+from app.config import get_settings
+
+settings = get_settings()
+
+
+class ReadThroughCache:
+    """
+    Size-bounded LRU with a TTL, used in front of hot database lookups.
+
+    Entries are invalidated explicitly on write; the TTL only bounds staleness
+    for writes made by other processes. A generation counter keeps a reader
+    that raced with a writer from storing the value it read before the write.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        """Store a value read while the cache was at `generation`."""
+        if generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        self.generation += 1
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def explanation_cache_ttl() -> float:
+    """
+    TTL for cached page explanations.
+
+    With a single process every write invalidates the cache, so entries can live
+    long. With several workers a page regenerated or deleted elsewhere is only
+    noticed when the entry expires, so the TTL drops to a few seconds.
+    """
+    if settings.web_concurrency > 1:
+        return min(settings.explanation_cache_ttl, settings.explanation_cache_shared_ttl)
+    return settings.explanation_cache_ttl
+
+
+def _detached_copy(pdf_doc: PDFDocument) -> PDFDocument:
+    """Copy a row into a transient object that is never bound to a session."""
+    return PDFDocument(**{
+        column.name: getattr(pdf_doc, column.name) for column in PDFDocument.__table__.columns
+    })
 
 
 class CacheService:
     """Handles reading/writing explanation cache."""
 
+    # In-process read-through caches for /api/progress and /api/explain lookups
+    _pdf_cache = ReadThroughCache(settings.metadata_cache_size, settings.metadata_cache_ttl)
+    _explanation_cache = ReadThroughCache(settings.explanation_cache_size, explanation_cache_ttl())
+    # Content-addressed memo counters (the memo itself lives in the database)
+    _memo_hits = 0
+    _memo_misses = 0
+
     @staticmethod
     async def get_cached_explanation(
         db: AsyncSession, pdf_id: str, page_number: int
@@ -40,7 +128,15 @@ class CacheService:
     ) -> PageExplanationMarkdown | None:
         """
         Retrieve cached Markdown explanation for a specific page.
+
+        Completed explanations are served from memory after the first read.
         """
+        key = (pdf_id, page_number)
+        cached = CacheService._explanation_cache.get(key)
+        if cached is not None:
+            return cached
+
+        generation = CacheService._explanation_cache.generation
         stmt = select(PageExplanationCache).where(
             PageExplanationCache.pdf_id == pdf_id,
             PageExplanationCache.page_number == page_number,
@@ -49,14 +145,38 @@ class CacheService:
         cache_entry = result.scalar_one_or_none()
 
         if cache_entry:
-            return PageExplanationMarkdown(
+            explanation = PageExplanationMarkdown(
                 page_number=page_number,
                 markdown_content=cache_entry.explanation_json,
                 summary=cache_entry.summary or ""
             )
+            CacheService._explanation_cache.put(key, explanation, generation)
+            return explanation
 
         return None
 
+    @staticmethod
+    async def _upsert_page_explanation(db: AsyncSession, **values):
+        """
+        Insert a page explanation, replacing any existing row for the same page.
+
+        Uses INSERT ... ON CONFLICT (pdf_id, page_number) DO UPDATE so concurrent
+        or repeated runs never create duplicate rows.
+        """
+        dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+        stmt = dialect_insert(PageExplanationCache).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PageExplanationCache.pdf_id, PageExplanationCache.page_number],
+            set_={
+                key: stmt.excluded[key]
+                for key in values
+                if key not in ("pdf_id", "page_number")
+            },
+        )
+        await db.execute(stmt)
+        await db.commit()
+        CacheService._explanation_cache.invalidate((values["pdf_id"], values["page_number"]))
+
     @staticmethod
     async def save_explanation(
         db: AsyncSession, pdf_id: str, page_number: int, explanation: PageExplanation
@@ -65,66 +185,43 @@ class CacheService:
         # Serialize Pydantic model to JSON
         explanation_json = explanation.model_dump_json()
 
-        cache_entry = PageExplanationCache(
+        await CacheService._upsert_page_explanation(
+            db,
             pdf_id=pdf_id,
             page_number=page_number,
             page_type=explanation.page_type,
             explanation_json=explanation_json,
         )
 
-        db.add(cache_entry)
-        await db.commit()
-
     @staticmethod
     async def save_markdown_explanation(
         db: AsyncSession, pdf_id: str, page_number: int, 
-        markdown_content: str, summary: str
+        markdown_content: str, summary: str, page_type: str = "CONTENT"
     ):
         """Save Markdown explanation to cache."""
-        cache_entry = PageExplanationCache(
+        await CacheService._upsert_page_explanation(
+            db,
             pdf_id=pdf_id,
             page_number=page_number,
-            page_type="CONTENT",
+            page_type=page_type,
             explanation_json=markdown_content,
             summary=summary,
         )
 
-        db.add(cache_entry)
-        await db.commit()
-
     @staticmethod
-    async def get_previous_summaries(
-        db: AsyncSession, pdf_id: str, current_page: int, max_pages: int = 3
-    ) -> List[str]:
+    async def get_page_summaries(db: AsyncSession, pdf_id: str) -> Dict[int, str]:
         """
-        Get summaries from previous pages for context.
-        
-        Args:
-            db: Database session
-            pdf_id: PDF identifier
-            current_page: Current page number
-            max_pages: Maximum number of previous pages to include
-            
+        Load the summaries of every cached page of a PDF in one query.
+
         Returns:
-            List of summary strings
+            Mapping of page number to summary ("" if the page has none);
+            the keys are exactly the pages that already have an explanation.
         """
-        start_page = max(1, current_page - max_pages)
-        
-        stmt = select(PageExplanationCache).where(
-            PageExplanationCache.pdf_id == pdf_id,
-            PageExplanationCache.page_number >= start_page,
-            PageExplanationCache.page_number < current_page,
-        ).order_by(PageExplanationCache.page_number)
-        
+        stmt = select(PageExplanationCache.page_number, PageExplanationCache.summary).where(
+            PageExplanationCache.pdf_id == pdf_id
+        )
         result = await db.execute(stmt)
-        cache_entries = result.scalars().all()
-        
-        summaries = []
-        for entry in cache_entries:
-            if entry.summary:
-                summaries.append(entry.summary)
-        
-        return summaries
+        return {page_number: summary or "" for page_number, summary in result.all()}
 
     @staticmethod
     async def get_all_explanations(
@@ -140,10 +237,22 @@ class CacheService:
 
     @staticmethod
     async def get_pdf_metadata(db: AsyncSession, pdf_id: str) -> PDFDocument | None:
-        """Get PDF document metadata."""
+        """
+        Get PDF document metadata.
+
+        Hits return a detached copy of the row; treat it as read-only.
+        """
+        cached = CacheService._pdf_cache.get(pdf_id)
+        if cached is not None:
+            return cached
+
+        generation = CacheService._pdf_cache.generation
         stmt = select(PDFDocument).where(PDFDocument.id == pdf_id)
         result = await db.execute(stmt)
-        return result.scalar_one_or_none()
+        pdf_doc = result.scalar_one_or_none()
+        if pdf_doc is not None:
+            CacheService._pdf_cache.put(pdf_id, _detached_copy(pdf_doc), generation)
+        return pdf_doc
 
     @staticmethod
     async def save_pdf_metadata(
@@ -180,18 +289,36 @@ class CacheService:
             )
             db.add(pdf_doc)
         await db.commit()
+        CacheService._pdf_cache.invalidate(pdf_id)
 
     @staticmethod
     async def update_processing_status(
-        db: AsyncSession, pdf_id: str, status: str, processed_pages: int
+        db: AsyncSession,
+        pdf_id: str,
+        status: str,
+        processed_pages: int,
+        selected_pages_count: Optional[int] = None,
     ):
-        """Update PDF processing status."""
+        """Update PDF processing status (and the progress total, when given)."""
+        values = {"processing_status": status, "processed_pages": processed_pages}
+        if selected_pages_count is not None:
+            values["selected_pages_count"] = selected_pages_count
+        stmt = update(PDFDocument).where(PDFDocument.id == pdf_id).values(**values)
+        await db.execute(stmt)
+        await db.commit()
+        CacheService._pdf_cache.invalidate(pdf_id)
+
+    @staticmethod
+    async def reset_processing(db: AsyncSession, pdf_id: str, selected_pages_count: int):
+        """Reset progress before a new processing run over the selected pages."""
         stmt = update(PDFDocument).where(PDFDocument.id == pdf_id).values(
-            processing_status=status,
-            processed_pages=processed_pages
+            selected_pages_count=selected_pages_count,
+            processed_pages=0,
+            processing_status="pending"
         )
         await db.execute(stmt)
         await db.commit()
+        CacheService._pdf_cache.invalidate(pdf_id)
 
     @staticmethod
     async def check_pdf_exists(db: AsyncSession, pdf_id: str) -> bool:
@@ -221,7 +348,74 @@ class CacheService:
         )
         result = await db.execute(stmt)
         await db.commit()
+        CacheService._explanation_cache.invalidate(
+            *((pdf_id, page_number) for page_number in page_numbers)
+        )
+        return result.rowcount
+
+    @staticmethod
+    async def get_memoized_explanation(db: AsyncSession, memo_key: str) -> Optional[str]:
+        """Look up a content-addressed explanation; returns None on a miss."""
+        markdown = await db.scalar(
+            select(ExplanationMemo.markdown).where(ExplanationMemo.key == memo_key)
+        )
+        if markdown is None:
+            CacheService._memo_misses += 1
+            return None
+        CacheService._memo_hits += 1
+        # Hits keep the entry out of the next prune
+        await db.execute(
+            update(ExplanationMemo)
+            .where(ExplanationMemo.key == memo_key)
+            .values(last_used_at=datetime.utcnow())
+        )
+        await db.commit()
+        return markdown
+
+    @staticmethod
+    async def save_memoized_explanation(
+        db: AsyncSession, memo_key: str, model: str, markdown: str
+    ):
+        """Store a generated explanation under its content key (first write wins)."""
+        dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+        stmt = dialect_insert(ExplanationMemo).values(
+            key=memo_key, model=model, markdown=markdown
+        ).on_conflict_do_nothing(index_elements=[ExplanationMemo.key])
+        await db.execute(stmt)
+        await db.commit()
+
+    @staticmethod
+    async def prune_memoized_explanations(db: AsyncSession, max_entries: int) -> int:
+        """
+        Keep only the max_entries most recently used memo rows.
+
+        Returns:
+            Number of deleted rows
+        """
+        last_used = func.coalesce(ExplanationMemo.last_used_at, ExplanationMemo.created_at)
+        stale = (
+            select(ExplanationMemo.key)
+            .order_by(last_used.desc())
+            .offset(max_entries)
+            .scalar_subquery()
+        )
+        result = await db.execute(delete(ExplanationMemo).where(ExplanationMemo.key.in_(stale)))
+        await db.commit()
         return result.rowcount
 
+    @staticmethod
+    def stats() -> dict:
+        """Hit/miss counters of the in-process read-through caches."""
+        lookups = CacheService._memo_hits + CacheService._memo_misses
+        return {
+            "pdf_metadata": CacheService._pdf_cache.stats(),
+            "explanations": CacheService._explanation_cache.stats(),
+            "explanation_memo": {
+                "hits": CacheService._memo_hits,
+                "misses": CacheService._memo_misses,
+                "hit_rate": round(CacheService._memo_hits / lookups, 3) if lookups else 0.0,
+            },
+        }
+
 
 cache_service = CacheService()
@@ -0,0 +1,250 @@
+"""聊天会话 - 对话历史保存在服务端，按 token 预算裁剪，较早的轮次压缩为摘要"""
+import asyncio
+import hashlib
+import json
+import re
+import unicodedata
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import AsyncGenerator, List, Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.models.database import AsyncSessionLocal, ChatMessage, ChatSession
+from app.services.cache_service import ReadThroughCache, cache_service
+from app.services.llm_service import GeminiService, estimate_input_tokens
+
+settings = get_settings()
+
+
+@dataclass
+class ChatTurn:
+    """一轮对话需要的上下文（均由服务端解析）"""
+    session_id: str
+    pdf_id: str
+    context: str
+    summary: str
+    history: List[dict]
+    # 超出预算、尚未并入摘要的较早消息
+    overflow: List[ChatMessage] = field(default_factory=list)
+
+
+def normalize_question(question: str) -> str:
+    """问题归一化：全半角、大小写、空白和句末标点不同的问题视为同一问题"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?？。.!！~～ ")
+
+
+def answer_cache_key(
+    pdf_id: str, page_number: int, question: str, turn: ChatTurn, model: str
+) -> tuple:
+    """
+    回答缓存键
+
+    指纹覆盖本轮发给模型的全部上下文（页面讲解、摘要、历史），
+    页面重新生成讲解或对话走向不同都会得到不同的键。
+    """
+    fingerprint = hashlib.sha256(
+        json.dumps([turn.context, turn.summary, turn.history], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    return (pdf_id, page_number, normalize_question(question), fingerprint, model)
+
+
+def split_history(messages: List[ChatMessage], budget: int) -> tuple[List[ChatMessage], List[ChatMessage]]:
+    """
+    从最新的消息往前保留，直到超出 token 预算
+
+    保留部分总是从用户消息开始，避免历史以助手回复开头。
+
+    Returns:
+        (超出预算的较早消息, 保留的消息)
+    """
+    used = 0
+    cut = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        used += estimate_input_tokens(messages[index].content)
+        if used > budget:
+            break
+        cut = index
+    while cut < len(messages) and messages[cut].role != "user":
+        cut += 1
+    return messages[:cut], messages[cut:]
+
+
+class ChatSessionService:
+    """
+    服务端聊天会话
+
+    客户端每轮只发送新问题；页面讲解从 page_explanations 读取，历史按预算裁剪。
+    超出预算的轮次在回答结束后于后台并入摘要，不增加本轮延迟。
+    """
+
+    def __init__(
+        self, history_budget: int, ttl_hours: int, answer_cache_size: int, answer_cache_ttl: float
+    ):
+        self.history_budget = history_budget
+        self.ttl = timedelta(hours=ttl_hours)
+        # 重复问题的回答缓存（按生成时的分块保存，命中时原样回放）；容量为 0 时关闭
+        self.answers = ReadThroughCache(answer_cache_size, answer_cache_ttl) if answer_cache_size else None
+        self._compacting: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    async def get_or_create(db: AsyncSession, pdf_id: str, session_id: Optional[str]) -> ChatSession:
+        """
+        取已有会话；不存在（或已过期删除、属于其他 PDF）时新建
+
+        新会话不在此写入数据库，首轮回答完整结束后由 record_turn 与消息一起写入，
+        生成失败或客户端中途断开不会留下空会话。
+        """
+        if session_id:
+            session = await db.get(ChatSession, session_id)
+            if session is not None and session.pdf_id == pdf_id:
+                return session
+        return ChatSession(id=uuid.uuid4().hex, pdf_id=pdf_id, summary="", summarized_until=0)
+
+    async def build_turn(self, db: AsyncSession, session: ChatSession, page_number: int) -> ChatTurn:
+        """解析页面讲解并按预算选取历史"""
+        explanation = await cache_service.get_cached_markdown_explanation(db, session.pdf_id, page_number)
+
+        stmt = select(ChatMessage).where(
+            ChatMessage.session_id == session.id,
+            ChatMessage.id > (session.summarized_until or 0),
+        ).order_by(ChatMessage.id)
+        messages = list((await db.execute(stmt)).scalars().all())
+        overflow, kept = split_history(messages, self.history_budget)
+
+        return ChatTurn(
+            session_id=session.id,
+            pdf_id=session.pdf_id,
+            context=explanation.markdown_content if explanation else "",
+            summary=session.summary or "",
+            history=[{"role": msg.role, "content": msg.content} for msg in kept],
+            overflow=overflow,
+        )
+
+    async def stream_answer(
+        self, llm: GeminiService, turn: ChatTurn, question: str, page_number: int
+    ) -> AsyncGenerator[str, None]:
+        """
+        流式生成回答，完整结束后保存本轮对话
+
+        相同页面、相同上下文下的相同问题直接回放缓存的回答。
+        中途取消（客户端断开）或出错时不保存，会话保持上一轮的状态。
+        """
+        cache_key = None
+        cached = None
+        if self.answers is not None:
+            cache_key = answer_cache_key(turn.pdf_id, page_number, question, turn, llm._model_name or "")
+            cached = self.answers.get(cache_key)
+
+        parts: List[str] = []
+        if cached is not None:
+            print(f"♻️ 第 {page_number} 页：命中聊天回答缓存")
+            for chunk in cached:
+                parts.append(chunk)
+                yield chunk
+        else:
+            generation = self.answers.generation if self.answers is not None else 0
+            async for chunk in llm.chat_stream(
+                question=question,
+                context=turn.context,
+                history=turn.history,
+                page_number=page_number,
+                summary=turn.summary,
+            ):
+                parts.append(chunk)
+                yield chunk
+            if cache_key is not None and parts:
+                self.answers.put(cache_key, tuple(parts), generation)
+
+        await self.record_turn(turn.session_id, turn.pdf_id, question, "".join(parts))
+        if turn.overflow:
+            self._schedule_compaction(llm, turn.session_id)
+
+    @staticmethod
+    async def record_turn(session_id: str, pdf_id: str, question: str, answer: str):
+        """保存一轮对话；会话尚未写入（首轮）或已被清理时在同一事务中创建"""
+        async with AsyncSessionLocal() as db:
+            if await db.get(ChatSession, session_id) is None:
+                db.add(ChatSession(id=session_id, pdf_id=pdf_id, summary="", summarized_until=0))
+            db.add_all([
+                ChatMessage(session_id=session_id, role="user", content=question),
+                ChatMessage(session_id=session_id, role="assistant", content=answer),
+            ])
+            await db.execute(
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                .values(updated_at=datetime.utcnow())
+            )
+            await db.commit()
+
+    def _schedule_compaction(self, llm: GeminiService, session_id: str):
+        # 同一会话同时只进行一次压缩
+        if session_id in self._compacting:
+            return
+        self._compacting.add(session_id)
+        task = asyncio.create_task(self._compact(llm, session_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, llm: GeminiService, session_id: str):
+        """把超出预算的较早消息并入会话摘要；失败时保持原样，下轮仍按预算裁剪"""
+        try:
+            async with AsyncSessionLocal() as db:
+                session = await db.get(ChatSession, session_id)
+                if session is None:
+                    return
+                stmt = select(ChatMessage).where(
+                    ChatMessage.session_id == session_id,
+                    ChatMessage.id > (session.summarized_until or 0),
+                ).order_by(ChatMessage.id)
+                messages = list((await db.execute(stmt)).scalars().all())
+                overflow, _ = split_history(messages, self.history_budget)
+                if not overflow:
+                    return
+
+                summary = await llm.summarize_conversation(
+                    session.summary or "",
+                    [{"role": msg.role, "content": msg.content} for msg in overflow],
+                )
+                await db.execute(
+                    update(ChatSession)
+                    .where(ChatSession.id == session_id)
+                    .values(summary=summary, summarized_until=overflow[-1].id)
+                )
+                await db.commit()
+                print(f"🗜️ 会话 {session_id[:8]}：{len(overflow)} 条较早消息已并入摘要")
+        except Exception as e:
+            print(f"⚠️ 会话 {session_id[:8]} 摘要失败: {str(e)}")
+        finally:
+            self._compacting.discard(session_id)
+
+    async def purge_idle(self) -> int:
+        """删除闲置超过 TTL 的会话及其消息"""
+        cutoff = datetime.utcnow() - self.ttl
+        async with AsyncSessionLocal() as db:
+            stale = select(ChatSession.id).where(ChatSession.updated_at < cutoff)
+            await db.execute(delete(ChatMessage).where(ChatMessage.session_id.in_(stale)))
+            result = await db.execute(delete(ChatSession).where(ChatSession.updated_at < cutoff))
+            await db.commit()
+            return result.rowcount or 0
+
+    def stats(self) -> dict:
+        return {
+            "compacting": len(self._compacting),
+            "answer_cache": self.answers.stats() if self.answers is not None else None,
+        }
+
+
+# 全局单例
+chat_sessions = ChatSessionService(
+    history_budget=settings.chat_history_token_budget,
+    ttl_hours=settings.chat_session_ttl_hours,
+    answer_cache_size=settings.chat_answer_cache_size,
+    answer_cache_ttl=settings.chat_answer_cache_ttl,
+)
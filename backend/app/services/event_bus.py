@@ -0,0 +1,68 @@
+"""进程内事件总线 - 按 pdf_id 向订阅者推送处理进度和页面完成事件"""
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Set
+
+# 订阅者被移除前收到的最后一个事件：积压已丢弃，需要重新获取快照
+OVERFLOW_EVENT = {"type": "overflow"}
+
+
+class EventBus:
+    """
+    简单的发布/订阅
+
+    每个订阅者持有一个有界队列；publish 不会阻塞发布者。
+    订阅者消费过慢导致队列满时，丢弃它的全部积压、放入一条 overflow 事件并取消订阅：
+    中间丢事件会让增量文本错乱，订阅者应结束连接，由客户端重连后重新获取快照。
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self.overflows = 0
+
+    def publish(self, topic: str, event: dict):
+        """向 topic 的所有订阅者推送事件"""
+        subscribers = self._subscribers.get(topic)
+        if not subscribers:
+            return
+        for queue in list(subscribers):
+            if not queue.full():
+                queue.put_nowait(event)
+                continue
+            subscribers.discard(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(OVERFLOW_EVENT)
+            self.overflows += 1
+        if not subscribers:
+            del self._subscribers[topic]
+
+    @asynccontextmanager
+    async def subscribe(self, topic: str) -> AsyncIterator[asyncio.Queue]:
+        """订阅 topic，退出上下文时自动取消订阅"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[topic].add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._subscribers.get(topic, ()))
+
+    def stats(self) -> dict:
+        return {
+            "topics": len(self._subscribers),
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "overflows": self.overflows,
+        }
+
+
+# 全局单例
+event_bus = EventBus()
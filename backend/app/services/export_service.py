@@ -0,0 +1,151 @@
+"""讲解文档导出服务 - 逐页渲染、流式输出"""
+import base64
+import zipfile
+from datetime import datetime
+from typing import AsyncIterator, List
+
+from app.config import get_settings
+from app.models.database import PDFDocument, PageExplanationCache
+from app.services.pdf_parser import pdf_parser
+
+settings = get_settings()
+
+
+def markdown_header(pdf_doc: PDFDocument) -> str:
+    """文档头部"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return f"""# 课件讲解: {pdf_doc.filename}
+
+> 生成时间: {timestamp}
+> 总页数: {pdf_doc.total_pages}
+
+---
+
+"""
+
+
+def markdown_page_section(page_num: int, explanation: str, image_ref: str = "") -> str:
+    """单页内容：可选的页面截图 + AI 讲解"""
+    image_line = f"![第{page_num}页]({image_ref})\n\n" if image_ref else ""
+    return f"""## 第 {page_num} 页
+
+{image_line}{explanation}
+
+---
+
+"""
+
+
+def markdown_footer() -> str:
+    """文档页脚"""
+    return """
+## 文档说明
+
+- 本文档由 PDF 课件自动讲解系统生成
+- 每页内容包含课件截图和 AI 详细讲解
+- 建议结合原始课件一起学习
+
+---
+*Generated by PPT Helper*
+"""
+
+
+async def stream_markdown(
+    pdf_doc: PDFDocument, explanations: List[PageExplanationCache]
+) -> AsyncIterator[bytes]:
+    """
+    流式生成完整的 Markdown 文档（页面截图以 base64 内联）
+
+    头部立即发出，之后每渲染完一页就输出一页；渲染并行提前
+    export_render_ahead 页，内存占用与文档页数无关。
+    """
+    yield markdown_header(pdf_doc).encode("utf-8")
+
+    explanation_by_page = {e.page_number: e.explanation_json for e in explanations}
+    async for page_num, page_image in pdf_parser.iter_pages(
+        pdf_doc.file_path,
+        list(explanation_by_page.keys()),
+        pdf_doc.id,
+        ahead=settings.export_render_ahead,
+    ):
+        image_ref = ""
+        if isinstance(page_image, Exception):
+            print(f"⚠️ 获取第 {page_num} 页图像失败: {str(page_image)}")
+        else:
+            img_base64 = base64.b64encode(page_image.data).decode("utf-8")
+            image_ref = f"data:{page_image.mime_type};base64,{img_base64}"
+
+        yield markdown_page_section(page_num, explanation_by_page[page_num], image_ref).encode("utf-8")
+
+    yield markdown_footer().encode("utf-8")
+
+
+class _ZipStreamBuffer:
+    """zipfile 的只写输出目标：暂存写入的字节，由生成器分批取走"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_info(name: str, compress_type: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+async def stream_zip_bundle(
+    pdf_doc: PDFDocument, explanations: List[PageExplanationCache]
+) -> AsyncIterator[bytes]:
+    """
+    流式生成 ZIP 包：explained.md + images/page-NNN.<格式>
+
+    图片作为独立文件按相对路径引用，不再 base64 内联。图片已是压缩格式，
+    以 ZIP_STORED 存储；Markdown 以 ZIP_DEFLATED 压缩。输出目标不可 seek，
+    zipfile 会为每个条目写数据描述符，每写完一个条目即可发送。
+    """
+    fmt = settings.export_image_format
+    extension = "jpg" if fmt == "jpeg" else fmt
+    buffer = _ZipStreamBuffer()
+    explanation_by_page = {e.page_number: e.explanation_json for e in explanations}
+    image_paths = {}
+
+    with zipfile.ZipFile(buffer, mode="w") as archive:
+        # 先写入图片（优先读取页面图像缓存），记录成功的页面
+        async for page_num, page_image in pdf_parser.iter_pages(
+            pdf_doc.file_path,
+            list(explanation_by_page.keys()),
+            pdf_doc.id,
+            fmt=fmt,
+            ahead=settings.export_render_ahead,
+        ):
+            if isinstance(page_image, Exception):
+                print(f"⚠️ 获取第 {page_num} 页图像失败: {str(page_image)}")
+                continue
+            image_path = f"images/page-{page_num:03d}.{extension}"
+            archive.writestr(_zip_info(image_path, zipfile.ZIP_STORED), page_image.data)
+            image_paths[page_num] = image_path
+            yield buffer.drain()
+
+        # 再逐页写入 Markdown
+        with archive.open(_zip_info("explained.md", zipfile.ZIP_DEFLATED), mode="w") as markdown:
+            markdown.write(markdown_header(pdf_doc).encode("utf-8"))
+            for page_num, explanation in explanation_by_page.items():
+                section = markdown_page_section(page_num, explanation, image_paths.get(page_num, ""))
+                markdown.write(section.encode("utf-8"))
+                yield buffer.drain()
+            markdown.write(markdown_footer().encode("utf-8"))
+
+    # 关闭 archive 后写出中央目录
+    yield buffer.drain()
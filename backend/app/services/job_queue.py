@@ -0,0 +1,330 @@
+"""持久化任务队列 - 任务与逐页状态存放在数据库中，通过租约在多个进程间认领"""
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.models.database import AsyncSessionLocal, ProcessingJob, ProcessingJobPage
+from app.services.cache_service import cache_service
+
+settings = get_settings()
+
+# 未结束的任务状态；每个 PDF 同时最多一个
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+# 客户端 Key 只在内存中，持有进程退出后任务无法续跑
+PARKED_ERROR = "API Key 不会保存到服务器，处理进程重启后请重新提交任务"
+
+
+def _claimable(now: datetime):
+    """排队中的任务，或租约已过期（持有进程已退出）的运行中任务"""
+    return or_(
+        ProcessingJob.status == "queued",
+        and_(ProcessingJob.status == "running", ProcessingJob.lease_expires_at < now),
+    )
+
+
+class JobQueue:
+    """
+    数据库任务队列
+
+    认领使用条件更新（compare-and-swap）：只有仍处于可认领状态的行会被更新，
+    多个进程同时认领同一任务时只有一个成功，不依赖数据库的行锁语法。
+
+    使用客户端 API Key 的任务：Key 只保存在提交进程的内存中，该进程从入队起
+    就持有任务租约（排队期间也续约），其他进程不会认领。持有进程退出后
+    租约过期，任务被标记为失败，客户端重新提交 Key 即可继续（已完成的页面走缓存）。
+    """
+
+    def __init__(self, lease_seconds: int):
+        self.lease = timedelta(seconds=lease_seconds)
+        self._keys: Dict[str, str] = {}  # job_id -> 客户端 API Key（仅本进程）
+
+    def api_key(self, job_id: str) -> Optional[str]:
+        """本进程持有的任务 API Key"""
+        return self._keys.get(job_id)
+
+    @staticmethod
+    async def get_active_job(db: AsyncSession, pdf_id: str) -> Optional[ProcessingJob]:
+        """PDF 当前未结束的任务"""
+        stmt = select(ProcessingJob).where(
+            ProcessingJob.pdf_id == pdf_id,
+            ProcessingJob.status.in_(ACTIVE_JOB_STATUSES),
+        )
+        result = await db.execute(stmt)
+        return result.scalars().first()
+
+    @staticmethod
+    async def is_page_pending(db: AsyncSession, pdf_id: str, page_number: int) -> bool:
+        """页面是否仍在未结束的任务中等待或正在生成"""
+        stmt = (
+            select(ProcessingJobPage.state)
+            .join(ProcessingJob, ProcessingJob.id == ProcessingJobPage.job_id)
+            .where(
+                ProcessingJob.pdf_id == pdf_id,
+                ProcessingJob.status.in_(ACTIVE_JOB_STATUSES),
+                ProcessingJobPage.page_number == page_number,
+            )
+        )
+        state = (await db.execute(stmt)).scalars().first()
+        return state in ("pending", "running")
+
+    async def enqueue(
+        self,
+        db: AsyncSession,
+        pdf_id: str,
+        page_numbers: List[int],
+        model: str,
+        api_key: Optional[str],
+        max_concurrent_pages: int,
+        pages_per_request: int = 1,
+        worker_id: Optional[str] = None,
+    ) -> ProcessingJob:
+        """
+        创建任务并重置文档进度（同一事务）
+
+        Args:
+            api_key: 用户提供的 API Key；使用服务器默认 Key 时传 None。Key 不落库
+            worker_id: 本进程任务执行器的 ID；提供 api_key 时必填，任务只由它运行
+
+        Raises:
+            ValueError: 该 PDF 已有未结束的任务
+        """
+        if api_key and not worker_id:
+            raise ValueError("使用客户端 API Key 的任务需要指定执行进程")
+        pages = sorted(set(page_numbers))
+        job = ProcessingJob(
+            id=uuid.uuid4().hex,
+            pdf_id=pdf_id,
+            page_numbers=json.dumps(pages),
+            model=model,
+            needs_client_key=bool(api_key),
+            max_concurrent_pages=max_concurrent_pages,
+            pages_per_request=pages_per_request,
+            status="queued",
+        )
+        if api_key:
+            # 排队期间由本进程持有租约，其他进程不会认领
+            job.lease_owner = worker_id
+            job.lease_expires_at = datetime.utcnow() + self.lease
+        db.add(job)
+        db.add_all(ProcessingJobPage(job_id=job.id, page_number=p) for p in pages)
+        try:
+            # reset_processing 负责提交，任务行与进度重置一起生效
+            await cache_service.reset_processing(db, pdf_id, len(pages))
+        except IntegrityError:
+            await db.rollback()
+            raise ValueError("该 PDF 正在处理中")
+        if api_key:
+            self._keys[job.id] = api_key
+        return job
+
+    async def claim(self, worker_id: str) -> Optional[ProcessingJob]:
+        """认领一个任务并取得租约，没有可认领的任务时返回 None"""
+        now = datetime.utcnow()
+        # 需要客户端 Key 的任务只能由持有 Key 的进程认领
+        runnable = or_(
+            ProcessingJob.needs_client_key.isnot(True),
+            and_(
+                ProcessingJob.lease_owner == worker_id,
+                ProcessingJob.id.in_(list(self._keys)),
+            ),
+        )
+        async with AsyncSessionLocal() as db:
+            stmt = (
+                select(ProcessingJob.id)
+                .where(_claimable(now), runnable)
+                .order_by(ProcessingJob.created_at)
+                .limit(5)
+            )
+            candidates = (await db.execute(stmt)).scalars().all()
+
+            for job_id in candidates:
+                result = await db.execute(
+                    update(ProcessingJob)
+                    .where(ProcessingJob.id == job_id, _claimable(now), runnable)
+                    .values(
+                        status="running",
+                        lease_owner=worker_id,
+                        lease_expires_at=now + self.lease,
+                        attempts=ProcessingJob.attempts + 1,
+                        updated_at=now,
+                    )
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    return await db.get(ProcessingJob, job_id)
+        return None
+
+    async def renew(self, job_id: str, worker_id: str) -> bool:
+        """续约；返回 False 表示租约已被其他进程取得"""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(ProcessingJob)
+                .where(
+                    ProcessingJob.id == job_id,
+                    ProcessingJob.lease_owner == worker_id,
+                    ProcessingJob.status == "running",
+                )
+                .values(lease_expires_at=now + self.lease, updated_at=now)
+            )
+            await db.commit()
+            return result.rowcount == 1
+
+    async def renew_held(self, worker_id: str):
+        """为本进程持有 Key、仍在排队的任务续约（运行中的任务由执行器续约）"""
+        if not self._keys:
+            return
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ProcessingJob)
+                .where(
+                    ProcessingJob.id.in_(list(self._keys)),
+                    ProcessingJob.lease_owner == worker_id,
+                    ProcessingJob.status == "queued",
+                )
+                .values(lease_expires_at=now + self.lease)
+            )
+            await db.commit()
+
+    async def park_orphaned(self) -> List[Tuple[str, str]]:
+        """
+        将持有进程已退出的客户端 Key 任务标记为失败
+
+        Returns:
+            [(job_id, pdf_id)]，调用方据此更新文档状态
+        """
+        now = datetime.utcnow()
+        orphaned = and_(
+            ProcessingJob.needs_client_key.is_(True),
+            ProcessingJob.status.in_(ACTIVE_JOB_STATUSES),
+            or_(ProcessingJob.lease_expires_at.is_(None), ProcessingJob.lease_expires_at < now),
+            ProcessingJob.id.notin_(list(self._keys)),
+        )
+        parked = []
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(ProcessingJob.id, ProcessingJob.pdf_id).where(orphaned)
+            )).all()
+            for job_id, pdf_id in rows:
+                result = await db.execute(
+                    update(ProcessingJob)
+                    .where(ProcessingJob.id == job_id, orphaned)
+                    .values(
+                        status="failed",
+                        error=PARKED_ERROR,
+                        lease_owner=None,
+                        lease_expires_at=None,
+                        updated_at=now,
+                    )
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    parked.append((job_id, pdf_id))
+        return parked
+
+    async def release(self, job_id: str, worker_id: str):
+        """
+        主动交还租约（进程正常关闭），任务可立即被重新认领
+
+        客户端 Key 任务的 Key 随进程退出而丢失，交还后由其他进程标记为失败。
+        """
+        self._keys.pop(job_id, None)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ProcessingJob)
+                .where(ProcessingJob.id == job_id, ProcessingJob.lease_owner == worker_id)
+                .values(
+                    status="queued",
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    attempts=ProcessingJob.attempts - 1,  # 正常交还不计入重试次数
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            await db.commit()
+
+    async def finish(self, job_id: str, worker_id: str, status: str, error: Optional[str] = None):
+        """结束任务并丢弃内存中的 API Key"""
+        self._keys.pop(job_id, None)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ProcessingJob)
+                .where(ProcessingJob.id == job_id, ProcessingJob.lease_owner == worker_id)
+                .values(
+                    status=status,
+                    error=error,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            await db.commit()
+
+    async def prepare_resume(self, job_id: str, max_page_attempts: int) -> List[int]:
+        """
+        计算本次需要处理的页面
+
+        上次运行中断在某页（状态仍为 running）且已达尝试上限的页面标记为 failed，
+        避免一个导致进程崩溃的页面让任务反复重启。已完成的页面仍返回，
+        由 PageProcessor 通过解释缓存跳过并计入进度。
+        """
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ProcessingJobPage)
+                .where(
+                    ProcessingJobPage.job_id == job_id,
+                    ProcessingJobPage.state == "running",
+                    ProcessingJobPage.attempts >= max_page_attempts,
+                )
+                .values(state="failed", updated_at=datetime.utcnow())
+            )
+            await db.commit()
+
+            stmt = select(ProcessingJobPage.page_number).where(
+                ProcessingJobPage.job_id == job_id,
+                ProcessingJobPage.state != "failed",
+            ).order_by(ProcessingJobPage.page_number)
+            return list((await db.execute(stmt)).scalars().all())
+
+    @staticmethod
+    async def record_pages(
+        db: AsyncSession, job_id: str, started: List[int], states: Dict[str, List[int]]
+    ):
+        """
+        批量写入逐页状态（不提交，由调用方与进度更新在同一事务中提交）
+
+        Args:
+            started: 开始处理的页面，各计入一次尝试并标记为 running
+            states: {状态: 页码}，done / failed；在 started 之后应用
+        """
+        now = datetime.utcnow()
+        if started:
+            await db.execute(
+                update(ProcessingJobPage)
+                .where(
+                    ProcessingJobPage.job_id == job_id,
+                    ProcessingJobPage.page_number.in_(started),
+                )
+                .values(state="running", attempts=ProcessingJobPage.attempts + 1, updated_at=now)
+            )
+        for state, page_numbers in states.items():
+            await db.execute(
+                update(ProcessingJobPage)
+                .where(
+                    ProcessingJobPage.job_id == job_id,
+                    ProcessingJobPage.page_number.in_(page_numbers),
+                )
+                .values(state=state, updated_at=now)
+            )
+
+
+# 全局单例
+job_queue = JobQueue(settings.job_lease_seconds)
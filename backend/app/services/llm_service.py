@@ -1,10 +1,24 @@
 """Gemini LLM 服务"""
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import gapic_v1
 from app.config import get_settings
 from PIL import Image
-from typing import List, Optional, AsyncGenerator
+from typing import Dict, List, Optional, AsyncGenerator, Tuple, Union
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 import asyncio
+import hashlib
+import math
+import re
+import time
+
+from app.services.rate_limiter import rate_limiter, KeyRateLimiter, is_rate_limit_error, parse_retry_delay
+from app.services.pdf_parser import RenderedPage
+from app.services.page_stream import BatchStreamSplitter, PageStream
+from app.models.database import AsyncSessionLocal
+from app.services.cache_service import cache_service
 
 settings = get_settings()
 
@@ -57,6 +71,201 @@ DEFAULT_PROMPT_TEMPLATE = """请作为一名专业的教师,详细分析这一
 请用清晰、易懂的中文回答,就像在给学生讲解一样。"""
 
 
+# Gemini 按 768x768 分块计算图像 token，每块约 258 tokens
+IMAGE_TILE_TOKENS = 258
+
+
+def estimate_input_tokens(
+    text: str, images: Optional[List[Union[Image.Image, RenderedPage]]] = None
+) -> int:
+    """粗略估算请求的输入 token 数（用于限流预扣，之后按实际用量校正）"""
+    tokens = len(text) // 2 + 1
+    for image in images or []:
+        width, height = image.size
+        tokens += math.ceil(width / 768) * math.ceil(height / 768) * IMAGE_TILE_TOKENS
+    return tokens
+
+
+def get_prompt_token_count(response) -> Optional[int]:
+    """从响应中读取实际的输入 token 数"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    return getattr(usage, "prompt_token_count", None) or None
+
+
+# 批量请求：多页共用一份模板，输出按分隔标记拆分
+BATCH_PROMPT_HEADER = """下面依次给出 {count} 页课件（第 {pages} 页），每页内容前标注了页码。
+请对每一页分别讲解，每页的讲解要求见下方说明。
+
+**输出格式（必须严格遵守）**:
+- 每一页的讲解以单独一行的分隔标记开头，格式为 ===PAGE 页码===，例如 ===PAGE {first}===
+- 按页码顺序输出，每页恰好一个分隔标记，分隔标记本身不要加粗或放进代码块
+
+以下是每页的讲解要求:
+
+"""
+
+# 批量输出中的分页标记
+PAGE_MARKER_PATTERN = re.compile(r"^[ \t]*=+[ \t]*PAGE[ \t]+(\d+)[ \t]*=+[ \t]*$", re.MULTILINE | re.IGNORECASE)
+
+
+class GenerationError(Exception):
+    """重试后仍未生成有效解释；调用方应将页面标记为失败，而不是保存占位文本"""
+
+
+async def iter_with_idle_timeout(response, idle_timeout: float):
+    """
+    逐块迭代流式响应
+
+    两块之间超过 idle_timeout 秒视为连接停滞（抛出 asyncio.TimeoutError）；
+    持续输出的长回答不受限制，总时长由调用方的截止时间约束。
+    """
+    iterator = response.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), timeout=idle_timeout)
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+
+def split_batch_response(text: str, page_numbers: List[int]) -> Dict[int, str]:
+    """
+    按分隔标记拆分批量输出
+
+    Returns:
+        {页码: Markdown}；只包含请求中的页码，重复出现或内容过短的页面视为失败
+    """
+    matches = list(PAGE_MARKER_PATTERN.finditer(text))
+    sections: Dict[int, str] = {}
+    duplicated = set()
+    for index, match in enumerate(matches):
+        page_num = int(match.group(1))
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        if page_num in sections:
+            duplicated.add(page_num)
+        sections[page_num] = text[match.end():end].strip()
+
+    return {
+        page_num: body
+        for page_num, body in sections.items()
+        if page_num in page_numbers and page_num not in duplicated and len(body) > 50
+    }
+
+
+# 解释记忆中代替本次请求页码的占位符：{{P0}} 为第一页，{{P1}} 为第二页……
+PAGE_PLACEHOLDER_PATTERN = re.compile(r"\{\{P(\d+)\}\}")
+# 生成结果中引用页码的写法：“第 N 页”和批量输出的分页标记
+PAGE_REFERENCE_PATTERNS = (
+    re.compile(r"(第[ \t]*)(\d+)([ \t]*页)"),
+    re.compile(r"(=+[ \t]*PAGE[ \t]+)(\d+)([ \t]*=+)", re.IGNORECASE),
+)
+# extract_summary 给摘要加的页码前缀
+SUMMARY_PAGE_PREFIX = re.compile(r"^\[第\d+页摘要\]\s*")
+
+
+def mask_page_numbers(text: str, page_numbers: List[int]) -> str:
+    """把文本中对本次请求页面的引用换成按位置编号的占位符（其他页码保持不变）"""
+    positions = {page_num: index for index, page_num in enumerate(page_numbers)}
+
+    def replace(match: "re.Match") -> str:
+        index = positions.get(int(match.group(2)))
+        if index is None:
+            return match.group(0)
+        return f"{match.group(1)}{{{{P{index}}}}}{match.group(3)}"
+
+    for pattern in PAGE_REFERENCE_PATTERNS:
+        text = pattern.sub(replace, text)
+    return text
+
+
+def unmask_page_numbers(text: str, page_numbers: List[int]) -> str:
+    """mask_page_numbers 的逆操作：占位符换回本次请求的页码"""
+    def replace(match: "re.Match") -> str:
+        index = int(match.group(1))
+        return str(page_numbers[index]) if index < len(page_numbers) else match.group(0)
+
+    return PAGE_PLACEHOLDER_PATTERN.sub(replace, text)
+
+
+def explanation_memo_key(
+    model: str,
+    prompt: str,
+    image_bytes: bytes,
+    previous_summaries: Optional[List[str]],
+    temperature: float,
+    max_tokens: int,
+) -> str:
+    """
+    页面解释的内容寻址键
+
+    只覆盖与页码无关的输入：模型、提示词模板（不含页码标注）、页面内容、
+    去掉页码前缀的前文摘要和采样参数。同一页出现在不同文档的不同位置时得到相同的键；
+    记忆中的页码以占位符保存，命中后填入当前页码。
+    """
+    summaries = [SUMMARY_PAGE_PREFIX.sub("", summary) for summary in previous_summaries or []]
+    parts = [
+        model,
+        hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        hashlib.sha256(image_bytes).hexdigest(),
+        hashlib.sha256("\n".join(summaries).encode("utf-8")).hexdigest(),
+        repr(float(temperature)),
+        str(max_tokens),
+    ]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+# GenerativeModel 懒加载客户端的属性；SDK 没有公开的注入参数，版本固定在 requirements.txt
+MODEL_CLIENT_ATTRIBUTES = ("_client", "_async_client")
+
+
+def build_model(api_key: str, model: str) -> genai.GenerativeModel:
+    """
+    创建绑定到指定 API Key 的模型
+
+    不调用 genai.configure：全局配置会被并发的其他 Key 覆盖。每个 Key 用公开的
+    google.ai.generativelanguage 客户端类创建同步与异步客户端（Key 通过 client_options 传入），
+    再交给模型使用。
+
+    Raises:
+        RuntimeError: 当前 SDK 的 GenerativeModel 不再有这两个客户端属性。
+            此时不退回全局配置（会让不同用户的请求共用一个 Key），而是直接报错
+    """
+    generative_model = genai.GenerativeModel(model)
+    missing = [name for name in MODEL_CLIENT_ATTRIBUTES if not hasattr(generative_model, name)]
+    if missing:
+        raise RuntimeError(
+            f"google-generativeai {genai.__version__} 的 GenerativeModel 缺少 {missing}，"
+            f"无法为每个 API Key 创建独立客户端；请安装 requirements.txt 中固定的版本"
+        )
+
+    client_options = {"api_key": api_key}
+    client_info = gapic_v1.client_info.ClientInfo(user_agent=f"genai-py/{genai.__version__}")
+    generative_model._client = glm.GenerativeServiceClient(
+        client_options=client_options, client_info=client_info
+    )
+    generative_model._async_client = glm.GenerativeServiceAsyncClient(
+        client_options=client_options, client_info=client_info
+    )
+    return generative_model
+
+
+# 聊天会话：将超出历史预算的较早对话压缩为摘要
+CHAT_SUMMARY_PROMPT = """下面是学生与课件讲解助手之间较早的对话，请将其压缩为一段摘要，供后续对话参考。
+
+要求:
+- 保留学生关心的问题、助手给出的关键结论、定义和公式
+- 保留学生表现出的理解难点或偏好
+- 省略寒暄和重复内容，不超过 300 字，使用中文
+
+已有的摘要（可能为空，需要与新对话合并）:
+{previous}
+
+新的对话:
+{transcript}"""
+
+
 @dataclass
 class LLMConfig:
     """LLM 配置"""
@@ -75,9 +284,17 @@ class GeminiService:
             config: LLM 配置，如果为 None 则使用环境变量配置（向后兼容）
         """
         self.prompt_template = DEFAULT_PROMPT_TEMPLATE
+        self.request_timeout = settings.llm_request_timeout
+        self.stream_idle_timeout = settings.llm_stream_idle_timeout
+        self.generation_deadline = settings.llm_generation_deadline
         self._model = None
         self._api_key = None
         self._model_name = None
+        self._limiter: Optional[KeyRateLimiter] = None
+        # 同时进行中的请求上限（由 LLMServicePool 设置，None 表示不限制）
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.last_used = time.monotonic()
 
         if config:
             self._init_with_config(config)
@@ -100,22 +317,43 @@ class GeminiService:
         if config.model not in SUPPORTED_MODELS:
             raise ValueError(f"不支持的模型: {config.model}，支持: {SUPPORTED_MODELS}")
 
-        genai.configure(api_key=config.api_key)
-        self._model = genai.GenerativeModel(config.model)
+        self._model = build_model(config.api_key, config.model)
         self._api_key = config.api_key
         self._model_name = config.model
+        # 同一 Key + 模型的所有实例共享一个限流器
+        self._limiter = rate_limiter.get(config.api_key, config.model)
 
     def configure(self, config: LLMConfig):
         """动态更新配置"""
         self._init_with_config(config)
         print(f"✅ Gemini 配置已更新: {config.model}")
 
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个并发名额，覆盖限流等待与请求本身"""
+        if self._slots is None:
+            yield
+            return
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                self.last_used = time.monotonic()
+
     @property
     def model(self):
         if self._model is None:
             raise ValueError("Gemini 未配置，请先提供 API Key")
         return self._model
 
+    @property
+    def limiter(self) -> KeyRateLimiter:
+        if self._limiter is None:
+            raise ValueError("Gemini 未配置，请先提供 API Key")
+        return self._limiter
+
     @property
     def is_configured(self) -> bool:
         return self._model is not None
@@ -156,16 +394,141 @@ class GeminiService:
 
     async def analyze_image(
         self,
-        image: Image.Image,
+        image: Union[Image.Image, RenderedPage],
         page_num: int,
         previous_summaries: Optional[List[str]] = None,
         temperature: float = 0.7,
         max_tokens: int = 50000,
+        stream: Optional[PageStream] = None,
     ) -> str:
-        """分析图像并生成Markdown格式解释"""
-        
-        # 构建提示词
+        """
+        分析图像并生成Markdown格式解释
+
+        Args:
+            image: 页面图像；RenderedPage 的已编码字节会原样上传，不再重新编码
+            stream: 提供时以流式方式请求，生成的文本实时写入 stream
+        """
         prompt = f"【第 {page_num} 页】\n\n{self.prompt_template}"
+        if isinstance(image, RenderedPage):
+            return await self._explain(
+                [page_num], prompt, self.prompt_template, [image], [image.to_blob()], image.data,
+                previous_summaries, temperature, max_tokens, stream,
+            )
+        return await self._explain(
+            [page_num], prompt, self.prompt_template, [image], [image], None,
+            previous_summaries, temperature, max_tokens, stream,
+        )
+
+    async def analyze_text(
+        self,
+        text: str,
+        page_num: int,
+        previous_summaries: Optional[List[str]] = None,
+        temperature: float = 0.7,
+        max_tokens: int = 50000,
+        stream: Optional[PageStream] = None,
+    ) -> str:
+        """
+        根据页面文本层生成Markdown格式解释（纯文字页面，不上传图像）
+
+        Args:
+            text: 从 PDF 文本层提取的页面文字
+        """
+        body = (
+            f"这一页课件只有文字（没有图片或图表），以下是从 PDF 中提取的页面文字:\n\n"
+            f"{text}\n\n---\n\n{self.prompt_template}"
+        )
+        # 页面文字已包含在提示词中，记忆键无需额外内容
+        return await self._explain(
+            [page_num], f"【第 {page_num} 页】\n\n{body}", body, [], [], b"",
+            previous_summaries, temperature, max_tokens, stream,
+        )
+
+    async def analyze_batch(
+        self,
+        pages: List[Tuple[int, Union[RenderedPage, str]]],
+        previous_summaries: Optional[List[str]] = None,
+        temperature: float = 0.7,
+        max_tokens: int = 50000,
+        stream: Optional[BatchStreamSplitter] = None,
+    ) -> Dict[int, str]:
+        """
+        一次请求分析多个连续页面，共用一份提示词模板
+
+        Args:
+            pages: [(页码, 页面图像或纯文字页面的文本)]，按页码顺序
+            stream: 提供时按分隔标记把输出实时分发到各页
+
+        Returns:
+            成功拆分出的 {页码: Markdown}；缺失或过短的页面不在结果中，由调用方逐页重试
+        """
+        page_numbers = [page_num for page_num, _ in pages]
+        prompt = BATCH_PROMPT_HEADER.format(
+            count=len(pages),
+            pages="、".join(str(p) for p in page_numbers),
+            first=page_numbers[0],
+        ) + self.prompt_template
+
+        images, parts = [], []
+        digest = hashlib.sha256()
+        for page_num, content in pages:
+            if isinstance(content, RenderedPage):
+                images.append(content)
+                parts += [f"【第 {page_num} 页】", content.to_blob()]
+                digest.update(hashlib.sha256(content.data).digest())
+            else:
+                parts.append(f"【第 {page_num} 页】（只有文字，以下是从 PDF 中提取的页面文字）\n\n{content}")
+                digest.update(hashlib.sha256(content.encode("utf-8")).digest())
+
+        # 记忆键用未填页码的批量模板；各页内容的顺序由 digest 体现
+        memo_prompt = f"{BATCH_PROMPT_HEADER}{len(pages)}\n{self.prompt_template}"
+        response_text = await self._explain(
+            page_numbers, prompt, memo_prompt, images, parts, digest.digest(),
+            previous_summaries, temperature, max_tokens, stream,
+        )
+        return split_batch_response(response_text, page_numbers)
+
+    async def _explain(
+        self,
+        page_numbers: List[int],
+        prompt: str,
+        memo_prompt: str,
+        images: List[Union[Image.Image, RenderedPage]],
+        parts: list,
+        memo_payload: Optional[bytes],
+        previous_summaries: Optional[List[str]],
+        temperature: float,
+        max_tokens: int,
+        stream: Optional[Union[PageStream, BatchStreamSplitter]],
+    ) -> str:
+        """
+        生成页面解释：查询记忆、限流、重试和结果提取
+
+        Raises:
+            GenerationError: 重试后仍无有效内容（超时、API 错误、无候选或被过滤）
+
+        Args:
+            page_numbers: 本次请求的页面（单页请求只有一页）
+            prompt: 页码 + 页面内容 + 模板，不含前文上下文
+            memo_prompt: 不含页码的提示词，用于记忆键
+            images: 随请求上传的页面图像（用于估算输入 token）
+            parts: 提示词之后依次发送的内容（图像 Blob、文字标注）
+            memo_payload: 参与记忆键计算的页面内容字节，None 表示不使用记忆
+        """
+        page_num = page_numbers[0]
+        memo_key = None
+        if memo_payload is not None:
+            # 相同输入的解释跨文档复用，命中时不调用 API
+            memo_key = explanation_memo_key(
+                self._model_name or "", memo_prompt, memo_payload, previous_summaries, temperature, max_tokens
+            )
+            memoized = await self._load_memo(memo_key)
+            if memoized is not None:
+                memoized = unmask_page_numbers(memoized, page_numbers)
+                print(f"♻️ 第 {page_num} 页：命中解释记忆，跳过 API 调用")
+                if stream is not None:
+                    stream.append(memoized)
+                return memoized
         
         # 添加前面页面的上下文
         if previous_summaries:
@@ -178,22 +541,33 @@ class GeminiService:
             max_output_tokens=max_tokens,
         )
 
+        estimated_tokens = estimate_input_tokens(prompt, images)
+        contents = [prompt, *parts]
+
         # 重试机制
         max_retries = 3
+        last_error = ""
         for attempt in range(max_retries):
             try:
-                response = self.model.generate_content(
-                    [prompt, image],
-                    generation_config=config,
-                    safety_settings=SAFETY_SETTINGS,
-                )
+                async with self.slot():
+                    await self.limiter.acquire(estimated_tokens)
+                    if stream is not None:
+                        stream.reset()  # 丢弃上次尝试已输出的文本
+
+                    # 使用原生异步接口，避免阻塞事件循环；单次请求与流式的块间停滞在
+                    # _generate 内限时，这里只设总截止时间，保证长回答可以完整生成
+                    response = await asyncio.wait_for(
+                        self._generate(contents, config, stream),
+                        timeout=self.generation_deadline,
+                    )
+                self.limiter.on_success()
+                self.limiter.record_usage(estimated_tokens, get_prompt_token_count(response))
 
                 # 检查是否有候选响应
                 if not response.candidates:
                     print(f"⚠️ 第 {page_num} 页：无候选响应，重试 {attempt + 1}/{max_retries}")
-                    if attempt < max_retries - 1:
-                        continue
-                    return f"## 第 {page_num} 页\n\n⚠️ 无法生成内容，请稍后重试。"
+                    last_error = "无候选响应"
+                    continue
 
                 candidate = response.candidates[0]
 
@@ -232,28 +606,88 @@ class GeminiService:
                         pass
 
                 if extracted_text and len(extracted_text.strip()) > 50:
+                    # 只记忆完整生成的结果，降级提示和过短内容不写入
+                    if memo_key is not None:
+                        await self._save_memo(memo_key, mask_page_numbers(extracted_text, page_numbers))
                     return extracted_text
                 elif extracted_text:
                     print(f"⚠️ 第 {page_num} 页：内容过短 ({len(extracted_text)} 字符)，重试")
                     if attempt < max_retries - 1:
                         continue
-                    return extracted_text if extracted_text else f"## 第 {page_num} 页\n\n⚠️ 内容生成不完整。"
+                    return extracted_text
                 else:
                     print(f"⚠️ 第 {page_num} 页：无法提取内容，重试 {attempt + 1}/{max_retries}")
-                    if attempt < max_retries - 1:
-                        continue
-                    return f"## 第 {page_num} 页\n\n⚠️ 无法提取内容，可能是安全过滤导致。"
+                    last_error = "无法提取内容，可能是安全过滤导致"
+                    continue
+
+            except asyncio.TimeoutError:
+                print(f"⚠️ 第 {page_num} 页：Gemini 请求超时，重试 {attempt + 1}/{max_retries}")
+                last_error = "生成超时"
 
             except Exception as e:
                 print(f"⚠️ 第 {page_num} 页：Gemini API 错误: {str(e)}")
-                if attempt < max_retries - 1:
-                    import asyncio
-                    await asyncio.sleep(2)  # 等待2秒后重试
-                    continue
-                return f"## 第 {page_num} 页\n\n⚠️ 生成失败: {str(e)[:200]}"
-        
-        return f"## 第 {page_num} 页\n\n⚠️ 多次尝试后仍无法生成内容。"
+                last_error = str(e)[:200]
+                if is_rate_limit_error(e):
+                    # 429：降低共享速率并进入冷却，下次 acquire 会自动等待
+                    self.limiter.on_rate_limited(parse_retry_delay(e))
+                elif attempt < max_retries - 1:
+                    await asyncio.sleep(2 ** (attempt + 1))  # 指数退避后重试
 
+        raise GenerationError(f"第 {page_num} 页多次尝试后仍无法生成内容: {last_error}")
+
+    async def _load_memo(self, memo_key: str) -> Optional[str]:
+        """读取解释记忆；数据库异常时视为未命中"""
+        try:
+            async with AsyncSessionLocal() as db:
+                return await cache_service.get_memoized_explanation(db, memo_key)
+        except Exception as e:
+            print(f"⚠️ 读取解释记忆失败: {str(e)}")
+            return None
+
+    async def _save_memo(self, memo_key: str, markdown: str):
+        """写入解释记忆；失败不影响本次结果"""
+        try:
+            async with AsyncSessionLocal() as db:
+                await cache_service.save_memoized_explanation(db, memo_key, self._model_name, markdown)
+        except Exception as e:
+            print(f"⚠️ 保存解释记忆失败: {str(e)}")
+
+    async def _generate(self, contents, config, stream: Optional[Union[PageStream, BatchStreamSplitter]] = None):
+        """
+        发送生成请求；有 stream 时逐块转发文本，返回聚合后的完整响应
+
+        非流式请求整体限时 request_timeout；流式请求只对首块限时 request_timeout、
+        块间停滞限时 stream_idle_timeout，总时长由调用方的截止时间约束。
+        """
+        if stream is None:
+            return await asyncio.wait_for(
+                self.model.generate_content_async(
+                    contents,
+                    generation_config=config,
+                    safety_settings=SAFETY_SETTINGS,
+                    request_options={"timeout": self.request_timeout},
+                ),
+                timeout=self.request_timeout,
+            )
+
+        response = await asyncio.wait_for(
+            self.model.generate_content_async(
+                contents,
+                generation_config=config,
+                safety_settings=SAFETY_SETTINGS,
+                stream=True,
+                request_options={"timeout": self.generation_deadline},
+            ),
+            timeout=self.request_timeout,
+        )
+        async for chunk in iter_with_idle_timeout(response, self.stream_idle_timeout):
+            try:
+                text = chunk.text
+            except ValueError:
+                text = ""  # 被安全过滤的块没有文本
+            if text:
+                stream.append(text)
+        return response
 
     async def chat_stream(
         self,
@@ -263,6 +697,7 @@ class GeminiService:
         page_number: int,
         temperature: float = 0.7,
         max_tokens: int = 50000,
+        summary: str = "",
     ) -> AsyncGenerator[str, None]:
         """
         流式聊天响应
@@ -274,9 +709,13 @@ class GeminiService:
             page_number: 当前页码
             temperature: 温度参数
             max_tokens: 最大 token 数
+            summary: 更早对话的摘要（已不在 history 中）
 
         Yields:
             流式响应的文本片段
+
+        Raises:
+            生成失败时抛出原始异常，由调用方通知客户端
         """
         # 构建系统提示
         system_prompt = f"""你是一个专业的课件讲解助手。用户正在阅读第 {page_number} 页的课件内容，下面是该页的详细讲解：
@@ -302,6 +741,9 @@ class GeminiService:
 - 用反引号包裹重要的数学表达式和变量名，如 `r(x)`, `θ₁`, `P(6|θ₂)`
 - 请用清晰、易懂的中文回答"""
 
+        if summary:
+            system_prompt += f"\n\n此前对话的摘要（更早的对话内容已省略）：\n{summary}"
+
         # 构建消息历史
         messages = []
 
@@ -319,26 +761,86 @@ class GeminiService:
             max_output_tokens=max_tokens,
         )
 
+        full_message = f"{system_prompt}\n\n用户问题：{question}"
+        estimated_tokens = estimate_input_tokens(
+            full_message + "".join(msg["content"] for msg in history)
+        )
+
         try:
-            # 使用 chat 模式
-            chat = self.model.start_chat(history=messages[:-1] if messages[:-1] else [])
+            async with self.slot():
+                await self.limiter.acquire(estimated_tokens)
+
+                # 使用 chat 模式
+                chat = self.model.start_chat(history=messages[:-1] if messages[:-1] else [])
+
+                # 原生异步流式生成：等待下一块时不占用事件循环；
+                # 调用方取消时 CancelledError 在此处抛出，同时取消上游请求。
+                # 首块限时 request_timeout，之后只限制块间停滞，长回答不会被截断
+                response = await asyncio.wait_for(
+                    chat.send_message_async(
+                        full_message,
+                        generation_config=config,
+                        safety_settings=SAFETY_SETTINGS,
+                        stream=True,
+                        request_options={"timeout": self.generation_deadline},
+                    ),
+                    timeout=self.request_timeout,
+                )
 
-            # 流式生成
-            response = chat.send_message(
-                f"{system_prompt}\n\n用户问题：{question}",
-                generation_config=config,
-                safety_settings=SAFETY_SETTINGS,
-                stream=True,
-            )
+                async for chunk in iter_with_idle_timeout(response, self.stream_idle_timeout):
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        text = ""  # 被安全过滤的块没有文本
+                    if text:
+                        yield text
 
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
-                    await asyncio.sleep(0)  # 让出控制权
+                self.limiter.on_success()
+                self.limiter.record_usage(estimated_tokens, get_prompt_token_count(response))
 
         except Exception as e:
+            if is_rate_limit_error(e):
+                self.limiter.on_rate_limited(parse_retry_delay(e))
             print(f"❌ 聊天流式响应错误: {str(e)}")
-            yield f"\n\n抱歉，发生错误：{str(e)}"
+            raise
+
+    async def summarize_conversation(self, previous_summary: str, messages: List[dict]) -> str:
+        """
+        将较早的对话与已有摘要合并为新的摘要
+
+        Args:
+            previous_summary: 已有摘要（可为空）
+            messages: 需要并入摘要的对话 [{"role": "user/assistant", "content": "..."}]
+        """
+        transcript = "\n\n".join(
+            f"{'学生' if msg['role'] == 'user' else '助手'}：{msg['content']}" for msg in messages
+        )
+        prompt = CHAT_SUMMARY_PROMPT.format(previous=previous_summary or "（无）", transcript=transcript)
+        config = genai.GenerationConfig(
+            temperature=0.2,
+            max_output_tokens=settings.chat_summary_max_tokens,
+        )
+        estimated_tokens = estimate_input_tokens(prompt)
+
+        async with self.slot():
+            await self.limiter.acquire(estimated_tokens)
+            try:
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(
+                        prompt,
+                        generation_config=config,
+                        safety_settings=SAFETY_SETTINGS,
+                        request_options={"timeout": self.request_timeout},
+                    ),
+                    timeout=self.request_timeout,
+                )
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self.limiter.on_rate_limited(parse_retry_delay(e))
+                raise
+            self.limiter.on_success()
+            self.limiter.record_usage(estimated_tokens, get_prompt_token_count(response))
+        return response.text.strip()
 
 
 # 全局单例（可选，向后兼容）
@@ -347,9 +849,71 @@ class GeminiService:
 llm_service = GeminiService()
 
 
+class LLMServicePool:
+    """
+    按 (API Key, 模型) 复用的 GeminiService 池
+
+    同一用户的多次聊天和处理任务共用已初始化的客户端；每个条目带并发上限。
+    超过容量时按 LRU 淘汰，空闲超时的条目在下次取用时清理；
+    有请求在进行中的条目不淘汰，保证并发上限不会因重建实例而失效。
+    """
+
+    def __init__(self, max_entries: int, idle_seconds: float, max_concurrency: int):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.max_concurrency = max_concurrency
+        self._services: "OrderedDict[tuple[str, str], GeminiService]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_key: str, model: str) -> GeminiService:
+        """获取（或创建）服务实例"""
+        key = (hashlib.sha256(api_key.encode()).hexdigest(), model)
+        service = self._services.get(key)
+        if service is None:
+            self.misses += 1
+            service = GeminiService(LLMConfig(api_key=api_key, model=model))
+            service._slots = asyncio.Semaphore(self.max_concurrency)
+            self._services[key] = service
+        else:
+            self.hits += 1
+            self._services.move_to_end(key)
+        service.last_used = time.monotonic()
+        self._evict(keep=key)
+        return service
+
+    def _evict(self, keep: tuple):
+        idle_before = time.monotonic() - self.idle_seconds
+        for key, service in list(self._services.items()):
+            if key == keep or service.in_flight:
+                continue
+            if len(self._services) > self.max_entries or service.last_used < idle_before:
+                del self._services[key]
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._services),
+            "in_flight": sum(service.in_flight for service in self._services.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+llm_pool = LLMServicePool(
+    max_entries=settings.llm_pool_max_entries,
+    idle_seconds=settings.llm_pool_idle_seconds,
+    max_concurrency=settings.llm_key_max_concurrency,
+)
+
+
 def create_llm_service(api_key: str, model: str = "gemini-2.5-flash") -> GeminiService:
     """
-    创建新的 LLM 服务实例（使用客户端配置）
+    获取 LLM 服务实例（使用客户端配置）
+
+    同一 (API Key, 模型) 返回池中共享的实例，不同 Key 的客户端互不影响。
 
     Args:
         api_key: Google API Key
@@ -358,5 +922,4 @@ def create_llm_service(api_key: str, model: str = "gemini-2.5-flash") -> GeminiS
     Returns:
         配置好的 GeminiService 实例
     """
-    config = LLMConfig(api_key=api_key, model=model)
-    return GeminiService(config)
+    return llm_pool.get(api_key, model)
@@ -0,0 +1,137 @@
+"""渲染页面的磁盘缓存 - 按 (pdf_id, 页码, DPI, 格式, 质量) 寻址，超出配额按 LRU 淘汰"""
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+from app.config import get_settings
+
+settings = get_settings()
+
+
+class PageImageCache:
+    """
+    渲染页面图像的磁盘缓存
+
+    pdf_id 本身是文件内容的哈希，所以同一键对应的图像内容不会变化。
+    写入先落到临时文件再 os.replace，读者不会看到半写的文件；
+    读取时刷新 mtime，总大小超出配额时按 mtime 从旧到新淘汰。
+    """
+
+    def __init__(self, cache_dir: str, max_size_mb: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None  # 首次使用时扫描目录
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, pdf_id: str, page_number: int, dpi: int, fmt: str, quality: Optional[int]) -> Path:
+        variant = f"_q{quality}" if quality else ""
+        return self.cache_dir / pdf_id / f"p{page_number:04d}_{dpi}{variant}.{fmt}"
+
+    def _ensure_scanned(self):
+        if self._total_bytes is None:
+            self._total_bytes = sum(
+                path.stat().st_size for path in self.cache_dir.rglob("*")
+                if path.is_file() and path.suffix != ".tmp"
+            )
+
+    def get(
+        self, pdf_id: str, page_number: int, dpi: int, fmt: str, quality: Optional[int] = None
+    ) -> Optional[bytes]:
+        """读取缓存的页面图像，未命中返回 None"""
+        path = self._path(pdf_id, page_number, dpi, fmt, quality)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # 刷新 LRU 时间
+        except FileNotFoundError:
+            pass  # 读取后恰好被淘汰
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(
+        self, pdf_id: str, page_number: int, dpi: int, fmt: str, data: bytes,
+        quality: Optional[int] = None,
+    ):
+        """原子写入页面图像"""
+        path = self._path(pdf_id, page_number, dpi, fmt, quality)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # 替换与计数在同一把锁内：首次扫描不会把刚写入的文件重复计入
+            with self._lock:
+                self._ensure_scanned()
+                previous_size = path.stat().st_size if path.exists() else 0
+                os.replace(tmp_path, path)
+                self._total_bytes += len(data) - previous_size
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _evict(self):
+        """按最近使用时间淘汰，直到总大小降到配额的 90%"""
+        entries = []
+        for path in self.cache_dir.rglob("*"):
+            if path.is_file() and path.suffix != ".tmp":
+                stat = path.stat()
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        target = int(self.max_bytes * 0.9)
+        self._total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                path.unlink()
+                self._total_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def delete(self, pdf_id: str, page_numbers: Optional[List[int]] = None):
+        """删除某个 PDF 指定页面（所有 DPI / 格式）的缓存图像，不指定页码时删除全部"""
+        directory = self.cache_dir / pdf_id
+        with self._lock:
+            if page_numbers is None:
+                shutil.rmtree(directory, ignore_errors=True)
+                self._total_bytes = None  # 下次使用时重新扫描
+                return
+            self._ensure_scanned()
+            for page_number in page_numbers:
+                for path in directory.glob(f"p{page_number:04d}_*"):
+                    try:
+                        size = path.stat().st_size
+                        path.unlink()
+                        self._total_bytes -= size
+                    except FileNotFoundError:
+                        pass
+
+    def stats(self) -> dict:
+        """缓存统计"""
+        with self._lock:
+            self._ensure_scanned()
+            return {
+                "size_mb": round(self._total_bytes / (1024 * 1024), 1),
+                "max_size_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# 全局单例
+page_image_cache = PageImageCache(settings.page_cache_dir, settings.page_cache_max_mb)
@@ -0,0 +1,135 @@
+"""生成中页面的实时输出 - 缓存已生成的文本并通过事件总线推送增量"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from app.services.event_bus import event_bus
+
+
+def page_topic(pdf_id: str, page_number: int) -> str:
+    """单页生成事件的 topic（与文档进度 topic 区分）"""
+    return f"{pdf_id}/{page_number}"
+
+
+class PageStream:
+    """
+    单个页面的一次生成过程
+
+    LLM 每输出一段文本就 append 一次；重试时 reset 清空已输出内容。
+    事件格式：
+    - {"type": "delta", "text": ...}  新增文本
+    - {"type": "reset"}               丢弃之前的文本（请求重试）
+    - {"type": "done", "page_number", "markdown_content", "summary"}  最终结果（已落库）
+    - {"type": "error", "message": ...}
+    """
+
+    def __init__(self, registry: "PageStreamRegistry", pdf_id: str, page_number: int):
+        self._registry = registry
+        self.pdf_id = pdf_id
+        self.page_number = page_number
+        self.topic = page_topic(pdf_id, page_number)
+        self._parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def append(self, text: str):
+        self._parts.append(text)
+        event_bus.publish(self.topic, {"type": "delta", "text": text})
+
+    def reset(self):
+        if not self._parts:
+            return
+        self._parts.clear()
+        event_bus.publish(self.topic, {"type": "reset"})
+
+    def finish(self, markdown_content: str, summary: str):
+        """结果已保存后调用：推送最终文本并结束"""
+        self._registry._remove(self)
+        event_bus.publish(self.topic, {
+            "type": "done",
+            "page_number": self.page_number,
+            "markdown_content": markdown_content,
+            "summary": summary,
+        })
+
+    def fail(self, message: str):
+        self._registry._remove(self)
+        event_bus.publish(self.topic, {"type": "error", "message": message})
+
+
+class BatchStreamSplitter:
+    """
+    批量请求的流式输出分发
+
+    与 PageStream 接口相同（append / reset）。按行识别分页标记，
+    将标记之后的文本转发到对应页面的 PageStream；未完成的行暂存到下一块。
+    """
+
+    def __init__(self, streams: Dict[int, PageStream], marker: "re.Pattern"):
+        self.streams = streams
+        self.marker = marker
+        self._current: Optional[PageStream] = None
+        self._pending = ""
+
+    def append(self, text: str):
+        self._pending += text
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            match = self.marker.match(line)
+            if match:
+                self._current = self.streams.get(int(match.group(1)))
+            elif self._current is not None:
+                self._current.append(line + "\n")
+
+    def reset(self):
+        self._current = None
+        self._pending = ""
+        for stream in self.streams.values():
+            stream.reset()
+
+
+class PageStreamRegistry:
+    """
+    正在生成的页面登记表
+
+    订阅者中途加入时先取已生成文本的快照，再接收之后的增量。
+    订阅与取快照之间没有 await，不会漏掉或重复增量。
+    """
+
+    def __init__(self):
+        self._streams: Dict[Tuple[str, int], PageStream] = {}
+
+    def start(self, pdf_id: str, page_number: int) -> PageStream:
+        stream = PageStream(self, pdf_id, page_number)
+        self._streams[(pdf_id, page_number)] = stream
+        event_bus.publish(stream.topic, {"type": "start"})
+        return stream
+
+    def get(self, pdf_id: str, page_number: int) -> Optional[PageStream]:
+        return self._streams.get((pdf_id, page_number))
+
+    def _remove(self, stream: PageStream):
+        key = (stream.pdf_id, stream.page_number)
+        if self._streams.get(key) is stream:
+            del self._streams[key]
+
+    def abort(self, pdf_id: str, page_numbers: List[int], message: str):
+        """
+        结束这些页面的订阅：生成中的页面按失败结束，尚未开始的页面直接推送 error
+
+        用于页面在生成开始前失败（如渲染失败）或任务被取消的情况，等待中的订阅者不会一直挂起。
+        """
+        for page_number in page_numbers:
+            stream = self.get(pdf_id, page_number)
+            if stream is not None:
+                stream.fail(message)
+            else:
+                event_bus.publish(page_topic(pdf_id, page_number), {"type": "error", "message": message})
+
+    def stats(self) -> dict:
+        return {"generating": len(self._streams)}
+
+
+# 全局单例
+page_streams = PageStreamRegistry()
@@ -1,52 +1,419 @@
 """PDF 解析服务 - PyMuPDF 图像提取"""
-import hashlib
+import asyncio
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Union
 import fitz  # PyMuPDF
 from PIL import Image
 import io
 
+from app.config import get_settings
+from app.services.page_image_cache import page_image_cache
+from app.services.render_worker import (
+    render_pixmap, encode_pixmap, render_encoded_in_worker
+)
+
+settings = get_settings()
+
+
+@dataclass
+class _OpenDocument:
+    """缓存中的文档句柄"""
+    doc: fitz.Document
+    mtime_ns: int
+    last_used: float
+
+
+class DocumentCache:
+    """
+    已打开 fitz.Document 的 LRU 缓存
+
+    同一 PDF 的多次渲染/计数复用一次解析结果（xref、页面树）。
+    PyMuPDF 不是线程安全的，借出的句柄在使用期间持有全局锁。
+    """
+
+    def __init__(self, max_open: int = 16, idle_seconds: float = 300):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self._docs: "OrderedDict[str, _OpenDocument]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def open(self, file_path: str) -> Iterator[fitz.Document]:
+        """借出文档句柄（文件被替换后自动重新打开）"""
+        key = os.path.realpath(file_path)
+        with self._lock:
+            mtime_ns = os.stat(key).st_mtime_ns
+            entry = self._docs.get(key)
+            if entry is not None and entry.mtime_ns != mtime_ns:
+                self._close(key)
+                entry = None
+
+            if entry is None:
+                entry = _OpenDocument(fitz.open(key), mtime_ns, time.monotonic())
+                self._docs[key] = entry
+            else:
+                self._docs.move_to_end(key)
+
+            entry.last_used = time.monotonic()
+            self._evict(keep=key)
+            yield entry.doc
+
+    def _close(self, key: str):
+        entry = self._docs.pop(key, None)
+        if entry is not None:
+            entry.doc.close()
+
+    def _evict(self, keep: str = None):
+        """淘汰空闲超时的句柄，并把数量限制在 max_open 以内"""
+        now = time.monotonic()
+        for key in list(self._docs.keys()):
+            if key != keep and now - self._docs[key].last_used > self.idle_seconds:
+                self._close(key)
+        while len(self._docs) > self.max_open:
+            oldest = next(iter(self._docs))
+            if oldest == keep:
+                break
+            self._close(oldest)
+
+    def evict_idle(self):
+        """关闭空闲超时的句柄（供定时清理调用）"""
+        with self._lock:
+            self._evict()
+
+    def invalidate(self, file_path: str):
+        """关闭指定文件的句柄"""
+        with self._lock:
+            self._close(os.path.realpath(file_path))
+
+    def close_all(self):
+        """关闭所有句柄"""
+        with self._lock:
+            for key in list(self._docs.keys()):
+                self._close(key)
+
+    @property
+    def open_count(self) -> int:
+        return len(self._docs)
+
+
+# 支持的页面图像编码格式
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+@dataclass
+class RenderedPage:
+    """编码后的页面图像"""
+    page_number: int
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+
+    @classmethod
+    def from_bytes(cls, page_number: int, data: bytes, fmt: str) -> "RenderedPage":
+        """从已编码字节构建（只读取图像头获取尺寸）"""
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+        return cls(page_number, data, IMAGE_MIME_TYPES[fmt], width, height)
+
+    def to_blob(self) -> dict:
+        """Gemini SDK 可直接使用的 blob，避免 SDK 对 PIL 图像重新编码"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+# 结束页文字（整页只有这些内容时视为 END 页）
+CLOSING_PATTERN = re.compile(
+    r"^(thank(s| you)( for (your )?(attention|listening))?|merci( de votre attention)?|"
+    r"questions?|q\s*&\s*a|the end|fin|谢谢(观看|聆听|大家)?|感谢(聆听|观看)?|致谢|提问|答疑|结束)"
+    r"[\s!！.。?？,，]*$",
+    re.IGNORECASE,
+)
+# 目录页标题
+INDEX_PATTERN = re.compile(
+    r"^(目录|大纲|提纲|contents|table of contents|outline|agenda|sommaire|plan du cours)\b",
+    re.IGNORECASE,
+)
+
+
+def _is_layout_sensitive(text: str) -> bool:
+    """
+    文本层是否丢失了关键排版信息
+
+    数学符号、希腊字母和无法映射的字形（私有区、替换字符）往往来自公式，
+    文本层无法保留上下标和分式结构，这类页面仍以图像分析。
+    """
+    suspicious = sum(
+        1 for ch in text
+        if "\u2200" <= ch <= "\u22ff"  # 数学运算符
+        or "\u0370" <= ch <= "\u03ff"  # 希腊字母
+        or "\ue000" <= ch <= "\uf8ff"  # 私有区字形
+        or ch == "\ufffd"
+    )
+    return suspicious >= 3
+
+
+@dataclass
+class PageProfile:
+    """
+    基于文本层的页面分类结果
+
+    kind:
+    - blank: 没有文字和图像的空白页
+    - closing: 只有"谢谢"、"Questions?"之类的结束页
+    - text: 纯文字页面，可以只发送文本层
+    - visual: 含图片、图表或公式，需要发送页面图像
+    """
+    page_number: int
+    page_type: str  # TITLE / CONTENT / END / INDEX
+    kind: str
+    text: str
+    image_count: int
+    drawing_count: int
+    dhash: int = 0  # 64 位差异哈希，用于识别相邻的近似页面
+
+    @property
+    def is_trivial(self) -> bool:
+        return self.kind in ("blank", "closing")
+
+    @property
+    def lines(self) -> List[str]:
+        return [line.strip() for line in self.text.splitlines() if line.strip()]
+
+
+def page_dhash(page: fitz.Page) -> int:
+    """
+    页面的差异哈希（dHash）
+
+    以约 64 像素的灰度缩略图渲染（开销远小于正常渲染），缩放到 9x8 后
+    比较每行相邻像素的明暗，得到 64 位指纹；版式相近的页面汉明距离小。
+    """
+    zoom = 64 / max(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    thumbnail = Image.frombuffer("L", (pix.width, pix.height), pix.samples, "raw", "L", pix.stride, 1)
+    pixels = list(thumbnail.resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def profile_page(doc: fitz.Document, page_number: int) -> PageProfile:
+    """读取文本层、图像数和矢量绘图数对页面分类，并计算缩略图指纹"""
+    page = doc[page_number - 1]
+    text = page.get_text("text").strip()
+    image_count = len(page.get_images())
+    drawing_count = len(page.get_cdrawings())
+    dhash = page_dhash(page)
+
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    compact = " ".join(lines)
+    # 模板装饰通常只有少量线条/色块；表格、示意图的绘图数明显更多
+    has_graphics = image_count > 0 or drawing_count > settings.text_page_max_drawings
+
+    if not lines:
+        kind = "visual" if has_graphics else "blank"
+        page_type = "END" if kind == "blank" and page_number > 1 else "CONTENT"
+        return PageProfile(page_number, page_type, kind, text, image_count, drawing_count, dhash)
+
+    if page_number > 1 and image_count == 0 and len(compact) <= 60 and CLOSING_PATTERN.match(compact):
+        return PageProfile(page_number, "END", "closing", text, image_count, drawing_count, dhash)
+
+    if INDEX_PATTERN.match(lines[0]):
+        page_type = "INDEX"
+    elif page_number == 1 and len(lines) <= 6 and len(compact) <= 200:
+        page_type = "TITLE"
+    else:
+        page_type = "CONTENT"
+
+    kind = "visual" if has_graphics or _is_layout_sensitive(text) else "text"
+    return PageProfile(page_number, page_type, kind, text, image_count, drawing_count, dhash)
+
 
 class PDFParserService:
     """PDF 解析器 - 将页面渲染为图像"""
 
     def __init__(self, dpi: int = 150):
         self.dpi = dpi
-        print(f"✅ PDF 解析器已初始化 (PyMuPDF, DPI={dpi})")
+        self.documents = DocumentCache(
+            max_open=settings.pdf_max_open_documents,
+            idle_seconds=settings.pdf_document_idle_seconds,
+        )
+        self.pool_size = settings.render_pool_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        print(f"✅ PDF 解析器已初始化 (PyMuPDF, DPI={dpi}, 渲染进程数={self.pool_size})")
 
-    async def extract_page_as_image(self, file_path: str, page_number: int) -> Image.Image:
-        """提取页面为 PIL 图像"""
-        doc = fitz.open(file_path)
-        try:
-            if not (1 <= page_number <= len(doc)):
-                raise ValueError(f"页码超出范围: {page_number} (总页数: {len(doc)})")
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        """按需创建渲染进程池（pool_size 为 0 时在线程中渲染）"""
+        if self.pool_size <= 0:
+            return None
+        if self._pool is None:
+            # spawn：避免 fork 继承事件循环线程和已打开的文档句柄
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.pool_size,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def shutdown(self):
+        """关闭渲染进程池和文档句柄"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self.documents.close_all()
+
+    def _resolve_format(self, fmt: Optional[str], quality: Optional[int]) -> tuple[str, Optional[int]]:
+        fmt = (fmt or settings.page_image_format).lower()
+        if fmt not in IMAGE_MIME_TYPES:
+            raise ValueError(f"不支持的图像格式: {fmt}，支持: {list(IMAGE_MIME_TYPES)}")
+        # 无损格式不区分质量
+        quality = None if fmt == "png" else (quality or settings.page_image_quality)
+        return fmt, quality
 
-            page = doc[page_number - 1]  # 0-based 索引
-            zoom = self.dpi / 72  # 72 DPI 默认值
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
+    async def render_page(
+        self,
+        file_path: str,
+        page_number: int,
+        pdf_id: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+    ) -> RenderedPage:
+        """
+        渲染页面为已编码的图像字节（可直接上传给模型或写入导出文件）
 
-            img_data = pix.tobytes("png")
-            return Image.open(io.BytesIO(img_data))
+        启用进程池时在子进程中渲染，多个并发调用可利用多核。
+
+        Args:
+            file_path: PDF 文件路径
+            page_number: 页码（1-based）
+            pdf_id: 提供时优先读取/写入磁盘缓存
+            fmt: 编码格式 png/jpeg/webp，默认使用配置
+            quality: 有损格式的质量，默认使用配置
+        """
+        fmt, quality = self._resolve_format(fmt, quality)
+
+        if pdf_id:
+            cached = await asyncio.to_thread(self._load_cached, pdf_id, page_number, fmt, quality)
+            if cached is not None:
+                return cached
+
+        data, width, height = await self._render_encoded(file_path, page_number, fmt, quality)
+
+        if pdf_id:
+            await asyncio.to_thread(
+                page_image_cache.put, pdf_id, page_number, self.dpi, fmt, data, quality
+            )
+        return RenderedPage(page_number, data, IMAGE_MIME_TYPES[fmt], width, height)
+
+    async def iter_pages(
+        self,
+        file_path: str,
+        page_numbers: List[int],
+        pdf_id: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+        ahead: int = 4,
+    ) -> AsyncIterator[tuple[int, Union[RenderedPage, Exception]]]:
+        """
+        按顺序逐页产出渲染结果，同时最多提前并行渲染 ahead 页
+
+        内存中最多保留 ahead 页图像，适合流式导出任意页数的文档。
+        渲染失败的页面以异常对象产出，迭代提前结束时取消未完成的渲染。
+        """
+        ahead = max(1, ahead)
+        pending: deque[tuple[int, asyncio.Task]] = deque()
+        remaining = iter(page_numbers)
+
+        def schedule_next():
+            page_number = next(remaining, None)
+            if page_number is not None:
+                task = asyncio.create_task(
+                    self.render_page(file_path, page_number, pdf_id, fmt, quality)
+                )
+                pending.append((page_number, task))
+
+        try:
+            for _ in range(ahead):
+                schedule_next()
+            while pending:
+                page_number, task = pending.popleft()
+                try:
+                    result = await task
+                except Exception as e:
+                    result = e
+                schedule_next()
+                yield page_number, result
         finally:
-            doc.close()
-
-    async def parse_single_page(self, file_path: str, page_number: int) -> Image.Image:
-        """解析单个页面（返回图像）"""
-        return await self.extract_page_as_image(file_path, page_number)
-
-    def _generate_pdf_id(self, file_path: str) -> str:
-        """生成 PDF 唯一 ID (SHA256)"""
-        sha256 = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
+            for _, task in pending:
+                task.cancel()
+
+    def _load_cached(
+        self, pdf_id: str, page_number: int, fmt: str, quality: Optional[int]
+    ) -> Optional[RenderedPage]:
+        data = page_image_cache.get(pdf_id, page_number, self.dpi, fmt, quality)
+        if data is None:
+            return None
+        return RenderedPage.from_bytes(page_number, data, fmt)
+
+    async def _render_encoded(
+        self, file_path: str, page_number: int, fmt: str, quality: Optional[int]
+    ) -> tuple[bytes, int, int]:
+        """渲染并编码页面：优先使用进程池，进程池不可用时退回线程渲染"""
+        pool = self._get_pool()
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(
+                    pool, render_encoded_in_worker, file_path, page_number, self.dpi, fmt, quality
+                )
+            except BrokenProcessPool:
+                print("⚠️ 渲染进程池异常退出，重建进程池并在线程中渲染本页")
+                if self._pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = None
+        return await asyncio.to_thread(self._render_encoded_local, file_path, page_number, fmt, quality)
+
+    def _render_encoded_local(
+        self, file_path: str, page_number: int, fmt: str, quality: Optional[int]
+    ) -> tuple[bytes, int, int]:
+        with self.documents.open(file_path) as doc:
+            pix = render_pixmap(doc, page_number, self.dpi)
+            return encode_pixmap(pix, fmt, quality), pix.width, pix.height
+
+    @staticmethod
+    def pdf_id_from_hash(sha256) -> str:
+        """由文件内容的 SHA256 哈希对象得到 PDF ID（上传时增量计算，无需回读文件）"""
         return sha256.hexdigest()[:16]
 
+    async def classify_pages(self, file_path: str, page_numbers: List[int]) -> Dict[int, PageProfile]:
+        """批量分类页面（一次借出文档句柄，在线程中执行）"""
+        return await asyncio.to_thread(self._classify_pages, file_path, page_numbers)
+
+    def _classify_pages(self, file_path: str, page_numbers: List[int]) -> Dict[int, PageProfile]:
+        with self.documents.open(file_path) as doc:
+            return {p: profile_page(doc, p) for p in page_numbers}
+
     def get_page_count(self, file_path: str) -> int:
         """获取总页数"""
-        doc = fitz.open(file_path)
-        count = len(doc)
-        doc.close()
-        return count
+        with self.documents.open(file_path) as doc:
+            return len(doc)
 
 
 # 全局单例
@@ -0,0 +1,794 @@
+"""页面处理引擎 - 有界并发的后台页面分析"""
+import asyncio
+import os
+import socket
+import time
+import traceback
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Union
+
+from app.config import get_settings
+from app.models.database import AsyncSessionLocal
+from app.models.schemas import ProcessingProgress
+from app.services.cache_service import cache_service
+from app.services.event_bus import event_bus
+from app.services.page_stream import BatchStreamSplitter, PageStream, page_streams
+from app.services.pdf_parser import pdf_parser, PageProfile, RenderedPage
+from app.services.job_queue import job_queue
+from app.services.llm_service import (
+    GeminiService, PAGE_MARKER_PATTERN, llm_service, create_llm_service,
+)
+
+settings = get_settings()
+
+
+async def publish_progress(pdf_id: str):
+    """向订阅者推送当前进度（无订阅者时跳过查询）"""
+    if not event_bus.subscriber_count(pdf_id):
+        return
+    async with AsyncSessionLocal() as db:
+        pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
+    if pdf_doc:
+        event_bus.publish(pdf_id, {
+            "type": "progress",
+            **ProcessingProgress.from_document(pdf_doc).model_dump(),
+        })
+
+
+async def set_job_status(
+    pdf_id: str, status: str, processed_pages: int, selected_pages_count: Optional[int] = None
+):
+    """写入处理状态并推送进度事件"""
+    async with AsyncSessionLocal() as db:
+        await cache_service.update_processing_status(
+            db, pdf_id, status, processed_pages, selected_pages_count
+        )
+    await publish_progress(pdf_id)
+
+
+def trivial_page_explanation(profile: PageProfile) -> str:
+    """空白页/结束页的模板解释（不调用 LLM）"""
+    if profile.kind == "blank":
+        return f"## 第 {profile.page_number} 页\n\n本页为空白页，没有需要讲解的内容。"
+    closing = " ".join(profile.text.split())
+    return f"## 第 {profile.page_number} 页\n\n本页为结束页（“{closing}”），没有需要讲解的内容。"
+
+
+def is_build_step(
+    previous: PageProfile,
+    current: PageProfile,
+    max_distance: int,
+    sparse_max_distance: int = 4,
+    min_text_chars: int = 40,
+) -> bool:
+    """
+    current 是否是 previous 的下一个动画分步
+
+    要求：
+    - 两页都不是空白/结束页
+    - 文字只增不减（previous 的每一行都出现在 current 中）
+    - current 严格增加了内容：更多文字行，或更多图片/矢量绘图
+    - 缩略图指纹足够接近；previous 文字很少（如只有共同的标题）时，
+      文字包含关系说明不了什么，改用 sparse_max_distance 这一严格得多的阈值
+    """
+    if previous.is_trivial or current.is_trivial:
+        return False
+    previous_lines, current_lines = previous.lines, current.lines
+    if not previous_lines:
+        return False
+    if Counter(previous_lines) - Counter(current_lines):
+        return False
+
+    adds_content = (
+        len(current_lines) > len(previous_lines)
+        or current.image_count > previous.image_count
+        or current.drawing_count > previous.drawing_count
+    )
+    if not adds_content:
+        return False
+
+    distance = bin(previous.dhash ^ current.dhash).count("1")
+    if len("".join(previous_lines)) < min_text_chars:
+        return distance <= sparse_max_distance
+    return distance <= max_distance
+
+
+def group_build_slides(
+    profiles: Dict[int, PageProfile],
+    max_distance: int,
+    sparse_max_distance: int = 4,
+    min_text_chars: int = 40,
+) -> List[List[int]]:
+    """
+    将连续的动画分步页分组（判定条件见 is_build_step）
+
+    Returns:
+        至少两页的分组列表；每组最后一页内容最完整
+    """
+    groups: List[List[int]] = []
+    current: List[int] = []
+    for page_number in sorted(profiles):
+        if (
+            current
+            and page_number == current[-1] + 1
+            and is_build_step(
+                profiles[current[-1]], profiles[page_number],
+                max_distance, sparse_max_distance, min_text_chars,
+            )
+        ):
+            current.append(page_number)
+            continue
+        if len(current) > 1:
+            groups.append(current)
+        current = [page_number]
+    if len(current) > 1:
+        groups.append(current)
+    return groups
+
+
+def build_step_explanation(
+    profile: PageProfile, previous: Optional[PageProfile], anchor: int, step: int, total: int
+) -> str:
+    """动画分步页的增量说明：指向完整页的讲解，列出本步新出现的内容"""
+    added = list((Counter(profile.lines) - Counter(previous.lines if previous else [])).elements())
+    # 保持原有行序
+    added_in_order, remaining = [], Counter(added)
+    for line in profile.lines:
+        if remaining[line] > 0:
+            added_in_order.append(line)
+            remaining[line] -= 1
+
+    body = "\n".join(f"- {line}" for line in added_in_order) or "- （仅有版式或动画变化）"
+    return (
+        f"## 第 {profile.page_number} 页\n\n"
+        f"> 本页是第 {anchor} 页的动画分步（第 {step}/{total} 步），完整讲解见第 {anchor} 页。\n\n"
+        f"**本步新出现的内容：**\n\n{body}\n"
+    )
+
+
+def split_into_segments(page_numbers: List[int], max_concurrent: int) -> List[List[int]]:
+    """
+    将页码划分为最多 max_concurrent 个连续片段
+
+    每个片段由一个 worker 按顺序处理，片段内后一页可以用到前一页刚生成的摘要，
+    只有片段首页拿不到前文上下文。各片段的第 i 页构成第 i 波并发请求。
+
+    Args:
+        page_numbers: 要处理的页码列表
+        max_concurrent: 最大并发数
+
+    Returns:
+        连续页码片段列表
+    """
+    pages = sorted(set(page_numbers))
+    if not pages:
+        return []
+
+    count = max(1, min(max_concurrent, len(pages)))
+    size, extra = divmod(len(pages), count)
+
+    segments = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        segments.append(pages[start:end])
+        start = end
+    return segments
+
+
+class JobProgress:
+    """
+    任务进度与逐页状态
+
+    完成数和逐页状态（开始、完成、失败）在内存中累积，每 progress_flush_pages 页
+    或每 progress_flush_interval 秒在同一个事务中合并写入一次数据库；
+    加锁保证页面乱序完成时写入值单调递增。
+    页面开始时的尝试计数同样延迟写入：进程在写入前崩溃时，该次尝试不计入页面的尝试上限。
+    """
+
+    def __init__(self, pdf_id: str, total: int, job_id: Optional[str] = None):
+        self.pdf_id = pdf_id
+        self.total = total
+        self.job_id = job_id
+        self.processed = 0
+        self._flushed = 0
+        self._started: List[int] = []
+        self._states: Dict[str, List[int]] = {}
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def start_page(self, page_number: int):
+        """页面开始处理：计入一次尝试（随下次进度写入落库）"""
+        async with self._lock:
+            self._started.append(page_number)
+
+    async def settle(self, page_numbers: List[int], state: str):
+        """记录页面结束（done / failed），达到批量阈值时写入数据库"""
+        async with self._lock:
+            self._states.setdefault(state, []).extend(page_numbers)
+            if state == "done":
+                self.processed += len(page_numbers)
+            due = (
+                self.processed - self._flushed >= settings.progress_flush_pages
+                or time.monotonic() - self._last_flush >= settings.progress_flush_interval
+            )
+            if due:
+                await self._flush_locked()
+
+    async def flush(self):
+        """立即写入尚未落库的进度"""
+        async with self._lock:
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        pages_dirty = self.job_id is not None and (self._started or self._states)
+        if self.processed == self._flushed and not pages_dirty:
+            return
+        async with AsyncSessionLocal() as db:
+            if pages_dirty:
+                await job_queue.record_pages(db, self.job_id, self._started, self._states)
+            # 提交时逐页状态与进度一起生效
+            await cache_service.update_processing_status(db, self.pdf_id, "processing", self.processed)
+        self._started = []
+        self._states = {}
+        self._flushed = self.processed
+        self._last_flush = time.monotonic()
+        await publish_progress(self.pdf_id)
+
+
+class PagePrefetcher:
+    """
+    页面渲染预取（生产者/消费者）
+
+    生产者按顺序提前渲染页面放入有界队列，消费者调用 LLM 时下一页已在渲染；
+    队列满时生产者阻塞（背压），内存中最多保留 depth 张待分析的图像。
+    渲染失败的页面以异常对象的形式交给消费者处理；skip 中的页面不渲染，以 None 交出。
+    """
+
+    def __init__(
+        self, pdf_id: str, file_path: str, page_numbers: List[int], depth: int = 2,
+        skip: Optional[set] = None,
+    ):
+        self.pdf_id = pdf_id
+        self.file_path = file_path
+        self.page_numbers = page_numbers
+        self.skip = skip or set()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, depth))
+        self._producer: Optional[asyncio.Task] = None
+        self._remaining = len(page_numbers)
+
+    async def _produce(self):
+        for page_number in self.page_numbers:
+            if page_number in self.skip:
+                await self._queue.put((page_number, None))
+                continue
+            try:
+                result = await pdf_parser.render_page(self.file_path, page_number, self.pdf_id)
+            except Exception as e:
+                result = e
+            await self._queue.put((page_number, result))
+
+    async def __aenter__(self) -> "PagePrefetcher":
+        self._producer = asyncio.create_task(self._produce())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._producer and not self._producer.done():
+            self._producer.cancel()
+            try:
+                await self._producer
+            except asyncio.CancelledError:
+                pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[int, Union[RenderedPage, Exception, None]]:
+        if self._remaining == 0:
+            raise StopAsyncIteration
+        self._remaining -= 1
+        return await self._queue.get()
+
+
+class PageProcessor:
+    """单个 PDF 处理任务：按片段并发处理选定页面"""
+
+    def __init__(
+        self,
+        pdf_id: str,
+        file_path: str,
+        llm: GeminiService,
+        model_name: str,
+        page_numbers: List[int],
+        max_concurrent_pages: int = 1,
+        job_id: Optional[str] = None,
+        pages_per_request: int = 1,
+    ):
+        self.pdf_id = pdf_id
+        self.file_path = file_path
+        self.llm = llm
+        self.model_name = model_name
+        self.page_numbers = page_numbers
+        self.max_concurrent_pages = max(1, max_concurrent_pages)
+        self.job_id = job_id
+        # 大于 1 时连续的普通页面合并为一次 LLM 请求
+        self.pages_per_request = max(1, pages_per_request)
+        self.progress = JobProgress(pdf_id, len(page_numbers), job_id)
+        self.summaries: Dict[int, str] = {}
+        self.profiles: Dict[int, PageProfile] = {}
+        self.text_fast_path = settings.page_text_fast_path
+        # 动画分步组：组内最完整一页 -> 组首页（分析时从组首页之前取上下文）
+        self.group_starts: Dict[int, int] = {}
+        # 已完成或已失败的页面；任务中断时其余页面的订阅者收到 error
+        self.settled: set = set()
+
+    async def run(self) -> int:
+        """
+        执行处理任务
+
+        Returns:
+            成功处理的页数
+        """
+        # 一次查询载入所有已缓存页面的摘要：既用于批量跳过，也作为前文上下文来源
+        async with AsyncSessionLocal() as db:
+            self.summaries = await cache_service.get_page_summaries(db, self.pdf_id)
+
+        pending = [p for p in self.page_numbers if p not in self.summaries]
+        cached = [p for p in self.page_numbers if p in self.summaries]
+        if cached:
+            print(f"✅ {len(cached)} 页已有缓存，跳过")
+            await self._set_page_state(cached, "done")
+
+        if pending and (self.text_fast_path or settings.build_slide_grouping):
+            await self._classify(pending)
+        if self.profiles and settings.build_slide_grouping:
+            pending = await self._collapse_build_slides(pending)
+
+        segments = split_into_segments(pending, self.max_concurrent_pages)
+        if segments:
+            print(f"  ⚙️ 并发度 {len(segments)}，片段: {[f'{s[0]}-{s[-1]}' for s in segments]}")
+
+        try:
+            await asyncio.gather(*(self._run_segment(segment) for segment in segments))
+        except BaseException as e:
+            # 任务取消（进程关闭、租约丢失）或出错：尚未结束的页面不会再有事件，通知等待中的订阅者
+            unsettled = [p for p in self.page_numbers if p not in self.settled]
+            message = "处理任务已中断" if isinstance(e, asyncio.CancelledError) else str(e)
+            page_streams.abort(self.pdf_id, unsettled, message)
+            raise
+        finally:
+            await self.progress.flush()
+        return self.progress.processed
+
+    async def _classify(self, page_numbers: List[int]):
+        """用文本层对待处理页面分类；失败时全部按图像处理"""
+        try:
+            self.profiles = await pdf_parser.classify_pages(self.file_path, page_numbers)
+        except Exception as e:
+            print(f"⚠️ 页面分类失败，全部按图像处理: {str(e)}")
+            return
+        counts: Dict[str, int] = {}
+        for profile in self.profiles.values():
+            counts[profile.kind] = counts.get(profile.kind, 0) + 1
+        print(f"  🔎 页面分类: {counts}")
+
+    async def _collapse_build_slides(self, pending: List[int]) -> List[int]:
+        """
+        合并动画分步页：每组只保留最完整的一页交给 LLM，其余页写入增量说明
+
+        Returns:
+            仍需分析的页面
+        """
+        groups = group_build_slides(
+            self.profiles,
+            settings.build_slide_max_hash_distance,
+            settings.build_slide_sparse_hash_distance,
+            settings.build_slide_min_text_chars,
+        )
+        if not groups:
+            return pending
+
+        steps = []
+        for group in groups:
+            anchor = group[-1]
+            self.group_starts[anchor] = group[0]
+            for step, page_number in enumerate(group[:-1], start=1):
+                previous = self.profiles[group[step - 2]] if step > 1 else None
+                markdown = build_step_explanation(
+                    self.profiles[page_number], previous, anchor, step, len(group)
+                )
+                steps.append((page_number, markdown))
+
+        print(f"  🎞️ 动画分步页: {[f'{g[0]}-{g[-1]}' for g in groups]}，省去 {len(steps)} 次分析")
+        for page_number, markdown in steps:
+            try:
+                # 分步页不提供摘要，避免重复内容挤占后续页面的上下文
+                await self._save_page(page_number, markdown, "", self.profiles[page_number].page_type)
+                await self._set_page_state([page_number], "done")
+            except Exception as e:
+                print(f"❌ 保存第 {page_number} 页分步说明失败: {str(e)}")
+                await self._set_page_state([page_number], "failed")
+
+        skipped = {page_number for page_number, _ in steps}
+        return [p for p in pending if p not in skipped]
+
+    def _needs_image(self, page_number: int) -> bool:
+        profile = self.profiles.get(page_number)
+        return not self.text_fast_path or profile is None or profile.kind == "visual"
+
+    def _batchable(self, page_number: int, page_image) -> bool:
+        """可以与相邻页面合并请求的页面：非模板页、非动画分步组"""
+        if self.pages_per_request <= 1 or isinstance(page_image, Exception):
+            return False
+        if page_number in self.group_starts:
+            return False
+        profile = self.profiles.get(page_number)
+        if self.text_fast_path and profile is not None and profile.is_trivial:
+            return False
+        return page_image is not None or profile is not None
+
+    async def _run_segment(self, segment: List[int]):
+        """顺序处理一个连续片段，页面边渲染边分析（纯文字页和空白页不渲染）"""
+        skip = {p for p in segment if not self._needs_image(p)}
+        batch: List[Tuple[int, Optional[RenderedPage]]] = []
+        async with PagePrefetcher(
+            self.pdf_id, self.file_path, segment, settings.render_prefetch_depth, skip
+        ) as pages:
+            async for page_number, page_image in pages:
+                if self._batchable(page_number, page_image):
+                    batch.append((page_number, page_image))
+                    if len(batch) >= self.pages_per_request:
+                        await self._process_batch(batch)
+                        batch = []
+                    continue
+                if batch:
+                    await self._process_batch(batch)
+                    batch = []
+                await self._process_page(page_number, page_image)
+        if batch:
+            await self._process_batch(batch)
+
+    async def _process_page(
+        self, page_number: int, page_image: Union[RenderedPage, Exception, None],
+        count_attempt: bool = True,
+    ):
+        """处理单个页面；失败只记录，不影响片段中的后续页面"""
+        try:
+            if isinstance(page_image, Exception):
+                # 渲染失败时该页的生成流尚未开始，直接通知订阅者
+                page_streams.abort(self.pdf_id, [page_number], f"页面渲染失败: {page_image}")
+                raise page_image
+            if count_attempt:
+                await self.progress.start_page(page_number)
+            # 限流由 GeminiService 内共享的限流器负责，这里无需额外延迟
+            await self._analyze_page(page_number, page_image)
+            await self._set_page_state([page_number], "done")
+        except Exception as e:
+            print(f"❌ 处理第 {page_number} 页失败: {str(e)}")
+            print(f"  详细错误: {traceback.format_exc()}")
+            await self._set_page_state([page_number], "failed")
+
+    async def _process_batch(self, batch: List[Tuple[int, Optional[RenderedPage]]]):
+        """
+        一次请求分析多个页面
+
+        输出按分隔标记拆分到各页；请求失败或某页未能拆分出有效内容时，
+        这些页面退回逐页分析。
+        """
+        if len(batch) == 1:
+            await self._process_page(*batch[0])
+            return
+
+        page_numbers = [page_number for page_number, _ in batch]
+        streams: Dict[int, PageStream] = {}
+        results: Dict[int, str] = {}
+        try:
+            for page_number in page_numbers:
+                await self.progress.start_page(page_number)
+                streams[page_number] = page_streams.start(self.pdf_id, page_number)
+
+            print(f"  🤖 正在由 {self.model_name} 模型合并分析第 {page_numbers[0]}-{page_numbers[-1]} 页...")
+            results = await self.llm.analyze_batch(
+                pages=[
+                    (page_number, page_image if page_image is not None else self.profiles[page_number].text)
+                    for page_number, page_image in batch
+                ],
+                previous_summaries=self._previous_summaries(page_numbers[0]),
+                temperature=settings.temperature,
+                max_tokens=settings.max_tokens,
+                stream=BatchStreamSplitter(streams, PAGE_MARKER_PATTERN),
+            )
+        except Exception as e:
+            print(f"⚠️ 第 {page_numbers[0]}-{page_numbers[-1]} 页合并请求失败，改为逐页分析: {str(e)}")
+        except BaseException as e:
+            for stream in streams.values():
+                stream.fail(str(e) or type(e).__name__)
+            raise
+
+        for page_number, page_image in batch:
+            stream = streams.get(page_number)
+            markdown_content = results.get(page_number)
+            if markdown_content is None:
+                if stream is not None:
+                    stream.reset()
+                print(f"  ↩️ 第 {page_number} 页未从合并结果中拆分出内容，单独分析")
+                await self._process_page(page_number, page_image, count_attempt=False)
+                continue
+
+            profile = self.profiles.get(page_number)
+            try:
+                summary = self.llm.extract_summary(markdown_content, page_number)
+                await self._save_page(
+                    page_number, markdown_content, summary,
+                    profile.page_type if profile else "CONTENT", stream,
+                )
+                await self._set_page_state([page_number], "done")
+                print(f"✅ 第 {page_number} 页处理完成")
+            except Exception as e:
+                print(f"❌ 保存第 {page_number} 页失败: {str(e)}")
+                await self._set_page_state([page_number], "failed")
+
+    async def _set_page_state(self, page_numbers: List[int], state: str):
+        """记录页面结束：完成的页面计入进度，逐页状态随进度批量写入（非队列任务时只计进度）"""
+        self.settled.update(page_numbers)
+        await self.progress.settle(page_numbers, state)
+
+    def _previous_summaries(self, page_number: int, max_pages: int = 3) -> List[str]:
+        """从预载的摘要中取前 max_pages 页作为上下文"""
+        start_page = max(1, page_number - max_pages)
+        return [
+            self.summaries[p] for p in range(start_page, page_number)
+            if self.summaries.get(p)
+        ]
+
+    async def _save_page(
+        self, page_number: int, markdown_content: str, summary: str, page_type: str,
+        stream: Optional[PageStream] = None,
+    ):
+        """保存页面解释并通知订阅者"""
+        stream = stream or page_streams.start(self.pdf_id, page_number)
+        try:
+            async with AsyncSessionLocal() as db:
+                await cache_service.save_markdown_explanation(
+                    db, self.pdf_id, page_number, markdown_content, summary, page_type
+                )
+        except BaseException as e:
+            stream.fail(str(e) or type(e).__name__)
+            raise
+        stream.finish(markdown_content, summary)
+        self.summaries[page_number] = summary
+        event_bus.publish(self.pdf_id, {"type": "page", "page_number": page_number})
+
+    async def _analyze_page(self, page_number: int, page_image: Optional[RenderedPage]):
+        """分析单个页面并保存结果（page_image 为 None 时按页面分类走文本或模板）"""
+        # 获取前面页面的摘要作为上下文（动画分步组从组首页之前取）
+        previous_summaries = self._previous_summaries(self.group_starts.get(page_number, page_number))
+        profile = self.profiles.get(page_number)
+        page_type = profile.page_type if profile else "CONTENT"
+
+        # 调用 LLM 生成解释，生成过程实时推送给订阅该页的客户端
+        stream = page_streams.start(self.pdf_id, page_number)
+        try:
+            if self.text_fast_path and profile is not None and profile.is_trivial:
+                print(f"  📄 第 {page_number} 页为{'空白页' if profile.kind == 'blank' else '结束页'}，使用模板")
+                markdown_content = trivial_page_explanation(profile)
+                summary = ""  # 不作为后续页面的上下文
+            else:
+                if page_image is None:
+                    print(f"  🤖 正在由 {self.model_name} 模型分析第 {page_number} 页（文本层）...")
+                    markdown_content = await self.llm.analyze_text(
+                        text=profile.text,
+                        page_num=page_number,
+                        previous_summaries=previous_summaries,
+                        temperature=settings.temperature,
+                        max_tokens=settings.max_tokens,
+                        stream=stream,
+                    )
+                else:
+                    print(f"  🤖 正在由 {self.model_name} 模型分析第 {page_number} 页...")
+                    markdown_content = await self.llm.analyze_image(
+                        image=page_image,
+                        page_num=page_number,
+                        previous_summaries=previous_summaries,
+                        temperature=settings.temperature,
+                        max_tokens=settings.max_tokens,
+                        stream=stream,
+                    )
+
+                # 提取摘要
+                summary = self.llm.extract_summary(markdown_content, page_number)
+        except BaseException as e:
+            stream.fail(str(e) or type(e).__name__)
+            raise
+
+        # 生成结束后一次性保存到缓存
+        await self._save_page(page_number, markdown_content, summary, page_type, stream)
+
+        print(f"✅ 第 {page_number} 页处理完成")
+
+
+def create_job_llm(model: str, api_key: Optional[str]) -> GeminiService:
+    """为任务创建 LLM 服务：用户 Key > 服务器默认 Key > 全局配置"""
+    api_key = api_key or settings.default_api_key
+    if api_key:
+        return create_llm_service(api_key=api_key, model=model)
+    # 向后兼容：使用全局配置
+    return llm_service
+
+
+class JobWorker:
+    """
+    任务执行器：从持久化队列认领任务并运行
+
+    每个进程一个实例，多进程共享同一数据库时各自认领任务；租约保证同一任务
+    同时只在一个进程中运行。持有者每 1/3 租约续约一次，进程崩溃后租约过期，
+    任务由其他（或重启后的）进程重新认领，已完成的页面通过解释缓存跳过。
+    """
+
+    def __init__(self, concurrency: int):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.concurrency = max(1, concurrency)
+        self._last_maintenance = 0.0
+        self._running: Dict[str, asyncio.Task] = {}
+        self._lost_leases: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """启动认领循环（在事件循环内调用）"""
+        self._wakeup = asyncio.Event()
+        self._loop_task = asyncio.create_task(self._claim_loop())
+        print(f"✅ 任务执行器已启动: {self.worker_id}，并发任务数 {self.concurrency}")
+
+    async def stop(self):
+        """停止认领并取消运行中的任务，交还租约以便重启后立即续跑"""
+        if self._loop_task:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def notify(self):
+        """有新任务入队时唤醒认领循环"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _maintain(self):
+        """每 1/3 租约一次：为排队中的客户端 Key 任务续约，并处理持有进程已退出的任务"""
+        now = time.monotonic()
+        if now - self._last_maintenance < settings.job_lease_seconds / 3:
+            return
+        self._last_maintenance = now
+        try:
+            await job_queue.renew_held(self.worker_id)
+            for job_id, pdf_id in await job_queue.park_orphaned():
+                print(f"⏹️ 任务 {job_id} 的 API Key 已随进程退出丢失，需客户端重新提交")
+                async with AsyncSessionLocal() as db:
+                    pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
+                await set_job_status(pdf_id, "failed", pdf_doc.processed_pages if pdf_doc else 0)
+        except Exception as e:
+            print(f"⚠️ 任务队列维护失败: {str(e)}")
+
+    async def _claim_loop(self):
+        while True:
+            await self._maintain()
+            job = None
+            if len(self._running) < self.concurrency:
+                try:
+                    job = await job_queue.claim(self.worker_id)
+                except Exception as e:
+                    print(f"⚠️ 认领任务失败: {str(e)}")
+
+            if job is not None:
+                task = asyncio.create_task(self._run(job))
+                self._running[job.id] = task
+                task.add_done_callback(lambda _, job_id=job.id: self._on_done(job_id))
+                continue  # 可能还有更多待认领的任务
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.job_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, job_id: str):
+        self._running.pop(job_id, None)
+        self._lost_leases.discard(job_id)
+        self.notify()
+
+    async def _keep_lease(self, job_id: str, run_task: asyncio.Task):
+        """定期续约；租约丢失时取消本地运行，避免两个进程同时处理"""
+        interval = settings.job_lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                renewed = await job_queue.renew(job_id, self.worker_id)
+            except Exception as e:
+                print(f"⚠️ 任务 {job_id} 续约失败: {str(e)}")
+                continue  # 暂时性错误，租约过期前还有两次机会
+            if not renewed:
+                print(f"⚠️ 任务 {job_id} 的租约已被其他进程取得，停止本地处理")
+                self._lost_leases.add(job_id)
+                run_task.cancel()
+                return
+
+    async def _run(self, job):
+        keeper = asyncio.create_task(self._keep_lease(job.id, asyncio.current_task()))
+        try:
+            await self._execute(job)
+        except asyncio.CancelledError:
+            if job.id not in self._lost_leases:
+                # 进程关闭：交还租约，文档保持 processing 状态，重启后续跑
+                await job_queue.release(job.id, self.worker_id)
+                print(f"⏸️ 任务 {job.id} 已中断，等待重新认领")
+            raise
+        finally:
+            keeper.cancel()
+
+    async def _execute(self, job):
+        """运行一个已认领的任务"""
+        pdf_id = job.pdf_id
+        if job.attempts > settings.job_max_attempts:
+            print(f"❌ 任务 {job.id} 已被认领 {job.attempts} 次，放弃")
+            await set_job_status(pdf_id, "failed", 0)
+            await job_queue.finish(job.id, self.worker_id, "failed", "超过最大重试次数")
+            return
+
+        async with AsyncSessionLocal() as db:
+            pdf_doc = await cache_service.get_pdf_metadata(db, pdf_id)
+        if not pdf_doc:
+            await job_queue.finish(job.id, self.worker_id, "failed", "PDF 未找到")
+            return
+
+        page_numbers = await job_queue.prepare_resume(job.id, settings.job_page_max_attempts)
+        resumed = " (续跑)" if job.attempts > 1 else ""
+        print(f"🚀 开始后台处理 PDF: {pdf_id}{resumed}, 处理 {len(page_numbers)} 页: {page_numbers}")
+        print(f"  📡 模型: {job.model}")
+
+        processor = PageProcessor(
+            pdf_id=pdf_id,
+            file_path=pdf_doc.file_path,
+            llm=create_job_llm(job.model, job_queue.api_key(job.id)),
+            model_name=job.model,
+            page_numbers=page_numbers,
+            max_concurrent_pages=job.max_concurrent_pages or 1,
+            job_id=job.id,
+            pages_per_request=job.pages_per_request or 1,
+        )
+
+        try:
+            # 更新状态为处理中；续跑时已失败的页面不再处理，进度按本次页数重新计算
+            await set_job_status(pdf_id, "processing", 0, len(page_numbers))
+
+            processed_count = await processor.run()
+
+            # 处理完成
+            await set_job_status(pdf_id, "completed", processed_count)
+            await job_queue.finish(job.id, self.worker_id, "completed")
+            print(f"🎉 PDF {pdf_id} 选定页面全部处理完成 ({processed_count}/{len(page_numbers)})")
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            print(f"❌ 后台处理失败: {str(e)}")
+            print(f"  详细错误: {traceback.format_exc()}")
+            try:
+                await set_job_status(pdf_id, "failed", processor.progress.processed)
+                await job_queue.finish(job.id, self.worker_id, "failed", str(e)[:500])
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {"worker_id": self.worker_id, "running": len(self._running)}
+
+
+# 全局单例
+job_worker = JobWorker(settings.job_worker_concurrency)
@@ -0,0 +1,200 @@
+"""Gemini 限流服务 - 按 (API Key, 模型) 共享的令牌桶，遇到 429 自适应降速"""
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from google.api_core import exceptions as google_exceptions
+
+from app.config import get_settings
+
+settings = get_settings()
+
+# 自适应速率系数的下限：连续 429 时最多降到基础速率的 1/8
+MIN_RATE_SCALE = 0.125
+# 每次成功请求恢复的速率系数
+RATE_RECOVERY_STEP = 0.05
+# 未从错误中解析出 retry_delay 时的默认冷却时间（秒）
+DEFAULT_COOLDOWN_SECONDS = 10.0
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """判断是否为 429 / ResourceExhausted 错误"""
+    return isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests))
+
+
+def parse_retry_delay(error: Exception) -> Optional[float]:
+    """从错误信息中解析服务端建议的重试间隔（retry_delay { seconds: N }）"""
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟预算，按 预算/60 每秒匀速补充"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def resize(self, per_minute: float, now: float):
+        """调整每分钟预算（自适应降速/恢复）"""
+        self.refill(now)
+        self.capacity = per_minute
+        self.tokens = min(self.tokens, per_minute)
+
+    def wait_time(self, amount: float) -> float:
+        """获取 amount 个令牌还需等待的秒数"""
+        # 单次请求超过桶容量时按满桶处理，避免永远等不到
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class KeyRateLimiter:
+    """单个 (API Key, 模型) 的 RPM/TPM 限流器"""
+
+    def __init__(self, label: str, model: str, rpm: int, tpm: int):
+        self.label = label
+        self.model = model
+        self.base_rpm = rpm
+        self.base_tpm = tpm
+        self.scale = 1.0
+        self.cooldown_until = 0.0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # 锁在等待期间保持，使并发请求按到达顺序排队
+        self._lock = asyncio.Lock()
+        self.total_requests = 0
+        self.rate_limited_count = 0
+        self.total_wait_seconds = 0.0
+
+    async def acquire(self, estimated_tokens: int = 0):
+        """等待直到请求数和 token 预算都允许发出一次请求"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(
+                    self.cooldown_until - now,
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens),
+                )
+                if wait <= 0:
+                    break
+                self.total_wait_seconds += wait
+                await asyncio.sleep(wait)
+
+            self.requests.tokens -= 1
+            self.tokens.tokens -= min(estimated_tokens, self.tokens.capacity)
+            self.total_requests += 1
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """用实际消耗的 token 数校正预估值"""
+        if actual_tokens is None:
+            return
+        self.tokens.tokens -= actual_tokens - estimated_tokens
+
+    def on_success(self):
+        """请求成功：逐步恢复速率"""
+        if self.scale < 1.0:
+            self._rescale(min(1.0, self.scale + RATE_RECOVERY_STEP))
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        """收到 429：速率减半并进入冷却期"""
+        self.rate_limited_count += 1
+        self._rescale(max(MIN_RATE_SCALE, self.scale / 2))
+        now = time.monotonic()
+        self.cooldown_until = max(self.cooldown_until, now + (retry_after or DEFAULT_COOLDOWN_SECONDS))
+        self.requests.tokens = 0
+
+    def _rescale(self, scale: float):
+        now = time.monotonic()
+        self.scale = scale
+        self.requests.resize(max(1.0, self.base_rpm * scale), now)
+        self.tokens.resize(max(1.0, self.base_tpm * scale), now)
+
+    def snapshot(self) -> dict:
+        """当前桶状态"""
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return {
+            "api_key": self.label,
+            "model": self.model,
+            "rpm_limit": self.base_rpm,
+            "tpm_limit": self.base_tpm,
+            "rate_scale": round(self.scale, 3),
+            "available_requests": round(self.requests.tokens, 2),
+            "available_tokens": int(self.tokens.tokens),
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - now), 1),
+            "waiting": self._lock.locked(),
+            "total_requests": self.total_requests,
+            "rate_limited_count": self.rate_limited_count,
+            "total_wait_seconds": round(self.total_wait_seconds, 1),
+        }
+
+
+class RateLimiterRegistry:
+    """限流器注册表：同一 (API Key, 模型) 的所有任务共享一个限流器"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._limiters: "OrderedDict[tuple[str, str], KeyRateLimiter]" = OrderedDict()
+
+    @staticmethod
+    def _mask_key(api_key: str) -> str:
+        """日志/接口中只展示 API Key 的首尾"""
+        if len(api_key) <= 8:
+            return "***"
+        return f"{api_key[:4]}…{api_key[-4:]}"
+
+    def _limits_for(self, model: str) -> tuple[int, int]:
+        override = settings.llm_model_rate_limits.get(model, {})
+        return (
+            override.get("rpm", settings.llm_rpm_limit),
+            override.get("tpm", settings.llm_tpm_limit),
+        )
+
+    def get(self, api_key: str, model: str) -> KeyRateLimiter:
+        """获取（或创建）限流器"""
+        key = (hashlib.sha256(api_key.encode()).hexdigest(), model)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            rpm, tpm = self._limits_for(model)
+            limiter = KeyRateLimiter(self._mask_key(api_key), model, rpm, tpm)
+            self._limiters[key] = limiter
+            self._evict()
+        else:
+            self._limiters.move_to_end(key)
+        return limiter
+
+    def _evict(self):
+        # 只淘汰没有请求在排队的限流器
+        for key in list(self._limiters.keys()):
+            if len(self._limiters) <= self.max_entries:
+                break
+            if not self._limiters[key]._lock.locked():
+                del self._limiters[key]
+
+    def snapshot(self) -> list[dict]:
+        """所有限流器的当前状态"""
+        return [limiter.snapshot() for limiter in self._limiters.values()]
+
+
+# 全局单例
+rate_limiter = RateLimiterRegistry()
@@ -0,0 +1,83 @@
+"""页面渲染函数 - 可在主进程或渲染进程池中执行
+
+本模块只依赖 PyMuPDF 和 Pillow，子进程导入时不会初始化应用服务。
+"""
+import io
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+# 每个渲染子进程最多保持打开的文档数
+WORKER_MAX_OPEN_DOCUMENTS = 8
+
+# 渲染子进程内的文档句柄：{路径: (mtime, 文档)}，进程单线程，无需加锁
+_worker_documents: "OrderedDict[str, Tuple[int, fitz.Document]]" = OrderedDict()
+
+
+def render_pixmap(doc: fitz.Document, page_number: int, dpi: int) -> fitz.Pixmap:
+    """渲染页面为 RGB 像素图"""
+    if not (1 <= page_number <= len(doc)):
+        raise ValueError(f"页码超出范围: {page_number} (总页数: {len(doc)})")
+
+    page = doc[page_number - 1]  # 0-based 索引
+    zoom = dpi / 72  # 72 DPI 默认值
+    mat = fitz.Matrix(zoom, zoom)
+    return page.get_pixmap(matrix=mat, alpha=False)
+
+
+def pixmap_to_image(pix: fitz.Pixmap) -> Image.Image:
+    """
+    像素图直接构造 PIL 图像，不复制像素数据
+
+    samples_mv 是像素图内存的视图（samples 会复制一份 bytes），
+    返回的图像借用这块内存，只能在 pix 存活期间使用。
+    """
+    return Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+
+
+def encode_pixmap(pix: fitz.Pixmap, fmt: str, quality: Optional[int] = None) -> bytes:
+    """将像素图编码为指定格式"""
+    if fmt == "png":
+        return pix.tobytes("png")
+    if fmt == "jpeg":
+        return pix.tobytes("jpg", jpg_quality=quality or 85)
+    # PyMuPDF 不支持 WebP 输出，经由 PIL 编码
+    buffer = io.BytesIO()
+    pixmap_to_image(pix).save(buffer, format="WEBP", quality=quality or 85, method=4)
+    return buffer.getvalue()
+
+
+def _open_worker_document(file_path: str) -> fitz.Document:
+    """获取子进程内缓存的文档句柄"""
+    key = os.path.realpath(file_path)
+    mtime_ns = os.stat(key).st_mtime_ns
+    entry = _worker_documents.get(key)
+    if entry is not None and entry[0] == mtime_ns:
+        _worker_documents.move_to_end(key)
+        return entry[1]
+
+    if entry is not None:
+        entry[1].close()
+    doc = fitz.open(key)
+    _worker_documents[key] = (mtime_ns, doc)
+    while len(_worker_documents) > WORKER_MAX_OPEN_DOCUMENTS:
+        _, (_, oldest) = _worker_documents.popitem(last=False)
+        oldest.close()
+    return doc
+
+
+def render_encoded_in_worker(
+    file_path: str, page_number: int, dpi: int, fmt: str, quality: Optional[int]
+) -> Tuple[bytes, int, int]:
+    """
+    进程池任务：渲染并编码单个页面
+
+    Returns:
+        (编码后的字节, 宽, 高)
+    """
+    doc = _open_worker_document(file_path)
+    pix = render_pixmap(doc, page_number, dpi)
+    return encode_pixmap(pix, fmt, quality), pix.width, pix.height
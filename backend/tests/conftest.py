@@ -0,0 +1,13 @@
+"""Test configuration: point the app at a throwaway SQLite database."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp(prefix="unitutor-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{_tmp}/test.db")
+os.environ.setdefault("DEBUG", "false")
+os.environ.setdefault("RENDER_POOL_SIZE", "0")
+os.environ.setdefault("PAGE_CACHE_DIR", f"{_tmp}/pages")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,65 @@
+"""Splitting batched responses back into per-page Markdown."""
+from app.services.llm_service import PAGE_MARKER_PATTERN, split_batch_response
+from app.services.page_stream import BatchStreamSplitter
+
+BODY_3 = "## 导数\n" + "第三页讲解导数的定义与几何意义。" * 4
+BODY_4 = "## 积分\n" + "第四页讲解定积分与面积的关系。" * 4
+
+
+class RecordingStream:
+    """Stands in for PageStream: keeps appended text, cleared on reset."""
+
+    def __init__(self):
+        self.text = ""
+        self.resets = 0
+
+    def append(self, text):
+        self.text += text
+
+    def reset(self):
+        self.text = ""
+        self.resets += 1
+
+
+def test_split_returns_each_requested_page():
+    text = f"前言\n===PAGE 3===\n{BODY_3}\n=== page 4 ===\n{BODY_4}\n"
+    assert split_batch_response(text, [3, 4]) == {3: BODY_3, 4: BODY_4}
+
+
+def test_split_drops_unrequested_duplicated_and_short_pages():
+    text = (
+        f"===PAGE 3===\n{BODY_3}\n===PAGE 3===\n{BODY_3}\n"
+        f"===PAGE 4===\n太短\n"
+        f"===PAGE 9===\n{BODY_4}\n"
+    )
+    assert split_batch_response(text, [3, 4]) == {}
+
+
+def test_split_requires_marker_on_its_own_line():
+    text = f"正文提到 ===PAGE 3=== 但不是标记\n{BODY_3}"
+    assert split_batch_response(text, [3]) == {}
+
+
+def test_stream_splitter_routes_lines_across_chunk_boundaries():
+    streams = {3: RecordingStream(), 4: RecordingStream()}
+    splitter = BatchStreamSplitter(streams, PAGE_MARKER_PATTERN)
+    text = f"前言\n===PAGE 3===\n{BODY_3}\n===PAGE 4===\n{BODY_4}\n"
+    # Chunks split markers and multi-byte text at arbitrary points
+    for start in range(0, len(text), 7):
+        splitter.append(text[start:start + 7])
+
+    assert streams[3].text == BODY_3 + "\n"
+    assert streams[4].text == BODY_4 + "\n"
+
+
+def test_stream_splitter_reset_clears_every_page():
+    streams = {3: RecordingStream(), 4: RecordingStream()}
+    splitter = BatchStreamSplitter(streams, PAGE_MARKER_PATTERN)
+    splitter.append("===PAGE 3===\n部分输出\n===PA")
+    splitter.reset()
+    # A retry starts from scratch: text before the next marker is not routed
+    splitter.append("GE 4===\n不应出现\n===PAGE 4===\n重试输出\n")
+
+    assert streams[3].text == ""
+    assert streams[4].text == "重试输出\n"
+    assert streams[3].resets == streams[4].resets == 1
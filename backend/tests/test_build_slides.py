@@ -0,0 +1,64 @@
+"""Build-slide detection (animation steps exported as separate pages)."""
+from app.services.pdf_parser import PageProfile
+from app.services.processing_service import group_build_slides, is_build_step
+
+BODY = "Gradient descent\n- Compute the gradient of the loss on a mini-batch"
+
+
+def profile(page_number, text, dhash=0, images=0, drawings=0, kind="text"):
+    return PageProfile(page_number, "CONTENT", kind, text, images, drawings, dhash)
+
+
+def test_step_that_adds_a_bullet_is_grouped():
+    previous = profile(2, BODY, dhash=0b111)
+    current = profile(3, BODY + "\n- Update the weights", dhash=0b11111)
+    assert is_build_step(previous, current, max_distance=12)
+
+
+def test_shared_title_with_different_charts_is_not_grouped():
+    # Reported case: same title, different bar charts, fingerprint distance 10
+    previous = profile(4, "Experimental Results", dhash=(1 << 10) - 1, images=1, drawings=20, kind="visual")
+    current = profile(5, "Experimental Results", dhash=0, images=1, drawings=20, kind="visual")
+    assert not is_build_step(previous, current, max_distance=12)
+
+
+def test_sparse_text_needs_a_much_closer_fingerprint():
+    previous = profile(4, "Experimental Results", dhash=(1 << 10) - 1, drawings=20, kind="visual")
+    current = profile(5, "Experimental Results\nAccuracy", dhash=0, drawings=22, kind="visual")
+    assert not is_build_step(previous, current, max_distance=12)
+
+    close = profile(5, "Experimental Results\nAccuracy", dhash=0b11, drawings=22, kind="visual")
+    previous_close = profile(4, "Experimental Results", dhash=0, drawings=20, kind="visual")
+    assert is_build_step(previous_close, close, max_distance=12)
+
+
+def test_page_must_strictly_add_content():
+    page = profile(2, BODY)
+    assert not is_build_step(page, profile(3, BODY), max_distance=12)
+    # Removing a line is never a build step
+    longer = profile(2, BODY + "\n- Update the weights")
+    assert not is_build_step(longer, profile(3, BODY), max_distance=12)
+
+
+def test_more_graphics_counts_as_added_content():
+    previous = profile(2, BODY, drawings=3)
+    current = profile(3, BODY, drawings=9, dhash=0b1)
+    assert is_build_step(previous, current, max_distance=12)
+
+
+def test_trivial_and_distant_pages_are_not_grouped():
+    closing = PageProfile(3, "END", "closing", "Thank you", 0, 0, 0)
+    assert not is_build_step(profile(2, BODY), closing, max_distance=12)
+    far = profile(3, BODY + "\n- Update the weights", dhash=(1 << 20) - 1)
+    assert not is_build_step(profile(2, BODY), far, max_distance=12)
+
+
+def test_group_build_slides_returns_consecutive_runs():
+    profiles = {
+        1: profile(1, "Course overview\nWeek 1 introduction to optimisation methods"),
+        2: profile(2, BODY),
+        3: profile(3, BODY + "\n- Update the weights"),
+        4: profile(4, BODY + "\n- Update the weights\n- Repeat until convergence"),
+        5: profile(5, "Something else entirely, with a long enough body text", dhash=(1 << 30) - 1),
+    }
+    assert group_build_slides(profiles, max_distance=12) == [[2, 3, 4]]
@@ -0,0 +1,49 @@
+"""Chat sessions are persisted together with their first completed turn."""
+import asyncio
+import uuid
+
+from sqlalchemy import func, select
+
+from app.models.database import AsyncSessionLocal, ChatMessage, ChatSession, engine, init_db
+from app.services.chat_service import chat_sessions
+
+
+def run(coro):
+    async def wrapper():
+        await init_db()
+        try:
+            return await coro
+        finally:
+            await engine.dispose()
+    return asyncio.run(wrapper())
+
+
+async def message_count(db, session_id):
+    return await db.scalar(
+        select(func.count()).select_from(ChatMessage).where(ChatMessage.session_id == session_id)
+    )
+
+
+def test_new_session_is_written_with_first_turn():
+    async def body():
+        pdf_id = uuid.uuid4().hex
+        async with AsyncSessionLocal() as db:
+            session = await chat_sessions.get_or_create(db, pdf_id, None)
+            turn = await chat_sessions.build_turn(db, session, 1)
+            assert turn.history == []
+        async with AsyncSessionLocal() as db:
+            # A failed or abandoned first answer leaves nothing behind
+            assert await db.get(ChatSession, session.id) is None
+
+        await chat_sessions.record_turn(turn.session_id, pdf_id, "问题", "回答")
+        await chat_sessions.record_turn(turn.session_id, pdf_id, "追问", "回答")
+        async with AsyncSessionLocal() as db:
+            stored = await db.get(ChatSession, session.id)
+            assert stored.pdf_id == pdf_id
+            assert await message_count(db, session.id) == 4
+            resumed = await chat_sessions.get_or_create(db, pdf_id, session.id)
+            assert resumed.id == session.id
+            turn = await chat_sessions.build_turn(db, resumed, 1)
+            assert [m["content"] for m in turn.history] == ["问题", "回答", "追问", "回答"]
+
+    run(body())
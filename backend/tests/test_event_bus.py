@@ -0,0 +1,50 @@
+"""Event bus overflow handling and page stream aborts."""
+import asyncio
+
+from app.services.event_bus import OVERFLOW_EVENT, EventBus, event_bus
+from app.services.page_stream import PageStreamRegistry, page_topic
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_slow_subscriber_is_dropped_with_overflow_marker():
+    async def body():
+        bus = EventBus(queue_size=2)
+        async with bus.subscribe("t") as slow, bus.subscribe("t") as fast:
+            bus.publish("t", {"n": 1})
+            drain(fast)
+            bus.publish("t", {"n": 2})
+            bus.publish("t", {"n": 3})
+
+            # Backlog is discarded rather than silently losing one delta
+            assert drain(slow) == [OVERFLOW_EVENT]
+            assert drain(fast) == [{"n": 2}, {"n": 3}]
+
+            bus.publish("t", {"n": 4})
+            assert slow.empty()
+            assert drain(fast) == [{"n": 4}]
+            assert bus.subscriber_count("t") == 1
+            assert bus.stats()["overflows"] == 1
+        assert bus.subscriber_count("t") == 0
+
+    asyncio.run(body())
+
+
+def test_abort_ends_live_and_not_started_pages():
+    async def body():
+        registry = PageStreamRegistry()
+        live = registry.start("pdf", 1)
+        live.append("partial")
+        async with event_bus.subscribe(page_topic("pdf", 1)) as q1, \
+                event_bus.subscribe(page_topic("pdf", 2)) as q2:
+            registry.abort("pdf", [1, 2], "stopped")
+            assert drain(q1) == [{"type": "error", "message": "stopped"}]
+            assert drain(q2) == [{"type": "error", "message": "stopped"}]
+        assert registry.get("pdf", 1) is None
+
+    asyncio.run(body())
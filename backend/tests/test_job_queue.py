@@ -0,0 +1,199 @@
+"""Job queue: lease claiming, client API key handling and batched page state."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text, update
+
+from app.models.database import (
+    AsyncSessionLocal, PDFDocument, ProcessingJob, ProcessingJobPage, engine, init_db,
+)
+from app.services.job_queue import PARKED_ERROR, JobQueue
+from app.services.processing_service import JobProgress
+
+
+def run(coro):
+    """Run one test body on a fresh loop; pooled aiosqlite connections are bound to it."""
+    async def wrapper():
+        await init_db()
+        try:
+            return await coro
+        finally:
+            await engine.dispose()
+    return asyncio.run(wrapper())
+
+
+async def enqueue(queue, api_key=None, worker_id=None, pages=(1, 2)):
+    pdf_id = uuid.uuid4().hex
+    async with AsyncSessionLocal() as db:
+        db.add(PDFDocument(id=pdf_id, filename="a.pdf", total_pages=3, file_path="a.pdf"))
+        await db.commit()
+        job = await queue.enqueue(
+            db, pdf_id, list(pages), model="m", api_key=api_key,
+            max_concurrent_pages=1, worker_id=worker_id,
+        )
+        return job.id
+
+
+async def expire_lease(job_id):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(ProcessingJob)
+            .where(ProcessingJob.id == job_id)
+            .values(lease_expires_at=datetime.utcnow() - timedelta(seconds=1))
+        )
+        await db.commit()
+
+
+async def drain(queue, worker_id):
+    """Claim everything currently claimable so tests see only their own jobs."""
+    while await queue.claim(worker_id) is not None:
+        pass
+
+
+async def page_states(db, job_id):
+    rows = (await db.execute(
+        select(ProcessingJobPage).where(ProcessingJobPage.job_id == job_id)
+    )).scalars().all()
+    return {row.page_number: (row.state, row.attempts) for row in rows}
+
+
+def test_concurrent_claims_hand_out_job_once():
+    async def body():
+        queue = JobQueue(lease_seconds=60)
+        await drain(queue, "setup")
+        job_id = await enqueue(queue)
+        claims = await asyncio.gather(*(queue.claim(f"w{i}") for i in range(5)))
+        won = [job for job in claims if job is not None]
+        assert [job.id for job in won] == [job_id]
+        assert won[0].status == "running"
+        assert won[0].attempts == 1
+        assert await queue.claim("late") is None
+
+    run(body())
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_loses_it():
+    async def body():
+        queue = JobQueue(lease_seconds=60)
+        await drain(queue, "setup")
+        job_id = await enqueue(queue)
+        assert (await queue.claim("a")).id == job_id
+        assert await queue.renew(job_id, "a")
+
+        await expire_lease(job_id)
+        job = await queue.claim("b")
+        assert job.id == job_id
+        assert job.lease_owner == "b"
+        assert job.attempts == 2
+        assert not await queue.renew(job_id, "a")
+
+    run(body())
+
+
+def test_release_requeues_without_counting_attempt():
+    async def body():
+        queue = JobQueue(lease_seconds=60)
+        await drain(queue, "setup")
+        job_id = await enqueue(queue)
+        await queue.claim("a")
+        await queue.release(job_id, "a")
+        job = await queue.claim("b")
+        assert job.id == job_id
+        assert job.attempts == 1
+
+    run(body())
+
+
+def test_client_key_is_never_written_to_database():
+    async def body():
+        queue = JobQueue(lease_seconds=60)
+        job_id = await enqueue(queue, api_key="secret-key", worker_id="owner")
+        assert queue.api_key(job_id) == "secret-key"
+        async with AsyncSessionLocal() as db:
+            job = await db.get(ProcessingJob, job_id)
+            assert job.needs_client_key
+            row = (await db.execute(text("SELECT * FROM processing_jobs WHERE id = :id"), {"id": job_id})).one()
+            assert "secret-key" not in [str(value) for value in row]
+
+        await queue.finish(job_id, "owner", "completed")
+        assert queue.api_key(job_id) is None
+
+    run(body())
+
+
+def test_client_key_job_is_only_claimed_by_key_holder():
+    async def body():
+        holder = JobQueue(lease_seconds=60)
+        other = JobQueue(lease_seconds=60)
+        await drain(other, "setup")
+        job_id = await enqueue(holder, api_key="k", worker_id="owner")
+
+        await expire_lease(job_id)
+        assert await other.claim("intruder") is None
+        job = await holder.claim("owner")
+        assert job.id == job_id
+
+    run(body())
+
+
+def test_orphaned_client_key_job_is_parked():
+    async def body():
+        crashed = JobQueue(lease_seconds=60)
+        survivor = JobQueue(lease_seconds=60)
+        job_id = await enqueue(crashed, api_key="k", worker_id="gone")
+
+        # Lease still live: the holder may yet run it
+        assert job_id not in [jid for jid, _ in await survivor.park_orphaned()]
+
+        await expire_lease(job_id)
+        assert job_id in [jid for jid, _ in await survivor.park_orphaned()]
+        async with AsyncSessionLocal() as db:
+            job = await db.get(ProcessingJob, job_id)
+            assert job.status == "failed"
+            assert job.error == PARKED_ERROR
+
+    run(body())
+
+
+def test_held_key_job_is_not_parked():
+    async def body():
+        holder = JobQueue(lease_seconds=60)
+        job_id = await enqueue(holder, api_key="k", worker_id="owner")
+        await expire_lease(job_id)
+        assert job_id not in [jid for jid, _ in await holder.park_orphaned()]
+
+        await holder.renew_held("owner")
+        async with AsyncSessionLocal() as db:
+            job = await db.get(ProcessingJob, job_id)
+            assert job.lease_expires_at > datetime.utcnow()
+
+    run(body())
+
+
+def test_page_states_are_flushed_with_progress():
+    async def body():
+        queue = JobQueue(lease_seconds=60)
+        job_id = await enqueue(queue, pages=(1, 2, 3))
+        async with AsyncSessionLocal() as db:
+            pdf_id = (await db.get(ProcessingJob, job_id)).pdf_id
+
+        progress = JobProgress(pdf_id, 3, job_id)
+        await progress.start_page(1)
+        await progress.start_page(2)
+        await progress.settle([1], "done")
+        await progress.settle([2], "failed")
+        async with AsyncSessionLocal() as db:
+            # Nothing written until the batch is due
+            pages = await page_states(db, job_id)
+            assert pages == {1: ("pending", 0), 2: ("pending", 0), 3: ("pending", 0)}
+
+        await progress.flush()
+        async with AsyncSessionLocal() as db:
+            assert await page_states(db, job_id) == {1: ("done", 1), 2: ("failed", 1), 3: ("pending", 0)}
+            assert (await db.get(PDFDocument, pdf_id)).processed_pages == 1
+
+        # Failed pages are not retried, so a resumed run covers the other two
+        assert await queue.prepare_resume(job_id, max_page_attempts=2) == [1, 3]
+
+    run(body())
@@ -0,0 +1,53 @@
+"""Per-key Gemini clients and the explanation memo."""
+import asyncio
+
+import google.generativeai as genai
+import pytest
+
+from app.services import llm_service
+from app.services.llm_service import (
+    build_model, explanation_memo_key, mask_page_numbers, unmask_page_numbers,
+)
+
+
+def credentials_token(client):
+    return client._transport._credentials.token
+
+
+def test_each_model_gets_its_own_key():
+    async def body():
+        # The async gRPC client binds to the running loop when created
+        a = build_model("key-a", "gemini-2.5-flash")
+        b = build_model("key-b", "gemini-2.5-flash")
+        assert credentials_token(a._client) == "key-a"
+        assert credentials_token(a._async_client._client) == "key-a"
+        assert credentials_token(b._client) == "key-b"
+
+    asyncio.run(body())
+
+
+def test_missing_client_attributes_fail_loudly(monkeypatch):
+    class StrippedModel:
+        def __init__(self, model):
+            self.model_name = model
+
+    monkeypatch.setattr(llm_service.genai, "GenerativeModel", StrippedModel)
+    with pytest.raises(RuntimeError, match=genai.__version__):
+        build_model("key-a", "gemini-2.5-flash")
+
+
+def test_memo_key_ignores_page_numbers():
+    key = lambda summaries: explanation_memo_key("m", "template", b"page", summaries, 0.7, 100)
+    assert key(["[第3页摘要] 导数的定义"]) == key(["[第17页摘要] 导数的定义"])
+    assert key(["[第3页摘要] 导数的定义"]) != key(["[第3页摘要] 积分的定义"])
+
+
+def test_memo_text_refills_page_numbers():
+    generated = "===PAGE 3===\n第 3 页承接第 2 页的内容\n===PAGE 4===\n第4页"
+    masked = mask_page_numbers(generated, [3, 4])
+    assert "3" not in masked and "4" not in masked
+    assert "第 2 页" in masked  # pages outside the request stay as written
+    assert unmask_page_numbers(masked, [3, 4]) == generated
+    assert unmask_page_numbers(masked, [10, 11]) == (
+        "===PAGE 10===\n第 10 页承接第 2 页的内容\n===PAGE 11===\n第11页"
+    )
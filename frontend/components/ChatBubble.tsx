@@ -19,22 +19,32 @@ export default function ChatBubble() {
     setIsLoading,
     clearMessages,
     setCurrentPageContext,
+    sessionId,
+    setSessionId,
   } = useChatStore();
 
-  const { pdfId, currentPage, explanations } = usePdfStore();
+  const { pdfId, currentPage } = usePdfStore();
   const { apiKey, model, isConfigured } = useSettingsStore();
 
   const [inputValue, setInputValue] = useState('');
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const inputRef = useRef<HTMLTextAreaElement>(null);
+  // 进行中的聊天请求；中止后服务端检测到断开并停止生成
+  const abortRef = useRef<AbortController | null>(null);
 
   // 当页面切换时，更新上下文并清空聊天
   useEffect(() => {
     if (currentPage !== currentPageContext) {
+      abortRef.current?.abort();
       setCurrentPageContext(currentPage);
     }
   }, [currentPage, currentPageContext, setCurrentPageContext]);
 
+  // 组件卸载时中止未完成的请求
+  useEffect(() => {
+    return () => abortRef.current?.abort();
+  }, []);
+
   // 自动滚动到底部
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -47,12 +57,6 @@ export default function ChatBubble() {
     }
   }, [isOpen]);
 
-  // 获取当前页面的解释内容作为上下文
-  const getCurrentContext = () => {
-    const explanation = explanations.get(currentPage);
-    return explanation?.markdown_content || '';
-  };
-
   // 发送消息
   const handleSend = async () => {
     if (!inputValue.trim() || isLoading || !pdfId) return;
@@ -89,13 +93,11 @@ export default function ChatBubble() {
 
     setIsLoading(true);
 
-    try {
-      const context = getCurrentContext();
-      const history = messages.map((msg) => ({
-        role: msg.role,
-        content: msg.content,
-      }));
+    const controller = new AbortController();
+    abortRef.current = controller;
+    let fullContent = '';
 
+    try {
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
       // 确保 API URL 不为空字符串
       const baseUrl = apiUrl && apiUrl.trim() !== '' ? apiUrl : 'http://localhost:8000';
@@ -108,7 +110,7 @@ export default function ChatBubble() {
         fullUrl,
         pdfId,
         currentPage,
-        hasContext: !!context,
+        sessionId,
         model,
       });
 
@@ -118,11 +120,12 @@ export default function ChatBubble() {
         headers: {
           'Content-Type': 'application/json',
         },
+        signal: controller.signal,
         body: JSON.stringify({
             question: userMessage,
             page_number: currentPage,
-            context: context,
-            history: history,
+            // 页面讲解与对话历史由服务端按会话维护
+            session_id: sessionId,
             llm_config: {
               api_key: apiKey,
               model: model,
@@ -152,15 +155,17 @@ export default function ChatBubble() {
       // 处理流式响应
       const reader = response.body?.getReader();
       const decoder = new TextDecoder();
-      let fullContent = '';
+      // 一次读取可能在行中间结束，不完整的行留到下次拼接
+      let buffer = '';
 
       if (reader) {
         while (true) {
           const { done, value } = await reader.read();
           if (done) break;
 
-          const chunk = decoder.decode(value, { stream: true });
-          const lines = chunk.split('\n');
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop() ?? '';
 
           for (const line of lines) {
             if (line.startsWith('data: ')) {
@@ -170,7 +175,12 @@ export default function ChatBubble() {
               } else {
                 try {
                   const parsed = JSON.parse(data);
-                  if (parsed.content) {
+                  if (parsed.session_id) {
+                    setSessionId(parsed.session_id);
+                  } else if (parsed.error) {
+                    fullContent += `\n\n抱歉，发生错误：${parsed.error}`;
+                    updateMessage(assistantMsgId, fullContent, true);
+                  } else if (parsed.content) {
                     fullContent += parsed.content;
                     updateMessage(assistantMsgId, fullContent, true);
                   }
@@ -185,6 +195,11 @@ export default function ChatBubble() {
 
       updateMessage(assistantMsgId, fullContent, false);
     } catch (error: any) {
+      if (error.name === 'AbortError') {
+        // 用户切换页面或关闭组件，保留已收到的内容
+        updateMessage(assistantMsgId, fullContent, false);
+        return;
+      }
       console.error('聊天请求失败:', error);
       updateMessage(
         assistantMsgId,
@@ -192,6 +207,9 @@ export default function ChatBubble() {
         false
       );
     } finally {
+      if (abortRef.current === controller) {
+        abortRef.current = null;
+      }
       setIsLoading(false);
     }
   };
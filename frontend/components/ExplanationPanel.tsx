@@ -7,7 +7,7 @@ import remarkMath from 'remark-math';
 import rehypeKatex from 'rehype-katex';
 import { usePdfStore } from '@/store/pdfStore';
 import { useSettingsStore } from '@/store/settingsStore';
-import { getExplanation, getProgress, downloadMarkdown, clearPageCache, startProcessing } from '@/lib/api';
+import { getExplanation, subscribeProgress, subscribePageStream, downloadMarkdown, downloadZipBundle, clearPageCache, startProcessing } from '@/lib/api';
 
 // 判断内容是否是临时的"正在生成中"内容
 const isTemporaryContent = (content: string) => {
@@ -58,56 +58,51 @@ export default function ExplanationPanel() {
 
   // 重新分析状态
   const [isReanalyzing, setIsReanalyzing] = useState(false);
+  // 当前页正在生成中的文本（实时推送，完成后写入 store）
+  const [liveText, setLiveText] = useState<string | null>(null);
 
   // 计算显示用的总页数：如果有选择页面，使用选择的页数；否则使用总页数
   const displayTotalPages = selectedPages.length > 0 ? selectedPages.length : totalPages;
 
-  // 用于跟踪当前页面的轮询
-  const pollIntervalRef = useRef<NodeJS.Timeout | null>(null);
   // 防止重复加载的标志
   const isLoadingRef = useRef(false);
   // 记录当前加载的页面，避免重复加载
   const currentLoadingPageRef = useRef<number | null>(null);
-  // 轮询次数计数器，防止无限轮询
-  const pollCountRef = useRef<number>(0);
-  const MAX_POLL_COUNT = 60; // 最多轮询60次（2分钟）
   // 用 ref 保存最新的 currentPage，避免闭包问题
   const currentPageRef = useRef(currentPage);
   currentPageRef.current = currentPage;
 
-  // 轮询处理进度（仅在处理中时轮询）
+  // 订阅处理进度（仅在处理中时订阅），页面完成时刷新当前页
   useEffect(() => {
     if (!pdfId) return;
     if (processingStatus !== 'processing') return;
 
-    const pollProgress = async () => {
-      try {
-        const progress = await getProgress(pdfId);
+    const unsubscribe = subscribeProgress(pdfId, {
+      onProgress: (progress) => {
         setProgress(progress.status, progress.processed_pages, progress.progress_percentage);
-      } catch (error) {
-        console.error('获取进度失败:', error);
-      }
-    };
-
-    // 立即获取一次
-    pollProgress();
-
-    // 每 3 秒轮询一次
-    const interval = setInterval(pollProgress, 3000);
+      },
+      onPageReady: async (pageNumber) => {
+        // 只刷新用户正在查看的页面，其他页面切换过去时再加载
+        if (currentPageRef.current !== pageNumber) return;
+        try {
+          const explanation = await getExplanation(pdfId, pageNumber);
+          if (currentPageRef.current === pageNumber) {
+            setExplanation(pageNumber, explanation);
+            console.log(`✅ 第 ${pageNumber} 页解释已完成`);
+          }
+        } catch (error) {
+          console.error('获取解释失败:', error);
+        }
+      },
+    });
 
-    return () => clearInterval(interval);
+    return unsubscribe;
   }, [pdfId, processingStatus]);
 
   // 当页面切换时，加载解释
   useEffect(() => {
     if (!pdfId) return;
 
-    // 立即清除之前的轮询
-    if (pollIntervalRef.current) {
-      clearInterval(pollIntervalRef.current);
-      pollIntervalRef.current = null;
-    }
-
     const loadExplanation = async () => {
       // 防止重复加载同一页面
       if (isLoadingRef.current && currentLoadingPageRef.current === currentPage) {
@@ -126,11 +121,6 @@ export default function ExplanationPanel() {
         return;
       }
 
-      // 如果缓存是临时内容，并且当前正在处理中，需要重新加载和轮询
-      if (cached && isTemporaryContent(cached.markdown_content) && processingStatus === 'processing') {
-        console.log(`🔄 第 ${currentPage} 页内容为临时内容，正在处理中，启动轮询...`);
-      }
-
       // 设置加载标志
       isLoadingRef.current = true;
       currentLoadingPageRef.current = currentPage;
@@ -139,73 +129,9 @@ export default function ExplanationPanel() {
       setPageError(currentPage, null);
 
       try {
+        // 临时内容会在收到该页的完成事件后刷新
         const explanation = await getExplanation(pdfId, currentPage);
         setExplanation(currentPage, explanation);
-
-        // 如果返回的是临时内容，且当前页面在选中的处理列表中，启动轮询
-        const isPageInSelectedList = selectedPages.length === 0 || selectedPages.includes(currentPage);
-        const pageToLoad = currentPage; // 保存当前要加载的页码
-
-        if (isTemporaryContent(explanation.markdown_content) && isPageInSelectedList) {
-          // 确保之前的轮询已清除
-          if (pollIntervalRef.current) {
-            clearInterval(pollIntervalRef.current);
-          }
-
-          // 重置轮询计数
-          pollCountRef.current = 0;
-
-          console.log(`📡 开始轮询第 ${pageToLoad} 页的解释...`);
-
-          pollIntervalRef.current = setInterval(async () => {
-            // 如果页面已切换，停止轮询
-            if (currentPageRef.current !== pageToLoad) {
-              console.log(`⏹️ 页面已切换，停止轮询第 ${pageToLoad} 页`);
-              if (pollIntervalRef.current) {
-                clearInterval(pollIntervalRef.current);
-                pollIntervalRef.current = null;
-              }
-              return;
-            }
-
-            // 检查轮询次数限制
-            pollCountRef.current += 1;
-            if (pollCountRef.current > MAX_POLL_COUNT) {
-              console.log('轮询次数达到上限，停止轮询');
-              if (pollIntervalRef.current) {
-                clearInterval(pollIntervalRef.current);
-                pollIntervalRef.current = null;
-              }
-              return;
-            }
-
-            try {
-              const newExplanation = await getExplanation(pdfId, pageToLoad);
-
-              // 只有当用户还在同一页时才更新
-              if (currentPageRef.current === pageToLoad) {
-                setExplanation(pageToLoad, newExplanation);
-                console.log(`🔄 第 ${pageToLoad} 页内容已更新`);
-
-                // 如果不再是临时内容，停止轮询
-                if (!isTemporaryContent(newExplanation.markdown_content)) {
-                  console.log(`✅ 第 ${pageToLoad} 页解释已完成，停止轮询`);
-                  if (pollIntervalRef.current) {
-                    clearInterval(pollIntervalRef.current);
-                    pollIntervalRef.current = null;
-                  }
-                }
-              }
-            } catch (error) {
-              console.error('轮询解释失败:', error);
-              // 轮询出错时也停止轮询
-              if (pollIntervalRef.current) {
-                clearInterval(pollIntervalRef.current);
-                pollIntervalRef.current = null;
-              }
-            }
-          }, 2000); // 每 2 秒检查一次
-        }
       } catch (error: any) {
         console.error('加载解释失败:', error);
         const errorMsg = error.response?.data?.detail || '加载解释失败';
@@ -218,15 +144,35 @@ export default function ExplanationPanel() {
     };
 
     loadExplanation();
+  }, [pdfId, currentPage, processingStatus]); // 添加 processingStatus，当开始处理时重新加载
+
+  // 当前页尚未生成完成时，订阅其生成过程，实时显示已输出的文本
+  const currentPagePending = !explanations.get(currentPage) ||
+    isTemporaryContent(explanations.get(currentPage)!.markdown_content);
+
+  useEffect(() => {
+    if (!pdfId) return;
+    if (processingStatus !== 'processing' || !currentPagePending) return;
+
+    const page = currentPage;
+    const unsubscribe = subscribePageStream(pdfId, page, {
+      onDelta: (text) => setLiveText((prev) => (prev ?? '') + text),
+      onReset: () => setLiveText(''),
+      onDone: (explanation) => {
+        setExplanation(page, explanation);
+        setLiveText(null);
+      },
+      onError: (message) => {
+        console.error(`第 ${page} 页生成失败:`, message);
+        setLiveText(null);
+      },
+    });
 
-    // 清理函数
     return () => {
-      if (pollIntervalRef.current) {
-        clearInterval(pollIntervalRef.current);
-        pollIntervalRef.current = null;
-      }
+      unsubscribe();
+      setLiveText(null);
     };
-  }, [pdfId, currentPage, processingStatus]); // 添加 processingStatus，当开始处理时重新加载
+  }, [pdfId, currentPage, processingStatus, currentPagePending]);
 
   // 下载处理
   const handleDownload = useCallback(async () => {
@@ -240,6 +186,18 @@ export default function ExplanationPanel() {
     }
   }, [pdfId, filename]);
 
+  // 下载 ZIP 包（图片为独立文件）
+  const handleDownloadZip = useCallback(async () => {
+    if (!pdfId || !filename) return;
+
+    try {
+      await downloadZipBundle(pdfId, filename.replace('.pdf', ''));
+    } catch (error: any) {
+      console.error('下载失败:', error);
+      alert(error.response?.data?.detail || '下载失败');
+    }
+  }, [pdfId, filename]);
+
   // 重新分析当前页
   const handleReanalyze = useCallback(async () => {
     if (!pdfId || !apiKey) {
@@ -332,6 +290,14 @@ export default function ExplanationPanel() {
         >
           {processingStatus === 'completed' ? '📥 下载完整讲解文档' : '等待处理完成后下载...'}
         </button>
+        {processingStatus === 'completed' && (
+          <button
+            onClick={handleDownloadZip}
+            className="w-full mt-2 py-2 px-4 rounded-lg text-xs font-medium text-gray-700 bg-white border border-gray-300 hover:bg-gray-50 transition-all"
+          >
+            📦 下载 ZIP 包（图片为独立文件，适合大文档）
+          </button>
+        )}
       </div>
 
       {/* 内容区域 - 增大padding */}
@@ -418,7 +384,7 @@ export default function ExplanationPanel() {
                 ),
               }}
             >
-              {fixLatexBlocks(currentExplanation.markdown_content)}
+              {fixLatexBlocks(liveText || currentExplanation.markdown_content)}
             </ReactMarkdown>
           </div>
         ) : (
@@ -110,6 +110,83 @@ export async function getProgress(pdfId: string): Promise<ProcessingProgress> {
   return response.data;
 }
 
+export interface ProgressStreamHandlers {
+  onProgress?: (progress: ProcessingProgress) => void;
+  onPageReady?: (pageNumber: number) => void;
+}
+
+/**
+ * 订阅处理进度（SSE）
+ * 连接后立即收到当前进度，之后推送进度变化和页面完成事件；
+ * 断线时 EventSource 自动重连。返回取消订阅函数。
+ */
+export function subscribeProgress(
+  pdfId: string,
+  handlers: ProgressStreamHandlers
+): () => void {
+  const source = new EventSource(`${API_BASE_URL}/api/progress/${pdfId}/stream`);
+
+  source.onmessage = (event) => {
+    try {
+      const data = JSON.parse(event.data);
+      if (data.type === 'progress') {
+        handlers.onProgress?.(data as ProcessingProgress);
+      } else if (data.type === 'page') {
+        handlers.onPageReady?.(data.page_number);
+      }
+    } catch (e) {
+      console.error('解析进度事件失败:', e);
+    }
+  };
+
+  return () => source.close();
+}
+
+export interface PageStreamHandlers {
+  onDelta: (text: string) => void;
+  onReset?: () => void;
+  onDone: (explanation: PageExplanationMarkdown) => void;
+  onError?: (message: string) => void;
+}
+
+/**
+ * 订阅单页解释的生成过程（SSE）
+ * 生成中的页面先收到已生成的文本，之后逐段推送；完成后收到最终结果。
+ * 返回取消订阅函数。
+ */
+export function subscribePageStream(
+  pdfId: string,
+  pageNumber: number,
+  handlers: PageStreamHandlers
+): () => void {
+  const source = new EventSource(`${API_BASE_URL}/api/explain/${pdfId}/${pageNumber}/stream`);
+
+  source.onmessage = (event) => {
+    try {
+      const data = JSON.parse(event.data);
+      if (data.type === 'delta') {
+        handlers.onDelta(data.text);
+      } else if (data.type === 'reset') {
+        handlers.onReset?.();
+      } else if (data.type === 'done') {
+        source.close();
+        handlers.onDone({
+          page_number: data.page_number,
+          markdown_content: data.markdown_content,
+          summary: data.summary,
+        });
+      } else if (data.type === 'error') {
+        source.close();
+        handlers.onError?.(data.message);
+      }
+    } catch (e) {
+      console.error('解析页面事件失败:', e);
+    }
+  };
+
+  return () => source.close();
+}
+
 /**
  * LLM 配置接口
  */
@@ -159,6 +236,25 @@ export async function downloadMarkdown(pdfId: string, filename: string): Promise
   window.URL.revokeObjectURL(url);
 }
 
+/**
+ * 下载 ZIP 包（Markdown + 独立的页面图片文件）
+ */
+export async function downloadZipBundle(pdfId: string, filename: string): Promise<void> {
+  const response = await api.get(`/api/download/${pdfId}/zip`, {
+    responseType: 'blob',
+  });
+
+  // 创建下载链接
+  const url = window.URL.createObjectURL(new Blob([response.data], { type: 'application/zip' }));
+  const link = document.createElement('a');
+  link.href = url;
+  link.setAttribute('download', `${filename}_explained.zip`);
+  document.body.appendChild(link);
+  link.click();
+  link.remove();
+  window.URL.revokeObjectURL(url);
+}
+
 /**
  * 清除指定页面的缓存
  */
@@ -14,6 +14,7 @@ interface ChatState {
   isOpen: boolean;
   isLoading: boolean;
   currentPageContext: number; // 当前上下文对应的页码
+  sessionId: string | null; // 服务端会话 ID，对话历史保存在服务端
 
   // Actions
   addMessage: (message: Omit<ChatMessage, 'id' | 'timestamp'>) => string;
@@ -22,6 +23,7 @@ interface ChatState {
   setIsLoading: (isLoading: boolean) => void;
   clearMessages: () => void;
   setCurrentPageContext: (page: number) => void;
+  setSessionId: (sessionId: string | null) => void;
 }
 
 export const useChatStore = create<ChatState>((set, get) => ({
@@ -30,6 +32,7 @@ export const useChatStore = create<ChatState>((set, get) => ({
   isOpen: false,
   isLoading: false,
   currentPageContext: 1,
+  sessionId: null,
 
   // Actions
   addMessage: (message) => {
@@ -57,13 +60,15 @@ export const useChatStore = create<ChatState>((set, get) => ({
 
   setIsLoading: (isLoading) => set({ isLoading }),
 
-  clearMessages: () => set({ messages: [] }),
+  clearMessages: () => set({ messages: [], sessionId: null }),
 
   setCurrentPageContext: (page) => {
     const state = get();
     // 如果页面变化，清空聊天记录
     if (state.currentPageContext !== page) {
-      set({ currentPageContext: page, messages: [] });
+      set({ currentPageContext: page, messages: [], sessionId: null });
     }
   },
+
+  setSessionId: (sessionId) => set({ sessionId }),
 }));